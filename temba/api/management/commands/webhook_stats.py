@@ -106,6 +106,7 @@ class Command(BaseCommand):  # pragma: no cover
             items = sorted(items, key=lambda i: i['failures']['timeouts']['count'], reverse=True)
 
         self._print_summary(items)
+        self._print_latency_histogram(WebHookResult.get_latency_histogram(results))
 
     def handle_slowest(self, max_age):
         results = WebHookResult.objects.only('url', 'request_time').order_by('-request_time')
@@ -142,6 +143,15 @@ class Command(BaseCommand):  # pragma: no cover
             ))
             self.stdout.write("   * all: %s" % ', '.join(all_codes))
 
+    def _print_latency_histogram(self, histogram):
+        self.stdout.write("\nRequest Times:\n=================================")
+
+        lower = 0
+        for upper, count in six.iteritems(histogram):
+            label = "%d-%dms" % (lower, upper) if upper is not None else "> %dms" % lower
+            self.stdout.write(" * %s: %s" % (label, self._num_style(count)))
+            lower = upper
+
     def _url_to_key(self, url, by_key):
         parsed_url = urlparse(url)
 
@@ -10,7 +10,7 @@ import uuid
 
 from collections import OrderedDict
 from datetime import timedelta
-from django.db.models import Q
+from django.db.models import Q, Count, Case, When
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, Group
@@ -18,6 +18,7 @@ from django.db import models
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 from rest_framework.permissions import BasePermission
 from smartmin.models import SmartModel
 from temba.channels.models import Channel, ChannelEvent
@@ -27,7 +28,7 @@ from temba.orgs.models import Org
 from temba.utils import prepped_request_to_str, on_transaction_commit
 from temba.utils.cache import get_cacheable_attr
 from temba.utils.dates import datetime_to_str
-from temba.utils.http import http_headers
+from temba.utils.http import http_headers, get_session, send_request, CircuitOpenError
 from urllib import urlencode
 
 
@@ -184,6 +185,17 @@ class WebHookEvent(SmartModel):
                       (STATUS_ERRORED, "Errored"),
                       (STATUS_FAILED, "Failed"))
 
+    # timeouts in seconds of event deliveries and of flow webhook calls
+    DELIVERY_TIMEOUT = 5
+    FLOW_WEBHOOK_TIMEOUT = 10
+
+    # how many event deliveries can be in flight at once in a batch
+    DELIVERY_CONCURRENCY = 10
+
+    # events are attempted this many times, with retries backing off exponentially from this delay
+    MAX_TRIES = 3
+    RETRY_BACKOFF = timedelta(minutes=5)
+
     org = models.ForeignKey(Org,
                             help_text="The organization that this event was triggered for")
     resthook = models.ForeignKey(Resthook, null=True,
@@ -255,10 +267,13 @@ class WebHookEvent(SmartModel):
 
                 # some hosts deny generic user agents, use Temba as our user agent
                 if action == 'GET':
-                    response = requests.get(webhook_url, headers=requests_headers, timeout=10)
+                    request = requests.Request('GET', webhook_url, headers=requests_headers)
                 else:
                     requests_headers['Content-type'] = 'application/json'
-                    response = requests.post(webhook_url, data=json.dumps(post_data), headers=requests_headers, timeout=10)
+                    request = requests.Request('POST', webhook_url, data=json.dumps(post_data), headers=requests_headers)
+
+                prepped = get_session(webhook_url).prepare_request(request)
+                response = send_request(prepped, timeout=cls.FLOW_WEBHOOK_TIMEOUT)
 
                 body = response.text
                 if body:
@@ -414,9 +429,12 @@ class WebHookEvent(SmartModel):
 
                 # some hosts deny generic user agents, use Temba as our user agent
                 if action == 'GET':
-                    response = requests.get(webhook_url, headers=requests_headers, timeout=10)
+                    request = requests.Request('GET', webhook_url, headers=requests_headers)
                 else:
-                    response = requests.post(webhook_url, data=data, headers=requests_headers, timeout=10)
+                    request = requests.Request('POST', webhook_url, data=data, headers=requests_headers)
+
+                prepped = get_session(webhook_url).prepare_request(request)
+                response = send_request(prepped, timeout=cls.FLOW_WEBHOOK_TIMEOUT)
 
                 body = response.text
                 if body:
@@ -585,9 +603,55 @@ class WebHookEvent(SmartModel):
         return hook_event
 
     def deliver(self):
-        from .v1.serializers import MsgCreateSerializer
-        start = time.time()
+        result, user, prepped, error = self._prepare_delivery()
+
+        # nothing to send, e.g. no webhook registered
+        if prepped is None and error is None:
+            return result
+
+        response, error, request_time = self._send_delivery(prepped) if prepped else (None, error, 0)
+
+        self._complete_delivery(result, user, response, error, request_time)
+        return result
+
+    @classmethod
+    def deliver_batch(cls, events):
+        """
+        Delivers the given events and records their results. Requests are sent from a bounded pool of threads, using
+        pooled connections to each host, so that a slow endpoint only ties up some threads rather than a whole worker.
+        All database work happens on the calling thread.
+        """
+        deliveries = []
+        for event in events:
+            result, user, prepped, error = event._prepare_delivery()
+
+            if prepped is None:
+                if error is not None:
+                    event._complete_delivery(result, user, None, error, 0)
+
+                WebHookResult.record_result(event, result)
+            else:
+                deliveries.append((event, result, user, prepped))
 
+        if not deliveries:
+            return
+
+        pool = ThreadPool(min(len(deliveries), cls.DELIVERY_CONCURRENCY))
+        try:
+            sent = pool.map(cls._send_delivery, [d[3] for d in deliveries])
+        finally:
+            pool.close()
+            pool.join()
+
+        for (event, result, user, prepped), (response, error, request_time) in zip(deliveries, sent):
+            event._complete_delivery(result, user, response, error, request_time)
+            WebHookResult.record_result(event, result)
+
+    def _prepare_delivery(self):
+        """
+        Prepares the request to deliver this event. Returns a tuple of the result so far, the org user, the prepared
+        request and any error which has already made delivery impossible.
+        """
         # create our post parameters
         post_data = json.loads(self.data)
         post_data['event'] = self.event
@@ -603,7 +667,7 @@ class WebHookEvent(SmartModel):
             result['message'] = "No webhook registered for this org, ignoring event"
             self.status = self.STATUS_FAILED
             self.next_attempt = None
-            return result
+            return result, None, None, None
 
         # get our org user
         user = self.org.get_user()
@@ -614,37 +678,64 @@ class WebHookEvent(SmartModel):
             result['message'] = "No active user for this org, ignoring event"
             self.status = self.STATUS_FAILED
             self.next_attempt = None
-            return result
+            return result, None, None, None
 
-        # make the request
         try:
             if not settings.SEND_WEBHOOKS:
                 raise Exception("!! Skipping WebHook send, SEND_WEBHOOKS set to False")
 
             headers = http_headers(extra=self.org.get_webhook_headers())
 
-            s = requests.Session()
             prepped = requests.Request('POST', self.org.get_webhook_url(),
                                        data=post_data,
                                        headers=headers).prepare()
             result['url'] = prepped.url
             result['request'] = prepped_request_to_str(prepped)
-            r = s.send(prepped, timeout=5)
 
-            result['status_code'] = r.status_code
-            result['body'] = r.text.strip()
+            return result, user, prepped, None
+
+        except Exception as e:
+            return result, user, None, e
+
+    @classmethod
+    def _send_delivery(cls, prepped):
+        """
+        Sends a prepared delivery request, returning the response or the error and the request time in milliseconds.
+        This makes no database queries so is safe to call from other threads.
+        """
+        start = time.time()
+        try:
+            response, error = send_request(prepped, timeout=cls.DELIVERY_TIMEOUT), None
+        except Exception as e:
+            response, error = None, e
+
+        return response, error, (time.time() - start) * 1000
+
+    def _complete_delivery(self, result, user, response, error, request_time):
+        """
+        Updates this event and the result from the response to, or error from, a delivery attempt
+        """
+        from .v1.serializers import MsgCreateSerializer
+
+        result['request_time'] = request_time
+
+        try:
+            if error:
+                raise error
+
+            result['status_code'] = response.status_code
+            result['body'] = response.text.strip()
 
-            r.raise_for_status()
+            response.raise_for_status()
 
             # any 200 code is ok by us
             self.status = self.STATUS_COMPLETE
-            result['request_time'] = (time.time() - start) * 1000
             result['message'] = "Event delivered successfully."
 
             # read our body if we have one
             if result['body']:
                 try:
-                    data = r.json()
+                    data = response.json()
                     serializer = MsgCreateSerializer(data=data, user=user, org=self.org)
 
                     if serializer.is_valid():
@@ -663,23 +754,25 @@ class WebHookEvent(SmartModel):
         except Exception as e:
             # we had an error, log it
             self.status = self.STATUS_ERRORED
-            result['request_time'] = time.time() - start
             result['message'] = "Error when delivering event - %s" % six.text_type(e)
 
-        # if we had an error of some kind, schedule a retry for five minutes from now
+        # if the endpoint's circuit is open we didn't actually try, so just check back once it may have recovered
+        if isinstance(error, CircuitOpenError):
+            self.next_attempt = timezone.now() + self.RETRY_BACKOFF
+            return
+
+        # if we had an error of some kind, schedule a retry, backing off exponentially
         self.try_count += 1
 
         if self.status == self.STATUS_ERRORED:
-            if self.try_count < 3:
-                self.next_attempt = timezone.now() + timedelta(minutes=5)
+            if self.try_count < self.MAX_TRIES:
+                self.next_attempt = timezone.now() + self.RETRY_BACKOFF * (2 ** (self.try_count - 1))
             else:
                 self.next_attempt = None
-                self.status = 'F'
+                self.status = self.STATUS_FAILED
         else:
             self.next_attempt = None
 
-        return result
-
     def __str__(self):  # pragma: needs cover
         return "WebHookEvent[%s:%d] %s" % (self.event, self.pk, self.data)
 
@@ -705,6 +798,9 @@ class WebHookResult(SmartModel):
     contact = models.ForeignKey('contacts.Contact', null=True, related_name='webhook_results',
                                 help_text="The contact that generated this result")
 
+    # upper bounds in milliseconds of the buckets used for request time histograms
+    LATENCY_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000)
+
     @classmethod
     def record_result(cls, event, result):
         # save our event
@@ -735,6 +831,30 @@ class WebHookResult(SmartModel):
                            created_by=api_user,
                            modified_by=api_user)
 
+    @classmethod
+    def get_latency_histogram(cls, results):
+        """
+        Calculates a histogram of the request times of the given results in a single query. Returns an ordered dict of
+        bucket upper bound to count, with None as the bound of the bucket for anything slower than the largest bound.
+        """
+        bounds = list(cls.LATENCY_BUCKETS) + [None]
+        aggregates = {}
+        lower = None
+
+        for b, upper in enumerate(bounds):
+            condition = Q()
+            if lower is not None:
+                condition &= Q(request_time__gt=lower)
+            if upper is not None:
+                condition &= Q(request_time__lte=upper)
+
+            aggregates['bucket_%d' % b] = Count(Case(When(condition, then=1), output_field=models.IntegerField()))
+            lower = upper
+
+        counts = results.exclude(request_time=None).aggregate(**aggregates)
+
+        return OrderedDict([(upper, counts['bucket_%d' % b]) for b, upper in enumerate(bounds)])
+
     @property
     def is_success(self):
         return 200 <= self.status_code < 300
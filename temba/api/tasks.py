@@ -11,6 +11,8 @@ from temba.utils import chunk_list
 from temba.utils.queues import nonoverlapping_task
 from .models import WebHookEvent, WebHookResult
 
+RETRY_BATCH_SIZE = 100
+
 
 @task(track_started=True, name='deliver_event_task')
 def deliver_event_task(event_id):  # pragma: no cover
@@ -33,24 +35,53 @@ def deliver_event_task(event_id):  # pragma: no cover
                 WebHookResult.record_result(event, result)
 
 
+@task(track_started=True, name='deliver_events_task')
+def deliver_events_task(event_ids):  # pragma: no cover
+    """
+    Delivers a batch of events concurrently, skipping any which are already being delivered by another task
+    """
+    r = get_redis_connection()
+
+    locks = []
+    try:
+        for event_id in event_ids:
+            lock = r.lock('deliver_event_%d' % event_id, timeout=300)
+            if lock.acquire(blocking=False):
+                locks.append((event_id, lock))
+
+        events = WebHookEvent.objects.filter(id__in=[event_id for event_id, lock in locks])
+        events = events.exclude(status__in=(WebHookEvent.STATUS_COMPLETE, WebHookEvent.STATUS_FAILED))
+        events = events.select_related('org', 'channel').order_by('id')
+
+        WebHookEvent.deliver_batch(list(events))
+    finally:
+        for event_id, lock in locks:
+            lock.release()
+
+
 @task(track_started=True, name='retry_events_task')
 def retry_events_task():  # pragma: no cover
     print("** retrying errored webhook events")
 
     # get all events that have an error and need to be retried
     now = timezone.now()
-    for event in WebHookEvent.objects.filter(status=WebHookEvent.STATUS_ERRORED, next_attempt__lte=now).exclude(event=WebHookEvent.TYPE_FLOW):
-        deliver_event_task.delay(event.pk)
+    errored = WebHookEvent.objects.filter(status=WebHookEvent.STATUS_ERRORED, next_attempt__lte=now)
 
     # also get those over five minutes old that are still pending
     five_minutes_ago = now - timedelta(minutes=5)
-    for event in WebHookEvent.objects.filter(status=WebHookEvent.STATUS_PENDING, created_on__lte=five_minutes_ago).exclude(event=WebHookEvent.TYPE_FLOW):
-        deliver_event_task.delay(event.pk)
+    pending = WebHookEvent.objects.filter(status=WebHookEvent.STATUS_PENDING, created_on__lte=five_minutes_ago)
 
     # and any that were errored and haven't been retried for some reason
     fifteen_minutes_ago = now - timedelta(minutes=15)
-    for event in WebHookEvent.objects.filter(status=WebHookEvent.STATUS_ERRORED, modified_on__lte=fifteen_minutes_ago).exclude(event=WebHookEvent.TYPE_FLOW):
-        deliver_event_task.delay(event.pk)
+    stale = WebHookEvent.objects.filter(status=WebHookEvent.STATUS_ERRORED, modified_on__lte=fifteen_minutes_ago)
+
+    event_ids = set()
+    for events in (errored, pending, stale):
+        event_ids.update(events.exclude(event=WebHookEvent.TYPE_FLOW).values_list('id', flat=True))
+
+    # deliver in batches which each send their requests concurrently
+    for batch in chunk_list(sorted(event_ids), RETRY_BATCH_SIZE):
+        deliver_events_task.delay(batch)
 
 
 @nonoverlapping_task(track_started=True, name='trim_webhook_event_task')
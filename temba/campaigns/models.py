@@ -4,7 +4,7 @@ import json
 import six
 
 from datetime import timedelta
-from django.db import models
+from django.db import connection, models
 from django.db.models import Model
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
@@ -12,7 +12,7 @@ from temba.contacts.models import ContactGroup, ContactField, Contact
 from temba.flows.models import Flow, FlowStart
 from temba.msgs.models import Msg
 from temba.orgs.models import Org
-from temba.utils import on_transaction_commit
+from temba.utils import chunk_list, on_transaction_commit
 from temba.utils.models import TembaModel, TranslatableField
 from temba.values.models import Value
 
@@ -248,6 +248,8 @@ class CampaignEvent(TembaModel):
 
     UNIT_CHOICES = [(u[0], u[1]) for u in UNIT_CONFIG]
 
+    UNIT_MINUTES_MULTIPLIERS = {UNIT_MINUTES: 1, UNIT_HOURS: 60, UNIT_DAYS: 60 * 24, UNIT_WEEKS: 60 * 24 * 7}
+
     campaign = models.ForeignKey(Campaign, related_name='events',
                                  help_text="The campaign this event is part of")
     offset = models.IntegerField(default=0,
@@ -483,8 +485,13 @@ class EventFire(Model):
 
     @classmethod
     def do_update_campaign_events(cls, campaign):
-        for contact in campaign.group.contacts.exclude(is_test=True):
-            cls.update_campaign_events_for_contact(campaign, contact)
+        # unschedule any fires
+        EventFire.objects.filter(event__campaign=campaign, fired=None).delete()
+
+        # and reschedule each of our events across the whole group
+        if not campaign.is_archived:
+            for event in campaign.get_events():
+                cls.schedule_fires_for_event(event)
 
     @classmethod
     def update_eventfires_for_event(cls, event):
@@ -498,60 +505,119 @@ class EventFire(Model):
 
         # add new ones if this event exists and the campaign is active
         if event.is_active and not event.campaign.is_archived:
+            cls.schedule_fires_for_event(event)
 
-            contacts = event.campaign.group.contacts.filter(is_active=True, is_blocked=False).exclude(is_test=True)
-            values = Value.objects.filter(contact__in=contacts, contact_field__key__exact=event.relative_to.key)
-            values = values.select_related('contact').distinct('contact')
+    @classmethod
+    def update_field_events(cls, contact_field):
+        """
+        Cancel any events for the passed in contact field
+        """
+        # remove any scheduled fires for the passed in field
+        EventFire.objects.filter(event__relative_to=contact_field, fired=None).delete()
 
-            now = timezone.now()
-            events = []
+        # and recreate them all if it's still active
+        if contact_field.is_active:
+            for event in CampaignEvent.objects.filter(relative_to=contact_field,
+                                                      campaign__is_active=True, campaign__is_archived=False, is_active=True):
+                cls.schedule_fires_for_event(event)
 
-            org = event.campaign.org
-            for value in values:
-                formatted_date = org.format_date(value.datetime_value)
-                scheduled = event.calculate_scheduled_fire_for_value(formatted_date, now)
+    @classmethod
+    def schedule_fires_for_event(cls, event):
+        """
+        Schedules fires for every active contact in the event's campaign group with a date in the event's relative to
+        field. This is done in a single query if the database knows the org's timezone, otherwise values are streamed
+        through calculate_scheduled_fire_for_value.
+        """
+        if not event.relative_to.is_active:  # pragma: no cover
+            return
 
-                # and if we have a date, then schedule it
-                if scheduled:
-                    events.append(EventFire(event=event, contact=value.contact, scheduled=scheduled))
+        now = timezone.now()
+        tz_name = six.text_type(event.campaign.org.timezone)
 
-            # bulk create our event fires
-            EventFire.objects.bulk_create(events)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT EXISTS(SELECT 1 FROM pg_timezone_names WHERE name = %s)', [tz_name])
+            db_has_timezone = cursor.fetchone()[0]
+
+        if db_has_timezone:
+            cls._schedule_fires_in_db(event, now)
+        else:  # pragma: no cover
+            cls._schedule_fires_in_python(event, now)
 
     @classmethod
-    def update_field_events(cls, contact_field):
+    def _schedule_fires_in_db(cls, event, now):
         """
-        Cancel any events for the passed in contact field
+        Schedules fires for an event with SQL which follows calculate_scheduled_fire_for_value exactly, i.e. dates are
+        floored to the minute in the org's timezone, offset, then either moved to the delivery hour or shifted to keep
+        the same time of day if a DST change was crossed.
         """
-        if not contact_field.is_active:
-            # remove any scheduled fires for the passed in field
-            EventFire.objects.filter(event__relative_to=contact_field, fired=None).delete()
-        else:
-            # cancel existing events, we are going to recreate them all
-            EventFire.objects.filter(event__relative_to=contact_field, fired=None).delete()
-
-            now = timezone.now()
-            from temba.values.models import Value
+        sql = """
+        INSERT INTO campaigns_eventfire(event_id, contact_id, scheduled)
+        SELECT %(event_id)s, contact_id, scheduled FROM (
+          SELECT contact_id, CASE
+            WHEN %(delivery_hour)s = -1 THEN shifted + (date_offset - shifted_offset)
+            ELSE ((date_trunc('day', shifted AT TIME ZONE %(tz)s) + %(delivery_hour)s * INTERVAL '1 hour')
+                  AT TIME ZONE 'UTC') - shifted_offset
+          END AS scheduled
+          FROM (
+            SELECT contact_id, shifted,
+                   (date_value AT TIME ZONE %(tz)s) - (date_value AT TIME ZONE 'UTC') AS date_offset,
+                   (shifted AT TIME ZONE %(tz)s) - (shifted AT TIME ZONE 'UTC') AS shifted_offset
+            FROM (
+              SELECT contact_id, date_value, date_value + %(offset_minutes)s * INTERVAL '1 minute' AS shifted
+              FROM (
+                SELECT DISTINCT ON (v.contact_id) v.contact_id,
+                       date_trunc('minute', v.datetime_value AT TIME ZONE %(tz)s) AT TIME ZONE %(tz)s AS date_value
+                FROM values_value v
+                INNER JOIN contacts_contactfield f ON f.id = v.contact_field_id
+                INNER JOIN contacts_contactgroup_contacts gc ON gc.contact_id = v.contact_id
+                INNER JOIN contacts_contact c ON c.id = v.contact_id
+                WHERE f.key = %(key)s AND gc.contactgroup_id = %(group_id)s AND v.datetime_value IS NOT NULL
+                  AND c.is_active = TRUE AND c.is_blocked = FALSE AND c.is_test = FALSE
+                ORDER BY v.contact_id, v.id
+              ) dates
+            ) shifts
+          ) offsets
+        ) fires
+        WHERE scheduled > %(now)s
+        """
+        params = {
+            'event_id': event.id,
+            'delivery_hour': int(event.delivery_hour),
+            'offset_minutes': event.offset * CampaignEvent.UNIT_MINUTES_MULTIPLIERS[event.unit],
+            'tz': six.text_type(event.campaign.org.timezone),
+            'key': event.relative_to.key,
+            'group_id': event.campaign.group_id,
+            'now': now,
+        }
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
 
-            org = contact_field.org
-            for event in CampaignEvent.objects.filter(relative_to=contact_field,
-                                                      campaign__is_active=True, campaign__is_archived=False, is_active=True):
+    @classmethod
+    def _schedule_fires_in_python(cls, event, now):
+        """
+        Schedules fires for an event by streaming the relevant values through calculate_scheduled_fire_for_value
+        """
+        tz = event.campaign.org.timezone
 
-                contacts = event.campaign.group.contacts.filter(is_active=True, is_blocked=False).exclude(is_test=True)
-                values = Value.objects.filter(contact__in=contacts, contact_field__key__exact=contact_field.key)
-                values = values.select_related('contact').distinct('contact')
+        contacts = event.campaign.group.contacts.filter(is_active=True, is_blocked=False).exclude(is_test=True)
+        values = Value.objects.filter(contact__in=contacts, contact_field__key__exact=event.relative_to.key)
+        values = values.exclude(datetime_value=None).order_by('contact_id', 'id').distinct('contact_id')
+        values = values.values_list('contact_id', 'datetime_value')
 
-                events = []
-                for value in values:
-                    formatted_date = org.format_date(value.datetime_value)
-                    scheduled = event.calculate_scheduled_fire_for_value(formatted_date, now)
+        for batch in chunk_list(values.iterator(), 1000):
+            fires = []
+            for contact_id, datetime_value in batch:
+                # floor to the minute in the org timezone, same as formatting and then re-parsing the date would
+                date_value = tz.localize(datetime_value.astimezone(tz).replace(second=0, microsecond=0, tzinfo=None))
+                scheduled = event.calculate_scheduled_fire_for_value(date_value, now)
 
-                    # and if we have a date, then schedule it
-                    if scheduled:
-                        events.append(EventFire(event=event, contact=value.contact, scheduled=scheduled))
+                # and if we have a date, then schedule it
+                if scheduled:
+                    fires.append(EventFire(event=event, contact_id=contact_id, scheduled=scheduled))
 
-                # bulk create our event fires
-                EventFire.objects.bulk_create(events)
+            # bulk create our event fires
+            EventFire.objects.bulk_create(fires)
 
     @classmethod
     def update_events_for_contact(cls, contact):
@@ -9,7 +9,7 @@ from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.utils import timezone
 from temba.campaigns.tasks import check_campaigns_task
-from temba.contacts.models import ContactField
+from temba.contacts.models import Contact, ContactField
 from temba.flows.models import FlowRun, Flow, RuleSet, ActionSet, FlowRevision, FlowStart
 from temba.msgs.models import Msg
 from temba.orgs.models import Language, get_current_export_version
@@ -632,6 +632,50 @@ class CampaignTest(TembaTest):
         self.assertEqual(delta.days, 1)
         self.assertEqual(delta.seconds, 82800)
 
+    def test_schedule_fires_for_event(self):
+        eastern = pytz.timezone('US/Eastern')
+        self.org.timezone = eastern
+        self.org.save()
+
+        campaign = Campaign.create(self.org, self.admin, "Planting Reminders", self.farmers)
+
+        # dates either side of DST changes, and one which is ambiguous in local time
+        farmer3 = self.create_contact("Page McConnell", "+250788444444")
+        farmer4 = self.create_contact("Jon Fishman", "+250788555555")
+        self.farmers.update_contacts(self.admin, [farmer3, farmer4], add=True)
+
+        self.farmer1.set_field(self.user, 'planting_date', "03-11-2029 12:30:45")
+        self.farmer2.set_field(self.user, 'planting_date', "10-03-2029 02:30:00")
+        farmer3.set_field(self.user, 'planting_date', "04-11-2029 01:30:00")
+        farmer4.set_field(self.user, 'planting_date', "not a date")
+        self.nonfarmer.set_field(self.user, 'planting_date', "03-11-2029 12:30:00")
+
+        for unit in ('M', 'H', 'D', 'W'):
+            for offset in (-3, 1, 25):
+                for delivery_hour in (-1, 0, 2, 13):
+                    event = CampaignEvent.create_flow_event(self.org, self.admin, campaign, self.planting_date,
+                                                            offset=offset, unit=unit, flow=self.reminder_flow,
+                                                            delivery_hour=delivery_hour)
+                    event.refresh_from_db()
+
+                    # per-contact calculation is our reference
+                    expected = set()
+                    for contact in (self.farmer1, self.farmer2, farmer3, farmer4):
+                        scheduled = event.calculate_scheduled_fire(Contact.objects.get(pk=contact.pk))
+                        if scheduled:
+                            expected.add((contact.id, scheduled))
+
+                    EventFire.objects.filter(event=event).delete()
+                    EventFire._schedule_fires_in_db(event, timezone.now())
+                    in_db = set(EventFire.objects.filter(event=event).values_list('contact_id', 'scheduled'))
+
+                    EventFire.objects.filter(event=event).delete()
+                    EventFire._schedule_fires_in_python(event, timezone.now())
+                    in_python = set(EventFire.objects.filter(event=event).values_list('contact_id', 'scheduled'))
+
+                    self.assertEqual(in_db, expected, "mismatch for offset=%d unit=%s hour=%d" % (offset, unit, delivery_hour))
+                    self.assertEqual(in_python, expected)
+
     def test_scheduling(self):
         campaign = Campaign.create(self.org, self.admin, "Planting Reminders", self.farmers)
         self.assertEqual("Planting Reminders", six.text_type(campaign))
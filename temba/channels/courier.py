@@ -2,6 +2,7 @@
 import time
 import json
 from django_redis import get_redis_connection
+from temba.utils import chunk_list
 from temba.utils.dates import datetime_to_str
 
 
@@ -9,17 +10,37 @@ def push_courier_msgs(channel, msgs, high_priority=False):
     """
     Adds the passed in msgs to our courier queue for channel
     """
+    push_courier_batches([dict(channel=channel, msgs=msgs, high_priority=high_priority)])
+
+
+def push_courier_batches(batches):
+    """
+    Adds the passed in batches of msgs to the courier queues of their channels. Each batch is a dict of channel, msgs
+    and high_priority. Batches are pushed in pipelines of COURIER_PIPELINE_SIZE script calls.
+    """
     r = get_redis_connection('default')
-    priority = COURIER_HIGH_PRIORITY if high_priority else COURIER_LOW_PRIORITY
-    tps = channel.tps if channel.tps else COURIER_DEFAULT_TPS
+    script = get_script(r)
+    last_epoch = 0
+
+    for batch_chunk in chunk_list(batches, COURIER_PIPELINE_SIZE):
+        pipe = r.pipeline(transaction=False)
+
+        for batch in batch_chunk:
+            channel = batch['channel']
+            priority = COURIER_HIGH_PRIORITY if batch['high_priority'] else COURIER_LOW_PRIORITY
+            tps = channel.tps if channel.tps else COURIER_DEFAULT_TPS
+
+            # create our payload
+            payload = json.dumps([msg_as_task(msg) for msg in batch['msgs']], separators=(',', ':'))
+
+            # batches are ordered in their queue by score, so make sure no two batches get the same score
+            epoch = max(time.time(), last_epoch + 0.000001)
+            last_epoch = epoch
 
-    # create our payload
-    payload = []
-    for msg in msgs:
-        payload.append(msg_as_task(msg))
+            # queue a call of our lua script
+            script(keys=(epoch, 'msgs', channel.uuid, tps, priority, payload), client=pipe)
 
-    # call our lua script
-    get_script(r)(keys=(time.time(), 'msgs', channel.uuid, tps, priority, json.dumps(payload)), client=r)
+        pipe.execute()
 
 
 _script = None
@@ -74,6 +95,7 @@ def msg_as_task(msg):
 COURIER_HIGH_PRIORITY = 1
 COURIER_LOW_PRIORITY = 0
 COURIER_DEFAULT_TPS = 10
+COURIER_PIPELINE_SIZE = 1000
 
 
 # Our lua script for properly inserting items to a courier queue
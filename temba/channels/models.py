@@ -3,6 +3,7 @@ from __future__ import absolute_import, print_function, unicode_literals
 import json
 import logging
 import phonenumbers
+import random
 import requests
 import six
 import time
@@ -1142,7 +1143,11 @@ class Channel(TembaModel):
         return pending.order_by('created_on')
 
     @classmethod
-    def send_message(cls, msg):  # pragma: no cover
+    def send_message(cls, msg, requeue_throttled=False):  # pragma: no cover
+        """
+        Sends the given message. If the channel is over its TPS limit and requeue_throttled is set, then nothing is sent
+        and the number of seconds after which to retry is returned instead.
+        """
         from temba.msgs.models import Msg, Attachment, QUEUED, WIRED, MSG_SENT_KEY
         r = get_redis_connection()
 
@@ -1171,33 +1176,24 @@ class Channel(TembaModel):
 
         channel_type = Channel.get_type_from_code(channel.channel_type)
 
-        # Check whether we need to throttle ourselves
-        # This isn't an ideal implementation, in that if there is only one Channel with tons of messages
-        # and a low throttle rate, we will have lots of threads waiting, but since throttling is currently
-        # a rare event, this is an ok stopgap.
+        # check whether we need to throttle ourselves, either handing back how long until we can send so that this
+        # message can be requeued, or waiting until our channel has capacity again
         if channel_type.max_tps:
-            tps_set_name = 'channel_tps_%d' % channel.id
-            lock_name = '%s_lock' % tps_set_name
+            delay = Channel.take_send_token(r, channel.id, channel_type.max_tps)
+            if delay:
+                analytics.gauge('temba.channel_throttled.%d' % channel.id, delay)
 
-            while True:
-                # only one thread should be messing with the map at once
-                with r.lock(lock_name, timeout=5):
-                    # check how many were sent in the last second
-                    now = time.time()
-                    last_second = time.time() - 1
+            while delay:
+                # everything throttled at the same moment is handed the same delay, so spread out the retries over the
+                # following second, during which the bucket refills with max_tps tokens, rather than have them all
+                # come back together and only max_tps of them get through
+                delay += random.random()
 
-                    # how many have been sent in the past second?
-                    count = r.zcount(tps_set_name, last_second, now)
+                if requeue_throttled:
+                    return delay
 
-                    # we're within our tps, add ourselves to the list and go on our way
-                    if count < channel_type.max_tps:
-                        r.zadd(tps_set_name, now, now)
-                        r.zremrangebyscore(tps_set_name, "-inf", last_second)
-                        r.expire(tps_set_name, 5)
-                        break
-
-                # too many sent in the last second, sleep a bit and try again
-                time.sleep(1 / float(channel_type.max_tps))
+                time.sleep(delay)
+                delay = Channel.take_send_token(r, channel.id, channel_type.max_tps)
 
         sent_count = 0
 
@@ -1256,6 +1252,28 @@ class Channel(TembaModel):
         if len(parts) > 1:
             Msg.objects.filter(id=msg.id).update(msg_count=len(parts))
 
+    @classmethod
+    def take_send_token(cls, r, channel_id, max_tps):
+        """
+        Takes a token from the given channel's send bucket, which refills at max_tps tokens per second and can hold at
+        most max_tps tokens. Returns zero if the token was taken, otherwise the number of seconds until one is available.
+        """
+        # this lua script refills the bucket according to the time elapsed since it was last touched, and then either
+        # takes a token or calculates how long until one is available, all as an atomic action
+        lua = "local bucket = redis.call('hmget', ARGV[1], 'tokens', 'ts') \n" \
+              "local rate, now = tonumber(ARGV[2]), tonumber(ARGV[3]) \n" \
+              "local tokens = tonumber(bucket[1]) or rate \n" \
+              "local elapsed = math.max(0, now - (tonumber(bucket[2]) or now)) \n" \
+              "tokens = math.min(rate, tokens + elapsed * rate) \n" \
+              "local delay = 0 \n" \
+              "if tokens >= 1 then tokens = tokens - 1 else delay = (1 - tokens) / rate end \n" \
+              "redis.call('hmset', ARGV[1], 'tokens', tostring(tokens), 'ts', ARGV[3]) \n" \
+              "redis.call('expire', ARGV[1], 5) \n" \
+              "return tostring(delay) \n"
+
+        delay = r.eval(lua, 3, 'key', 'rate', 'now', 'channel_tps_bucket_%d' % channel_id, max_tps, repr(time.time()))
+        return float(delay)
+
     @classmethod
     def track_status(cls, channel, status):
         if channel:
@@ -7,12 +7,15 @@ import time
 from celery.task import task
 from datetime import timedelta
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 from django_redis import get_redis_connection
 from enum import Enum
+from multiprocessing.pool import ThreadPool
+from six.moves.queue import Queue, Empty
 from temba.msgs.models import SEND_MSG_TASK, MSG_QUEUE
 from temba.utils import dict_to_struct
-from temba.utils.queues import start_task, push_task, nonoverlapping_task, complete_task
+from temba.utils.queues import start_tasks, push_task, nonoverlapping_task, complete_task
 from temba.utils.mage import MageClient
 from temba.temba_celery import app as celery_app
 from .models import Channel, Alert, ChannelLog, ChannelCount
@@ -20,6 +23,12 @@ from .models import Channel, Alert, ChannelLog, ChannelCount
 
 logger = logging.getLogger(__name__)
 
+# the maximum number of contact msg batches a single send task will pop off our queue at once
+SEND_MSG_TASK_BATCH_SIZE = 10
+
+# the maximum number of contacts a single send task will send msgs to at the same time
+SEND_MSG_CONCURRENCY = 5
+
 
 class MageStreamAction(Enum):
     activate = 1
@@ -54,43 +63,101 @@ def sync_channel_fcm_task(cloud_registration_id, channel_id=None):  # pragma: no
 @task(track_started=True, name='send_msg_task')
 def send_msg_task():
     """
-    Pops the next message off of our msg queue to send.
+    Pops the next batches of messages off of our msg queue to send.
     """
-    # pop off the next task
-    org_id, msg_tasks = start_task(SEND_MSG_TASK)
+    # pop off the next tasks, each of which is a list of msgs for a single contact
+    org_id, msg_tasks = start_tasks(SEND_MSG_TASK, SEND_MSG_TASK_BATCH_SIZE)
 
     # it is possible we have no message to send, if so, just return
     if not msg_tasks:  # pragma: needs cover
         return
 
-    if not isinstance(msg_tasks, list):  # pragma: needs cover
-        msg_tasks = [msg_tasks]
+    msg_tasks = [t if isinstance(t, list) else [t] for t in msg_tasks]
 
-    r = get_redis_connection()
+    # throttled msgs can only be requeued for later if celery is actually going to delay them, and sending has to
+    # happen on this thread if celery is running tasks eagerly, e.g. in tests
+    eager = getattr(settings, 'CELERY_ALWAYS_EAGER', False)
+    requeue_throttled = not eager
+    concurrency = 1 if eager else min(SEND_MSG_CONCURRENCY, len(msg_tasks))
 
-    # acquire a lock on our contact to make sure two sets of msgs aren't being sent at the same time
     try:
-        with r.lock('send_contact_%d' % msg_tasks[0]['contact'], timeout=300):
-            # send each of our msgs
-            while msg_tasks:
-                msg_task = msg_tasks.pop(0)
-                msg = dict_to_struct('MockMsg', msg_task,
-                                     datetime_fields=['modified_on', 'sent_on', 'created_on', 'queued_on',
-                                                      'next_attempt'])
-                Channel.send_message(msg)
-
-                # if there are more messages to send for this contact, sleep a second before moving on
-                if msg_tasks:
-                    time.sleep(1)
+        send_contact_msg_batches(org_id, msg_tasks, concurrency, requeue_throttled)
 
     finally:  # pragma: no cover
         # mark this worker as done
         complete_task(SEND_MSG_TASK, org_id)
 
         # if some msgs weren't sent for some reason, then requeue them for later sending
-        if msg_tasks:
-            # requeue any unsent msgs
-            push_task(org_id, MSG_QUEUE, SEND_MSG_TASK, msg_tasks)
+        for contact_msgs in msg_tasks:
+            if contact_msgs:
+                push_task(org_id, MSG_QUEUE, SEND_MSG_TASK, contact_msgs)
+
+
+def send_contact_msg_batches(org_id, msg_tasks, concurrency, requeue_throttled):
+    """
+    Sends the given batches of msgs, each of which is for a single contact, using up to concurrency threads
+    """
+    if concurrency <= 1:
+        for contact_msgs in msg_tasks:
+            send_contact_msgs(org_id, contact_msgs, requeue_throttled)
+        return
+
+    pending = Queue()
+    for contact_msgs in msg_tasks:
+        pending.put(contact_msgs)
+
+    # each thread sends the msgs of one contact at a time, so msgs for the same contact are still sent in order
+    def send_pending(thread_num):
+        try:
+            while True:
+                try:
+                    contact_msgs = pending.get_nowait()
+                except Empty:
+                    return
+
+                send_contact_msgs(org_id, contact_msgs, requeue_throttled)
+        finally:
+            connection.close()
+
+    pool = ThreadPool(concurrency)
+    try:
+        pool.map(send_pending, range(concurrency))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def send_contact_msgs(org_id, contact_msgs, requeue_throttled):
+    """
+    Sends the given msgs for a single contact in order, removing them from the list as they are sent or requeued
+    """
+    r = get_redis_connection()
+
+    # acquire a lock on our contact to make sure two sets of msgs aren't being sent at the same time
+    with r.lock('send_contact_%d' % contact_msgs[0]['contact'], timeout=300):
+        # send each of our msgs
+        while contact_msgs:
+            msg_task = contact_msgs.pop(0)
+            msg = dict_to_struct('MockMsg', msg_task,
+                                 datetime_fields=['modified_on', 'sent_on', 'created_on', 'queued_on', 'next_attempt'])
+            delay = Channel.send_message(msg, requeue_throttled=requeue_throttled)
+
+            # our channel is over its TPS limit so requeue this contact's msgs for when it has capacity again
+            if delay:
+                requeue_msgs_task.apply_async(args=[org_id, [msg_task] + contact_msgs], countdown=delay)
+                del contact_msgs[:]
+
+            # if there are more messages to send for this contact, sleep a second before moving on
+            elif contact_msgs:
+                time.sleep(1)
+
+
+@task(track_started=True, name='requeue_msgs_task')
+def requeue_msgs_task(org_id, msg_tasks):  # pragma: no cover
+    """
+    Puts a batch of throttled msgs for a contact back on our msg queue
+    """
+    push_task(org_id, MSG_QUEUE, SEND_MSG_TASK, msg_tasks)
 
 
 @nonoverlapping_task(track_started=True, name='check_channels_task', lock_key='check_channels')
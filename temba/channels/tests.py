@@ -11,6 +11,7 @@ import json
 import iso8601
 import pytz
 import six
+import threading
 import time
 import urllib2
 import uuid
@@ -57,7 +58,7 @@ from xml.etree import ElementTree as ET
 
 from .models import Channel, ChannelCount, ChannelEvent, SyncEvent, Alert, ChannelLog, ChannelSession, CHANNEL_EVENT
 from .models import DART_MEDIA_ENDPOINT, HUB9_ENDPOINT
-from .tasks import check_channels_task, squash_channelcounts, refresh_jiochat_access_tokens
+from .tasks import check_channels_task, squash_channelcounts, refresh_jiochat_access_tokens, send_contact_msg_batches
 
 
 class ChannelTest(TembaTest):
@@ -295,6 +296,86 @@ class ChannelTest(TembaTest):
         self.assertEqual(self.tel_channel, Msg.objects.get(pk=msg.id).channel)
         self.assertEqual(1, Msg.objects.get(pk=msg.id).msg_count)
 
+    def test_take_send_token(self):
+        r = get_redis_connection()
+
+        with patch('time.time', return_value=1000.0):
+            # bucket starts full, so we can send up to our max TPS straight away
+            self.assertEqual(Channel.take_send_token(r, self.tel_channel.id, 2), 0)
+            self.assertEqual(Channel.take_send_token(r, self.tel_channel.id, 2), 0)
+
+            # but then have to wait for the next token
+            self.assertAlmostEqual(Channel.take_send_token(r, self.tel_channel.id, 2), 0.5)
+
+        with patch('time.time', return_value=1000.25):
+            self.assertAlmostEqual(Channel.take_send_token(r, self.tel_channel.id, 2), 0.25)
+
+        with patch('time.time', return_value=1000.5):
+            self.assertEqual(Channel.take_send_token(r, self.tel_channel.id, 2), 0)
+            self.assertAlmostEqual(Channel.take_send_token(r, self.tel_channel.id, 2), 0.5)
+
+        # other channels have their own buckets
+        self.assertEqual(Channel.take_send_token(r, self.twitter_channel.id, 2), 0)
+
+    def test_send_contact_msg_batches(self):
+        r = get_redis_connection()
+        joe = self.create_contact("Joe", "+250788111111")
+        frank = self.create_contact("Frank", "+250788222222")
+
+        msg_tasks = [
+            [dict(id=i, contact=joe.id, channel=self.tel_channel.id) for i in (1, 2, 3)],
+            [dict(id=i, contact=frank.id, channel=self.tel_channel.id) for i in (4, 5, 6)],
+        ]
+        contact_msg_ids = {joe.id: [1, 2, 3], frank.id: [4, 5, 6]}
+
+        sent = []
+        started_contacts = set()
+        all_started = threading.Event()
+        lock = threading.Lock()
+
+        def send_message(msg, requeue_throttled=False):
+            # don't let either contact's msgs be sent until both have been picked up by a thread
+            with lock:
+                started_contacts.add(msg.contact)
+                if len(started_contacts) == 2:
+                    all_started.set()
+            all_started.wait(5)
+
+            # our channel can only send 4 msgs before it's throttled
+            delay = Channel.take_send_token(r, msg.channel, 4)
+            if not delay:
+                with lock:
+                    sent.append((threading.current_thread().ident, msg.contact, msg.id))
+            return delay
+
+        with patch('time.time', return_value=1000.0), patch('time.sleep'):
+            with patch('temba.channels.models.Channel.send_message', side_effect=send_message):
+                with patch('temba.channels.tasks.requeue_msgs_task.apply_async') as mock_requeue:
+                    send_contact_msg_batches(self.org.id, msg_tasks, 2, True)
+
+        # each contact was sent to by a single thread, but not the same one
+        joe_threads = {s[0] for s in sent if s[1] == joe.id}
+        frank_threads = {s[0] for s in sent if s[1] == frank.id}
+        self.assertEqual(len(joe_threads), 1)
+        self.assertEqual(len(frank_threads), 1)
+        self.assertNotEqual(joe_threads, frank_threads)
+
+        # only 4 msgs made it through our channel, the rest were requeued
+        self.assertEqual(len(sent), 4)
+        self.assertEqual(msg_tasks, [[], []])
+
+        requeued = {}
+        for call in mock_requeue.call_args_list:
+            org_id, contact_msgs = call[1]['args']
+            self.assertEqual(org_id, self.org.id)
+            self.assertGreater(call[1]['countdown'], 0)
+            requeued[contact_msgs[0]['contact']] = [m['id'] for m in contact_msgs]
+
+        # and each contact's msgs were sent and requeued in order
+        for contact_id, msg_ids in six.iteritems(contact_msg_ids):
+            sent_ids = [s[2] for s in sent if s[1] == contact_id]
+            self.assertEqual(sent_ids + requeued.get(contact_id, []), msg_ids)
+
     def test_ensure_normalization(self):
         self.tel_channel.country = 'RW'
         self.tel_channel.save()
@@ -3281,7 +3362,7 @@ class KannelTest(TembaTest):
         joe = self.create_contact("Joe", "+250788383383")
         msg = joe.send("Test message", self.admin, trigger_send=False, attachments=['image/jpeg:https://example.com/attachments/pic.jpg'])[0]
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value = MockResponse(200, 'Accepted 201')
 
             # manually send it off
@@ -3305,7 +3386,7 @@ class KannelTest(TembaTest):
         joe = self.create_contact("Joe", "+250788383383")
         msg = joe.send("Test message", self.admin, trigger_send=False)[0]
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value = MockResponse(200, 'Accepted 201')
 
             # manually send it off
@@ -3330,7 +3411,7 @@ class KannelTest(TembaTest):
         msg.text = "No capital accented È!"
         msg.save()
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value = MockResponse(200, 'Accepted 201')
 
             # manually send it off
@@ -3353,7 +3434,7 @@ class KannelTest(TembaTest):
         msg.response_to = incoming
         msg.save()
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value = MockResponse(200, 'Accepted 201')
 
             # manually send it off
@@ -3375,7 +3456,7 @@ class KannelTest(TembaTest):
         msg.text = "Normal"
         msg.save()
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value = MockResponse(200, 'Accepted 201')
 
             # manually send it off
@@ -3400,7 +3481,7 @@ class KannelTest(TembaTest):
                                               send_url='http://foo/', verify_ssl=False))
         self.channel.save()
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value = MockResponse(200, 'Accepted 201')
 
             # manually send it off
@@ -3423,7 +3504,7 @@ class KannelTest(TembaTest):
                                               send_url='http://foo/', verify_ssl=False))
         self.channel.save()
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value = MockResponse(400, "Error")
 
             # manually send it off
@@ -3438,7 +3519,7 @@ class KannelTest(TembaTest):
             self.assertEqual(1, msg.error_count)
             self.assertTrue(msg.next_attempt)
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.side_effect = Exception('Kaboom')
 
             # manually send it off
@@ -4294,7 +4375,7 @@ class InfobipTest(TembaTest):
         joe = self.create_contact("Joe", "+250788383383")
         msg = joe.send("Test message", self.admin, trigger_send=False)[0]
 
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.return_value = MockResponse(200, json.dumps(dict(messages=[{'status': {'groupId': 1}}])))
 
             # manually send it off
@@ -4321,7 +4402,7 @@ class InfobipTest(TembaTest):
 
             self.clear_cache()
 
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.return_value = MockResponse(400, "Error", method='POST')
 
             # manually send it off
@@ -4333,7 +4414,7 @@ class InfobipTest(TembaTest):
             self.assertEqual(1, msg.error_count)
             self.assertTrue(msg.next_attempt)
 
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.side_effect = Exception('Kaboom!')
 
             # manually send it off
@@ -4348,7 +4429,7 @@ class InfobipTest(TembaTest):
         Msg.objects.all().delete()
         msg = joe.send("Test message", self.admin, trigger_send=False)[0]
 
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.return_value = MockResponse(200, json.dumps(dict(messages=[
                 {'status': {'groupId': 2, 'description': "Request was rejected"}, 'messageid': 12}])))
 
@@ -4369,7 +4450,7 @@ class InfobipTest(TembaTest):
         joe = self.create_contact("Joe", "+250788383383")
         msg = joe.send("Test message", self.admin, trigger_send=False, attachments=['image/jpeg:https://example.com/attachments/pic.jpg'])[0]
 
-        with patch('requests.post') as mock:
+        with patch('requests.Session.post') as mock:
             mock.return_value = MockResponse(200, json.dumps(dict(messages=[{'status': {'groupId': 1}}])))
 
             # manually send it off
@@ -6062,7 +6143,7 @@ class ClickatellTest(TembaTest):
         joe = self.create_contact("Joe", "+250788383383")
         msg = joe.send("Test message", self.admin, trigger_send=False)[0]
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             msg.text = "Test message"
             mock.return_value = MockResponse(200, "000")
 
@@ -6088,7 +6169,7 @@ class ClickatellTest(TembaTest):
 
             self.clear_cache()
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             msg.text = "Test message ☺"
             mock.return_value = MockResponse(200, "ID: 15")
 
@@ -6115,7 +6196,7 @@ class ClickatellTest(TembaTest):
 
             self.clear_cache()
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.return_value = MockResponse(400, "Error", method='POST')
 
             # manually send it off
@@ -6127,7 +6208,7 @@ class ClickatellTest(TembaTest):
             self.assertEqual(1, msg.error_count)
             self.assertTrue(msg.next_attempt)
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             mock.side_effect = Exception('Kaboom!')
 
             # manually send it off
@@ -6147,7 +6228,7 @@ class ClickatellTest(TembaTest):
         joe = self.create_contact("Joe", "+250788383383")
         msg = joe.send("Test message", self.admin, trigger_send=False, attachments=['image/jpeg:https://example.com/attachments/pic.jpg'])[0]
 
-        with patch('requests.get') as mock:
+        with patch('requests.Session.get') as mock:
             msg.text = "Test message"
             mock.return_value = MockResponse(200, "000")
 
@@ -10709,6 +10790,37 @@ class CourierTest(TembaTest):
             self.assertEqual(low_priority_msgs[1][0]['tps_cost'], 1)
             self.assertIsNone(low_priority_msgs[2][0]['attachments'])
 
+    @patch('temba.channels.courier.COURIER_PIPELINE_SIZE', 2)
+    def test_queue_to_courier_in_batches(self):
+        with self.settings(COURIER_CHANNELS=['T']):
+            self.channel.channel_type = 'T'
+            self.channel.save()
+
+            for c in range(5):
+                Msg.create_outgoing(self.org, self.admin, 'tel:+1206555000%d' % c, "Outgoing %d" % c)
+
+            # load our messages without their channels, contacts or URNs
+            msgs = list(Msg.objects.filter(direction='O').order_by('id'))
+
+            # which are loaded in bulk rather than once per message
+            with self.assertNumQueries(4):
+                Msg._prefetch_send_relations(msgs)
+
+            with self.assertNumQueries(0):
+                for msg in msgs:
+                    self.assertEqual((msg.channel, msg.contact_urn.id, msg.contact.is_test), (self.channel, msg.contact_urn_id, False))
+
+            Msg.send_messages(msgs)
+
+            # batches are pushed across several pipelines but keep their order in the queue
+            r = get_redis_connection()
+            queue_name = "msgs:" + self.channel.uuid + "|10"
+            low_priority_msgs = [json.loads(t) for t in r.zrange(queue_name + "/0", 0, -1)]
+
+            self.assertEqual([[m['text'] for m in b] for b in low_priority_msgs],
+                             [["Outgoing 0"], ["Outgoing 1"], ["Outgoing 2"], ["Outgoing 3"], ["Outgoing 4"]])
+            self.assertEqual(low_priority_msgs[0][0]['urn'], 'tel:+12065550000')
+
 
 class HandleEventTest(TembaTest):
     def test_stop_contact_task(self):
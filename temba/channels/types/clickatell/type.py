@@ -1,7 +1,6 @@
 from __future__ import unicode_literals, absolute_import
 
 import time
-import requests
 import six
 
 from django.utils.http import urlencode
@@ -10,7 +9,7 @@ from django.utils.translation import ugettext_lazy as _
 from temba.channels.types.clickatell.views import ClaimView
 from temba.contacts.models import TEL_SCHEME
 from temba.msgs.models import WIRED
-from temba.utils.http import HttpEvent, http_headers
+from temba.utils.http import HttpEvent, get_session, http_headers
 from ...models import Channel, ChannelType, SendException, Encoding
 
 
@@ -60,7 +59,7 @@ class ClickatellType(ChannelType):
         start = time.time()
 
         try:
-            response = requests.get(url, params=payload, headers=http_headers(), timeout=5)
+            response = get_session(url).get(url, params=payload, headers=http_headers(), timeout=5)
             event.status_code = response.status_code
             event.response_body = response.text
 
@@ -2,7 +2,6 @@ from __future__ import unicode_literals, absolute_import
 
 import base64
 import json
-import requests
 import six
 import time
 
@@ -11,7 +10,7 @@ from django.utils.translation import ugettext_lazy as _
 from temba.channels.views import AuthenticatedExternalCallbackClaimView
 from temba.contacts.models import TEL_SCHEME
 from temba.msgs.models import SENT
-from temba.utils.http import HttpEvent, http_headers
+from temba.utils.http import HttpEvent, get_session, http_headers
 from ...models import Channel, ChannelType, SendException
 
 
@@ -66,7 +65,7 @@ class InfobipType(ChannelType):
         start = time.time()
 
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=5)
+            response = get_session(url).post(url, json=payload, headers=headers, timeout=5)
             event.status_code = response.status_code
             event.response_body = response.text
         except Exception as e:
@@ -3,7 +3,6 @@ from __future__ import unicode_literals, absolute_import
 import time
 
 import phonenumbers
-import requests
 import six
 from django.urls import reverse
 from django.utils.http import urlencode
@@ -13,7 +12,7 @@ from django.utils.translation import ugettext_lazy as _
 from temba.channels.types.kannel.views import ClaimView
 from temba.contacts.models import TEL_SCHEME
 from temba.msgs.models import WIRED
-from temba.utils.http import HttpEvent
+from temba.utils.http import HttpEvent, get_session
 from ...models import Channel, ChannelType, SendException, Encoding
 
 
@@ -96,9 +95,9 @@ class KannelType(ChannelType):
 
         try:
             if channel.config.get(Channel.CONFIG_VERIFY_SSL, True):
-                response = requests.get(url, verify=True, params=payload, timeout=15)
+                response = get_session(url).get(url, verify=True, params=payload, timeout=15)
             else:
-                response = requests.get(url, verify=False, params=payload, timeout=15)
+                response = get_session(url).get(url, verify=False, params=payload, timeout=15)
 
             event.status_code = response.status_code
             event.response_body = response.text
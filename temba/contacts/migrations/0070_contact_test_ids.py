@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+SQL = """
+----------------------------------------------------------------------
+-- Utility function to lookup whether a contact is a simulator contact
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION temba_contact_is_test(_contact_id INT) RETURNS BOOLEAN AS $$
+BEGIN
+  -- simulator contacts are few, so probe the small partial index of them rather than the contact primary key
+  RETURN EXISTS(SELECT 1 FROM contacts_contact WHERE id = _contact_id AND is_test = TRUE);
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+----------------------------------------------------------------------
+-- Utility function to lookup whether a contact is a simulator contact
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION temba_flows_contact_is_test(_contact_id INT) RETURNS BOOLEAN AS $$
+BEGIN
+  -- simulator contacts are few, so probe the small partial index of them rather than the contact primary key
+  RETURN EXISTS(SELECT 1 FROM contacts_contact WHERE id = _contact_id AND is_test = TRUE);
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+----------------------------------------------------------------------
+-- Manages keeping track of the # of messages sent and received by a channel
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION temba_update_channelcount() RETURNS TRIGGER AS $$
+BEGIN
+  -- Message being updated
+  IF TG_OP = 'INSERT' THEN
+    -- Return if there is no channel on this message
+    IF NEW.channel_id IS NULL THEN
+      RETURN NULL;
+    END IF;
+
+    -- Return if this is a test contact
+    IF temba_contact_is_test(NEW.contact_id) THEN
+      RETURN NULL;
+    END IF;
+
+    -- If this is an incoming message, without message type, then increment that count
+    IF NEW.direction = 'I' THEN
+      -- This is a voice message, increment that count
+      IF NEW.msg_type = 'V' THEN
+        PERFORM temba_insert_channelcount(NEW.channel_id, 'IV', NEW.created_on::date, 1);
+      -- Otherwise, this is a normal message
+      ELSE
+        PERFORM temba_insert_channelcount(NEW.channel_id, 'IM', NEW.created_on::date, 1);
+      END IF;
+
+    -- This is an outgoing message
+    ELSIF NEW.direction = 'O' THEN
+      -- This is a voice message, increment that count
+      IF NEW.msg_type = 'V' THEN
+        PERFORM temba_insert_channelcount(NEW.channel_id, 'OV', NEW.created_on::date, 1);
+      -- Otherwise, this is a normal message
+      ELSE
+        PERFORM temba_insert_channelcount(NEW.channel_id, 'OM', NEW.created_on::date, 1);
+      END IF;
+
+    END IF;
+
+  -- Assert that updates aren't happening that we don't approve of
+  ELSIF TG_OP = 'UPDATE' THEN
+    -- If the direction is changing, blow up
+    IF NEW.direction <> OLD.direction THEN
+      RAISE EXCEPTION 'Cannot change direction on messages';
+    END IF;
+
+    -- Cannot move from IVR to Text, or IVR to Text
+    IF (OLD.msg_type <> 'V' AND NEW.msg_type = 'V') OR (OLD.msg_type = 'V' AND NEW.msg_type <> 'V') THEN
+      RAISE EXCEPTION 'Cannot change a message from voice to something else or vice versa';
+    END IF;
+
+    -- Cannot change created_on
+    IF NEW.created_on <> OLD.created_on THEN
+      RAISE EXCEPTION 'Cannot change created_on on messages';
+    END IF;
+
+  -- Table being cleared, reset all counts
+  ELSIF TG_OP = 'TRUNCATE' THEN
+    DELETE FROM channels_channelcount WHERE count_type IN ('IV', 'IM', 'OV', 'OM');
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+----------------------------------------------------------------------
+-- Trigger procedure to update group count
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION update_group_count() RETURNS TRIGGER AS $$
+BEGIN
+  -- contact being added to group
+  IF TG_OP = 'INSERT' THEN
+    -- ignore test contacts
+    IF NOT temba_contact_is_test(NEW.contact_id) THEN
+      INSERT INTO contacts_contactgroupcount("group_id", "count", "is_squashed")
+      VALUES(NEW.contactgroup_id, 1, FALSE);
+    END IF;
+
+  -- contact being removed from a group
+  ELSIF TG_OP = 'DELETE' THEN
+    -- ignore test contacts
+    IF NOT temba_contact_is_test(OLD.contact_id) THEN
+      INSERT INTO contacts_contactgroupcount("group_id", "count", "is_squashed")
+      VALUES(OLD.contactgroup_id, -1, FALSE);
+    END IF;
+
+  -- table being cleared, clear our counts
+  ELSIF TG_OP = 'TRUNCATE' THEN
+    TRUNCATE contacts_contactgroupcount;
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('contacts', '0069_iso639-3'),
+    ]
+
+    operations = [
+        migrations.RunSQL("CREATE INDEX CONCURRENTLY contacts_contact_test_ids "
+                          "ON contacts_contact (id) WHERE is_test = TRUE;",
+                          "DROP INDEX IF EXISTS contacts_contact_test_ids;"),
+        migrations.RunSQL(SQL)
+    ]
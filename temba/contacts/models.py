@@ -1,5 +1,6 @@
 from __future__ import print_function, unicode_literals
 
+import copy
 import datetime
 import json
 import logging
@@ -11,13 +12,14 @@ import six
 import time
 import uuid
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
 from django.db import models, transaction, IntegrityError
 from django.db.models import Count, Max, Q, Sum
 from django.utils import timezone
 from django.utils.translation import ugettext, ugettext_lazy as _
+from django_redis import get_redis_connection
 from itertools import chain
 from smartmin.models import SmartModel, SmartImportRowError
 from smartmin.csv_imports.models import ImportTask
@@ -25,12 +27,11 @@ from temba.assets.models import register_asset_store
 from temba.channels.models import Channel
 from temba.locations.models import AdminBoundary
 from temba.orgs.models import Org, OrgLock
-from temba.utils import analytics, format_decimal, chunk_list, get_anonymous_user
+from temba.utils import analytics, format_decimal, chunk_list, get_anonymous_user, on_transaction_commit
 from temba.utils.languages import _get_language_name_iso6393
 from temba.utils.models import SquashableModel, TembaModel
-from temba.utils.cache import get_cacheable_attr
+from temba.utils.cache import get_cacheable_attr, LRUCache
 from temba.utils.export import BaseExportAssetStore, BaseExportTask, TableExporter
-from temba.utils.profiler import time_monitor
 from temba.utils.text import clean_string, truncate
 from temba.values.models import Value
 
@@ -44,6 +45,28 @@ END_TEST_CONTACT_PATH = 12065550199
 # how many sequential contacts on import triggers suspension
 SEQUENTIAL_CONTACTS_THRESHOLD = 250
 
+# how many rows of an import file are read and processed at a time
+IMPORT_BATCH_SIZE = 500
+
+# key of the progress of a running contact import, which is kept outside of the import's transaction
+IMPORT_PROGRESS_KEY = 'contact_import:%d:progress'
+IMPORT_PROGRESS_TTL = 60 * 60 * 24
+
+# per-process cache of the field values and URNs of recently used contacts, versioned by their modified_on and a stamp
+# shared by all processes which is changed whenever those field values or URNs change
+contact_state_cache = LRUCache(max_size=5000, ttl=300)
+
+CONTACT_STATE_VERSION_KEY = 'contact:%d:cache:state_version'
+CONTACT_STATE_VERSION_TTL = 60 * 60  # 1 hour
+
+# per-process cache of dynamic group queries compiled to membership predicates, versioned by query and org fields
+group_predicate_cache = LRUCache(max_size=2000, ttl=300)
+
+
+def _matches_no_contacts(contact):  # pragma: no cover
+    return False
+
+
 EMAIL_SCHEME = 'mailto'
 EXTERNAL_SCHEME = 'ext'
 FACEBOOK_SCHEME = 'facebook'
@@ -632,6 +655,15 @@ class Contact(TembaModel):
 
         return sorted(activity, key=lambda i: i['time'], reverse=True)[:MAX_HISTORY]
 
+    def get_cached_state(self):
+        """
+        Gets the field values and URNs of this contact cached by this process, if they are still current
+        """
+        if not self.id or self.id not in contact_state_cache:
+            return None
+
+        return contact_state_cache.get(self.id, Contact.get_state_versions([self])[self.id])
+
     def get_field(self, key):
         """
         Gets the (possibly cached) value of a contact field
@@ -641,7 +673,12 @@ class Contact(TembaModel):
         if hasattr(self, cache_attr):
             return getattr(self, cache_attr)
 
-        value = Value.objects.filter(contact=self, contact_field__key__exact=key).select_related('contact_field').first()
+        state = self.get_cached_state()
+        if state is not None and key in state['fields']:
+            value = copy.copy(state['fields'][key])
+        else:
+            value = Value.objects.filter(contact=self, contact_field__key__exact=key).select_related('contact_field').first()
+
         self.set_cached_field_value(key, value)
         return value
 
@@ -706,11 +743,12 @@ class Contact(TembaModel):
         else:
             return value.string_value
 
-    def set_field(self, user, key, value, label=None, importing=False):
+    def set_field(self, user, key, value, label=None, importing=False, field=None):
         from temba.values.models import Value
 
-        # make sure this field exists
-        field = ContactField.get_or_create(self.org, user, key, label)
+        # make sure this field exists, unless we've been given it by an import which already has
+        if field is None:
+            field = ContactField.get_or_create(self.org, user, key, label)
 
         existing = None
         has_changed = False
@@ -779,8 +817,9 @@ class Contact(TembaModel):
                                                 location_value=loc_value, category=category)
                 has_changed = True
 
-        # cache this field value
+        # cache this field value, and drop any cached state for this contact which is now out of date
         self.set_cached_field_value(key, existing)
+        Contact.invalidate_state(self.id)
 
         if has_changed:
             self.modified_by = user
@@ -982,8 +1021,13 @@ class Contact(TembaModel):
                 # add attribute which allows import process to track new vs existing
                 contact.is_new = True
 
-            # attach all orphaned URNs
+            # attach all orphaned URNs, invalidating the state of any contacts they are taken from
+            for urn in existing_orphan_urns.values():
+                if urn.contact_id and urn.contact_id != contact.id:
+                    Contact.invalidate_state(urn.contact_id)
+
             ContactURN.objects.filter(pk__in=[urn.id for urn in existing_orphan_urns.values()]).update(contact=contact)
+            Contact.invalidate_state(contact.id)
 
             # create dict of all requested URNs and actual URN objects
             urn_objects = existing_orphan_urns.copy()
@@ -1065,7 +1109,7 @@ class Contact(TembaModel):
         return contact_search(org, query, base_group.contacts.all(), base_set=base_set)
 
     @classmethod
-    def create_instance(cls, field_dict):
+    def create_instance(cls, field_dict, import_state=None):
         """
         Creates or updates a contact from the given field values during an import
         """
@@ -1074,7 +1118,11 @@ class Contact(TembaModel):
 
         org = field_dict.pop('org')
         user = field_dict.pop('created_by')
-        is_admin = org.administrators.filter(id=user.id).exists()
+
+        if import_state is None:
+            import_state = cls.get_import_state(org, user)
+
+        is_admin = import_state['is_admin']
         uuid = field_dict.pop('contact uuid', None)
 
         # for backward compatibility
@@ -1091,50 +1139,23 @@ class Contact(TembaModel):
             possible_urn_headers = []
 
         for urn_header in possible_urn_headers:
-            value = None
-            if urn_header in field_dict:
-                value = field_dict[urn_header]
-                del field_dict[urn_header]
+            value = field_dict.pop(urn_header, None)
 
             if not value:
                 continue
 
-            value = six.text_type(value)
-
-            urn_scheme = ContactURN.IMPORT_HEADER_TO_SCHEME[urn_header]
-
-            if urn_scheme == TEL_SCHEME:
-
-                value = regex.sub(r'[ \-()]+', '', value, regex.V0)
-
-                # at this point the number might be a decimal, something that looks like '18094911278.0' due to
-                # excel formatting that field as numeric.. try to parse it into an int instead
-                try:
-                    value = str(int(float(value)))
-                except Exception:  # pragma: no cover
-                    # oh well, neither of those, stick to the plan, maybe we can make sense of it below
-                    pass
-
-                # only allow valid numbers
-                (normalized, is_valid) = URN.normalize_number(value, country)
-
-                if not is_valid:
-                    error_msg = "Invalid Phone number %s" % value
-                    if not country:
-                        error_msg = "Invalid Phone number or no country code specified for %s" % value
-
-                    raise SmartImportRowError(error_msg)
-
-                # in the past, test contacts have ended up in exports. Don't re-import them
-                if value == OLD_TEST_CONTACT_TEL:
-                    raise SmartImportRowError("Ignored test contact")
-
-            urn = URN.from_parts(urn_scheme, value)
-            search_contact = Contact.from_urn(org, urn, country)
+            urn = cls.parse_import_urn(urn_header, value, country)
 
             # if this is an anonymous org, don't allow updating
-            if org.is_anon and search_contact and not is_admin:
-                raise SmartImportRowError("Other existing contact on anonymous organization")
+            if org.is_anon and not is_admin:
+                existing_urns = import_state['existing_urns']
+                if existing_urns is not None:
+                    is_existing = cls.normalize_import_urn(urn, country) in existing_urns
+                else:
+                    is_existing = Contact.from_urn(org, urn, country) is not None
+
+                if is_existing:
+                    raise SmartImportRowError("Other existing contact on anonymous organization")
 
             urns.append(urn)
 
@@ -1159,6 +1180,11 @@ class Contact(TembaModel):
 
         # create new contact or fetch existing one
         contact = Contact.get_or_create(org, user, name, uuid=uuid, urns=urns, language=language, force_urn_update=True)
+        contact.org = org
+
+        # the URNs of this row now belong to an existing contact as far as the rows after it are concerned
+        if import_state['existing_urns'] is not None:
+            import_state['existing_urns'].update(cls.normalize_import_urn(urn, country) for urn in urns)
 
         # if they exist and are blocked, unblock them
         if contact.is_blocked:
@@ -1179,7 +1205,11 @@ class Contact(TembaModel):
                     value = org.timezone.localize(value) if org.timezone else pytz.utc.localize(value)
                 value = org.format_date(value, True)
 
-            contact.set_field(user, key, value, importing=True)
+            field = import_state['fields'].get(key)
+            if not field:
+                field = import_state['fields'][key] = ContactField.get_or_create(org, user, key)
+
+            contact.set_field(user, key, value, importing=True, field=field)
             contact_field_keys_updated.add(key)
 
         # to handle dynamic groups and campaign events updates
@@ -1188,12 +1218,119 @@ class Contact(TembaModel):
         return contact
 
     @classmethod
-    def prepare_fields(cls, field_dict, import_params=None, user=None):
+    def parse_import_urn(cls, urn_header, value, country):
+        """
+        Parses the value of a URN column in an import into a URN string
+        """
+        value = six.text_type(value)
+
+        urn_scheme = ContactURN.IMPORT_HEADER_TO_SCHEME[urn_header]
+
+        if urn_scheme == TEL_SCHEME:
+
+            value = regex.sub(r'[ \-()]+', '', value, regex.V0)
+
+            # at this point the number might be a decimal, something that looks like '18094911278.0' due to
+            # excel formatting that field as numeric.. try to parse it into an int instead
+            try:
+                value = str(int(float(value)))
+            except Exception:  # pragma: no cover
+                # oh well, neither of those, stick to the plan, maybe we can make sense of it below
+                pass
+
+            # only allow valid numbers
+            (normalized, is_valid) = URN.normalize_number(value, country)
+
+            if not is_valid:
+                error_msg = "Invalid Phone number %s" % value
+                if not country:
+                    error_msg = "Invalid Phone number or no country code specified for %s" % value
+
+                raise SmartImportRowError(error_msg)
+
+            # in the past, test contacts have ended up in exports. Don't re-import them
+            if value == OLD_TEST_CONTACT_TEL:
+                raise SmartImportRowError("Ignored test contact")
+
+        return URN.from_parts(urn_scheme, value)
+
+    @classmethod
+    def normalize_import_urn(cls, urn, country):
+        """
+        Normalizes a URN parsed from an import so that it can be compared with those of existing contacts
+        """
+        try:
+            return URN.normalize(urn, country)
+        except ValueError:
+            return urn
+
+    @classmethod
+    def get_import_state(cls, org, user):
+        """
+        Gets the state shared by all the rows of an import, i.e. whether the importing user is an administrator, the
+        contact fields used so far, and the URNs in the current batch which belong to existing contacts
+        """
+        return dict(org=org, is_admin=org.administrators.filter(id=user.id).exists(), fields={}, existing_urns=None)
+
+    @classmethod
+    def get_existing_import_urns(cls, org, urns, country):
+        """
+        Gets those of the given import URNs which belong to active contacts, normalized. Equivalent to calling from_urn
+        for each URN but with a single query for all of them.
+        """
+        by_identity = defaultdict(set)
+        by_twitter_path = defaultdict(set)
+
+        for urn in urns:
+            try:
+                normalized = URN.normalize(urn, country)
+            except ValueError:
+                continue
+
+            by_identity[URN.identity(normalized)].add(normalized)
+
+            scheme, path, display = URN.to_parts(normalized)
+            if scheme == TWITTER_SCHEME:
+                by_twitter_path[path].add(normalized)
+
+        if not by_identity:
+            return set()
+
+        query = Q(identity__in=by_identity.keys())
+        if by_twitter_path:
+            query |= Q(scheme=TWITTERID_SCHEME, display__in=by_twitter_path.keys())
+
+        identity_is_active = {}
+        twitterid_is_active = {}
+        for scheme, identity, display, is_active in ContactURN.objects.filter(query, org=org).values_list(
+                'scheme', 'identity', 'display', 'contact__is_active'):
+            if identity in by_identity:
+                identity_is_active[identity] = bool(is_active)
+            if scheme == TWITTERID_SCHEME and display in by_twitter_path:
+                twitterid_is_active[display] = bool(is_active)
+
+        existing = set()
+        for identity, is_active in six.iteritems(identity_is_active):
+            if is_active:
+                existing.update(by_identity[identity])
+
+        # like ContactURN.lookup, a twitterid URN with the same screen name takes precedence over a twitter URN
+        for path, urns_for_path in six.iteritems(by_twitter_path):
+            if path in twitterid_is_active:
+                if twitterid_is_active[path]:
+                    existing.update(urns_for_path)
+                else:
+                    existing.difference_update(urns_for_path)
+
+        return existing
+
+    @classmethod
+    def prepare_fields(cls, field_dict, import_params=None, user=None, import_state=None):
         if not import_params or 'org_id' not in import_params or 'extra_fields' not in import_params:
             raise ValueError('Import params must include org_id and extra_fields')
 
         field_dict['created_by'] = user
-        field_dict['org'] = Org.objects.get(pk=import_params['org_id'])
+        field_dict['org'] = import_state['org'] if import_state else Org.objects.get(pk=import_params['org_id'])
 
         extra_fields = []
 
@@ -1207,8 +1344,12 @@ class Contact(TembaModel):
                 del field_dict[field['header']]
                 field_dict[key] = value
 
-                # create the contact field if it doesn't exist
-                ContactField.get_or_create(field_dict['org'], user, key, label, False, field['type'])
+                # create the contact field if it doesn't exist, only once per import if we're given its state
+                if not import_state or key not in import_state['fields']:
+                    contact_field = ContactField.get_or_create(field_dict['org'], user, key, label, False, field['type'])
+                    if import_state:
+                        import_state['fields'][key] = contact_field
+
                 extra_fields.append(key)
             else:
                 raise ValueError('Extra field %s is a reserved field name' % key)
@@ -1277,21 +1418,32 @@ class Contact(TembaModel):
         return val
 
     @classmethod
-    def import_excel(cls, filename, user, import_params, log=None, import_results=None):
-
+    def import_excel(cls, filename, user, import_params, log=None, import_results=None, task=None, on_batch=None):
+        """
+        Imports contacts from the given file, reading its rows lazily and processing them in batches. The contacts of
+        each batch are passed to on_batch if given, and only their ids, one per imported row, are kept and returned.
+        """
         import pyexcel
-        sheet_data = pyexcel.get_array(file_name=filename.name)
 
+        try:
+            rows = pyexcel.iget_array(file_name=filename.name)
+
+            return cls._import_rows(rows, user, import_params, log, import_results, task, on_batch)
+        finally:
+            pyexcel.free_resources()
+
+    @classmethod
+    def _import_rows(cls, rows, user, import_params, log, import_results, task, on_batch):
         line_number = 0
 
-        header = sheet_data[line_number]
+        header = next(rows, None)
         line_number += 1
         while header is not None and len(header[0]) > 1 and header[0][0] == "#":  # pragma: needs cover
-            header = sheet_data[line_number]
+            header = next(rows, None)
             line_number += 1
 
         # do some sanity checking to make sure they uploaded the right kind of file
-        if len(header) < 1:  # pragma: needs cover
+        if not header:  # pragma: needs cover
             raise Exception("Invalid header for import file")
 
         # normalize our header names, removing quotes and spaces
@@ -1299,60 +1451,120 @@ class Contact(TembaModel):
 
         cls.validate_import_header(header)
 
-        records = []
+        # state shared by all rows so that we only fetch the org and create fields once
+        import_state = None
+        if import_params and 'org_id' in import_params:
+            import_state = cls.get_import_state(Org.objects.get(pk=import_params['org_id']), user)
+
+        record_ids = []
         num_errors = 0
         error_messages = []
+        num_rows = 0
+        start = time.time()
 
-        sheet_data_records = sheet_data[line_number:]
+        for batch in chunk_list(rows, IMPORT_BATCH_SIZE):
+            batch_values = []
+            records = []
 
-        for row in sheet_data_records:
-            # trim all our values
-            row_data = []
-            for cell in row:
-                cell_value = cls.normalize_value(cell)
-                if not isinstance(cell_value, datetime.date) and not isinstance(cell_value, datetime.datetime):
-                    cell_value = six.text_type(cell_value)
-                row_data.append(cell_value)
+            for row in batch:
+                # trim all our values
+                row_data = []
+                for cell in row:
+                    cell_value = cls.normalize_value(cell)
+                    if not isinstance(cell_value, datetime.date) and not isinstance(cell_value, datetime.datetime):
+                        cell_value = six.text_type(cell_value)
+                    row_data.append(cell_value)
 
-            line_number += 1
+                # rows are read as they are in the file so pad any which are missing trailing empty cells
+                if len(row_data) < len(header):
+                    row_data += [''] * (len(header) - len(row_data))
 
-            # make sure there are same number of fields
-            if len(row_data) != len(header):  # pragma: needs cover
-                raise Exception("Line %d: The number of fields for this row is incorrect. Expected %d but found %d." % (line_number, len(header), len(row_data)))
+                line_number += 1
 
-            field_values = dict(zip(header, row_data))
-            log_field_values = field_values.copy()
-            field_values['created_by'] = user
-            field_values['modified_by'] = user
-            try:
+                # make sure there are same number of fields
+                if len(row_data) != len(header):  # pragma: needs cover
+                    raise Exception("Line %d: The number of fields for this row is incorrect. Expected %d but found %d." % (line_number, len(header), len(row_data)))
+
+                batch_values.append((line_number, dict(zip(header, row_data))))
+                num_rows += 1
 
-                field_values = cls.prepare_fields(field_values, import_params, user)
-                record = cls.create_instance(field_values)
-                if record:
-                    records.append(record)
-                else:  # pragma: needs cover
-                    num_errors += 1
+            # anonymous orgs can't update existing contacts, so look up which of this batch's URNs exist all at once
+            if import_state and import_state['org'].is_anon and not import_state['is_admin']:
+                import_state['existing_urns'] = cls._get_existing_batch_urns(import_state['org'], batch_values)
+
+            for line_number, field_values in batch_values:
+                log_field_values = field_values.copy()
+                field_values['created_by'] = user
+                field_values['modified_by'] = user
+                try:
 
-            except SmartImportRowError as e:
-                error_messages.append(dict(line=line_number, error=str(e)))
+                    field_values = cls.prepare_fields(field_values, import_params, user, import_state)
+                    record = cls.create_instance(field_values, import_state)
+                    if record:
+                        records.append(record)
+                    else:  # pragma: needs cover
+                        num_errors += 1
 
-            except Exception as e:  # pragma: needs cover
-                if log:
-                    import traceback
-                    traceback.print_exc(100, log)
-                raise Exception("Line %d: %s\n\n%s" % (line_number, str(e), str(log_field_values)))
+                except SmartImportRowError as e:
+                    error_messages.append(dict(line=line_number, error=str(e)))
+
+                except Exception as e:  # pragma: needs cover
+                    if log:
+                        import traceback
+                        traceback.print_exc(100, log)
+                    raise Exception("Line %d: %s\n\n%s" % (line_number, str(e), str(log_field_values)))
+
+            if on_batch and records:
+                on_batch(records)
+
+            record_ids += [r.id for r in records]
+
+            # report our progress so far, which has to be outside of the database as the import runs in a transaction
+            if task:
+                elapsed = time.time() - start
+                progress = dict(records=len(record_ids), errors=num_errors + len(error_messages),
+                                rows=num_rows, rows_per_sec=int(num_rows / elapsed) if elapsed else 0)
+
+                r = get_redis_connection()
+                r.set(IMPORT_PROGRESS_KEY % task.pk, json.dumps(progress), ex=IMPORT_PROGRESS_TTL)
 
         if import_results is not None:
-            import_results['records'] = len(records)
+            import_results['records'] = len(record_ids)
             import_results['errors'] = num_errors + len(error_messages)
             import_results['error_messages'] = error_messages
 
-        return records
+        return record_ids
 
     @classmethod
-    def import_csv(cls, task, log=None):
-        import pyexcel
+    def get_import_progress(cls, task):
+        """
+        Gets the progress of the given import task while it runs, if it has reported any
+        """
+        r = get_redis_connection()
+        progress = r.get(IMPORT_PROGRESS_KEY % task.pk)
+        return json.loads(progress) if progress else None
+
+    @classmethod
+    def _get_existing_batch_urns(cls, org, batch_values):
+        """
+        Gets which of the URNs in the given batch of import rows already belong to contacts
+        """
+        country = org.get_country_code()
+        urns = []
+
+        for line_number, field_values in batch_values:
+            for urn_header, scheme in IMPORT_HEADERS:
+                value = field_values.get(urn_header)
+                if value:
+                    try:
+                        urns.append(cls.parse_import_urn(urn_header, value, country))
+                    except SmartImportRowError:
+                        pass  # will be reported when we try to import this row
+
+        return cls.get_existing_import_urns(org, urns, country)
 
+    @classmethod
+    def import_csv(cls, task, log=None):
         filename = task.csv_file.file
         user = task.created_by
 
@@ -1373,62 +1585,66 @@ class Contact(TembaModel):
         except Exception:
             pass
 
-        # rewrite our file to local disk
+        # rewrite our file to local disk, a chunk at a time
         extension = filename.name.rpartition('.')[2]
         tmp_file = os.path.join(settings.MEDIA_ROOT, 'tmp/%s.%s' % (str(uuid4()), extension.lower()))
         filename.open()
 
-        out_file = open(tmp_file, 'w')
-        out_file.write(filename.read())
-        out_file.close()
+        with open(tmp_file, 'wb') as out_file:
+            for chunk in filename.chunks():
+                out_file.write(chunk)
+
+        import_results = dict()
 
-        # convert the file to CSV
-        csv_tmp_file = os.path.join(settings.MEDIA_ROOT, 'tmp/%s.csv' % str(uuid4()))
+        # imported contacts are added to a group as each batch is imported, so we only need to hold onto their ids.
+        # We always create a group after a successful import (strip off 8 character uniquifier by django)
+        imported = dict(org=None, group=None, num_creates=0)
 
-        pyexcel.save_as(file_name=out_file.name, dest_file_name=csv_tmp_file)
+        def add_batch_to_group(contacts):
+            if not imported['group']:
+                group_name = os.path.splitext(os.path.split(import_params.get('original_filename'))[-1])[0]
+                group_name = group_name.replace('_', ' ').replace('-', ' ').title()
 
-        import_results = dict()
+                if len(group_name) >= ContactGroup.MAX_NAME_LEN - 10:
+                    group_name = group_name[:ContactGroup.MAX_NAME_LEN - 10]
+
+                # group org is same as org of any contact in that group
+                imported['org'] = contacts[0].org
+                imported['group'] = ContactGroup.create_static(imported['org'], user, group_name, task)
+
+            members = []
+            for contact in contacts:
+                # if contact has is_new attribute, then we have created a new contact rather than updated an existing one
+                if getattr(contact, 'is_new', False):
+                    imported['num_creates'] += 1
+
+                # do not add blocked or stopped contacts
+                if not contact.is_stopped and not contact.is_blocked:
+                    members.append(contact)
+
+            imported['group'].contacts.add(*members)
 
         try:
-            contacts = cls.import_excel(open(tmp_file), user, import_params, log, import_results)
+            contact_ids = cls.import_excel(open(tmp_file), user, import_params, log, import_results, task=task,
+                                           on_batch=add_batch_to_group)
         finally:
             os.remove(tmp_file)
-            os.remove(csv_tmp_file)
 
         # save the import results even if no record was created
         task.import_results = json.dumps(import_results)
 
-        # don't create a group if there are no contacts
-        if not contacts:
-            return contacts
-
-        # we always create a group after a successful import (strip off 8 character uniquifier by django)
-        group_name = os.path.splitext(os.path.split(import_params.get('original_filename'))[-1])[0]
-        group_name = group_name.replace('_', ' ').replace('-', ' ').title()
-
-        if len(group_name) >= ContactGroup.MAX_NAME_LEN - 10:
-            group_name = group_name[:ContactGroup.MAX_NAME_LEN - 10]
-
-        # group org is same as org of any contact in that group
-        group_org = contacts[0].org
-        group = ContactGroup.create_static(group_org, user, group_name, task)
-
-        num_creates = 0
-        for contact in contacts:
-            # if contact has is_new attribute, then we have created a new contact rather than updated an existing one
-            if getattr(contact, 'is_new', False):
-                num_creates += 1
+        # don't check the numbers if there are no contacts
+        if not contact_ids:
+            return contact_ids
 
-            # do not add blocked or stopped contacts
-            if not contact.is_stopped and not contact.is_blocked:
-                group.contacts.add(contact)
+        group_org = imported['org']
 
         # if we aren't whitelisted, check for sequential phone numbers
         if not group_org.is_whitelisted():
             try:
                 # get all of our phone numbers for the imported contacts
-                paths = [int(u.path) for u in ContactURN.objects.filter(scheme=TEL_SCHEME, contact__in=[c.pk for c in contacts])]
-                paths = sorted(paths)
+                paths = ContactURN.objects.filter(scheme=TEL_SCHEME, contact__in=set(contact_ids))
+                paths = sorted([int(p) for p in paths.values_list('path', flat=True)])
 
                 last_path = None
                 sequential = 0
@@ -1447,11 +1663,11 @@ class Contact(TembaModel):
                 pass
 
         # overwrite the import results for adding the counts
-        import_results['creates'] = num_creates
-        import_results['updates'] = len(contacts) - num_creates
+        import_results['creates'] = imported['num_creates']
+        import_results['updates'] = len(contact_ids) - imported['num_creates']
         task.import_results = json.dumps(import_results)
 
-        return contacts
+        return contact_ids
 
     @classmethod
     def apply_action_label(cls, user, contacts, group, add):
@@ -1595,10 +1811,41 @@ class Contact(TembaModel):
         Contact.bulk_cache_initialize(self.org, [self])
 
     @classmethod
-    def bulk_cache_initialize(cls, org, contacts, for_show_only=False):
+    def get_state_versions(cls, contacts):
+        """
+        Gets the versions of the cached state of the given contacts, as a map of contact ids to versions
+        """
+        r = get_redis_connection()
+        keys = [CONTACT_STATE_VERSION_KEY % c.id for c in contacts]
+        stamps = r.mget(keys) if keys else []
+
+        missing = [key for key, stamp in zip(keys, stamps) if stamp is None]
+        if missing:
+            pipe = r.pipeline()
+            for key in missing:
+                pipe.set(key, uuid.uuid4().hex, ex=CONTACT_STATE_VERSION_TTL, nx=True)
+            pipe.execute()
+            stamps = r.mget(keys)
+
+        return {c.id: (c.modified_on, stamp) for c, stamp in zip(contacts, stamps)}
+
+    @classmethod
+    def invalidate_state(cls, contact_id):
+        """
+        Invalidates the cached state of the given contact, held by this process now and by all others once the current
+        transaction commits
+        """
+        contact_state_cache.delete(contact_id)
+
+        key = CONTACT_STATE_VERSION_KEY % contact_id
+        on_transaction_commit(lambda: get_redis_connection().set(key, uuid.uuid4().hex, ex=CONTACT_STATE_VERSION_TTL))
+
+    @classmethod
+    def bulk_cache_initialize(cls, org, contacts, for_show_only=False, fresh=False):
         """
         Performs optimizations on our contacts to prepare them to send. This includes loading all our contact fields for
-        variable substitution.
+        variable substitution. If fresh is set then these are always loaded from the database rather than from any
+        state cached by this process.
         """
         from temba.values.models import Value
 
@@ -1612,71 +1859,90 @@ class Contact(TembaModel):
         # build id maps to avoid re-fetching contact objects
         key_map = {f.id: f.key for f in fields}
 
+        versions = cls.get_state_versions(contacts)
+
         contact_map = dict()
         for contact in contacts:
+            # if we have state cached for this version of the contact which includes these fields, use copies of that
+            state = None if fresh else contact_state_cache.get(contact.id, versions[contact.id])
+            if state is not None and all(f.key in state['fields'] for f in fields):
+                for field in fields:
+                    contact.set_cached_field_value(field.key, copy.copy(state['fields'][field.key]))
+                setattr(contact, '__urns', [copy.copy(u) for u in state['urns']])
+                continue
+
             contact_map[contact.id] = contact
             setattr(contact, '__urns', list())  # initialize URN list cache (setattr avoids name mangling or __urns)
 
-        # cache all field values
-        values = Value.objects.filter(contact_id__in=contact_map.keys(),
-                                      contact_field_id__in=key_map.keys()).select_related('contact_field', 'location_value')
-        for value in values:
-            contact = contact_map[value.contact_id]
-            field_key = key_map[value.contact_field_id]
-            cache_attr = '__field__%s' % field_key
-            setattr(contact, cache_attr, value)
-
-        # set missing fields as None attributes to avoid cache fetches later
-        for contact in contacts:
+            # set all fields as None attributes, replacing any previously cached, to avoid cache fetches later
             for field in fields:
-                cache_attr = '__field__%s' % field.key
-                if not hasattr(contact, cache_attr):
-                    setattr(contact, cache_attr, None)
+                setattr(contact, '__field__%s' % field.key, None)
+
+        if contact_map:
+            # cache all field values
+            values = Value.objects.filter(contact_id__in=contact_map.keys(),
+                                          contact_field_id__in=key_map.keys()).select_related('contact_field', 'location_value')
+            for value in values:
+                contact = contact_map[value.contact_id]
+                field_key = key_map[value.contact_field_id]
+                cache_attr = '__field__%s' % field_key
+                setattr(contact, cache_attr, value)
+
+            # cache all URN values (a priority ordered list on each contact)
+            urns = ContactURN.objects.filter(contact__in=contact_map.keys()).order_by('contact', '-priority', 'pk')
+            for urn in urns:
+                contact = contact_map[urn.contact_id]
+                getattr(contact, '__urns').append(urn)
 
-        # cache all URN values (a priority ordered list on each contact)
-        urns = ContactURN.objects.filter(contact__in=contact_map.keys()).order_by('contact', '-priority', 'pk')
-        for urn in urns:
-            contact = contact_map[urn.contact_id]
-            getattr(contact, '__urns').append(urn)
+            # and keep copies of that state around for the next time these contacts are used by this process
+            for contact in contact_map.values():
+                field_values = {f.key: copy.copy(getattr(contact, '__field__%s' % f.key)) for f in fields}
+                state = dict(fields=field_values, urns=[copy.copy(u) for u in getattr(contact, '__urns')])
+                contact_state_cache.set(contact.id, versions[contact.id], state)
 
         # set the cache initialize as correct
         for contact in contacts:
             contact.org = org
             setattr(contact, '__cache_initialized', True)
 
-    def build_expressions_context(self):
+    def build_expressions_context(self, keys=None):
         """
-        Builds a dictionary suitable for use in variable substitution in messages.
+        Builds a dictionary suitable for use in variable substitution in messages. If keys are provided then only
+        those items are included.
         """
         self.initialize_cache()
 
         org = self.org
-        context = {
-            '__default__': self.get_display(),
-            Contact.NAME: self.name or '',
-            Contact.FIRST_NAME: self.first_name(org),
-            Contact.LANGUAGE: self.language,
-            'tel_e164': self.get_urn_display(scheme=TEL_SCHEME, org=org, formatted=False),
-            'groups': ",".join([_.name for _ in self.cached_user_groups]),
-            'uuid': self.uuid
+        builders = {
+            '__default__': lambda: self.get_display(),
+            Contact.NAME: lambda: self.name or '',
+            Contact.FIRST_NAME: lambda: self.first_name(org),
+            Contact.LANGUAGE: lambda: self.language,
+            'tel_e164': lambda: self.get_urn_display(scheme=TEL_SCHEME, org=org, formatted=False),
+            'groups': lambda: ",".join([_.name for _ in self.cached_user_groups]),
+            'uuid': lambda: self.uuid
         }
 
         # anonymous orgs also get @contact.id
         if org.is_anon:
-            context['id'] = self.id
+            builders['id'] = lambda: self.id
+
+        context = {key: build() for key, build in six.iteritems(builders) if keys is None or key in keys}
 
         # add all URNs
         for scheme, label in ContactURN.SCHEME_CHOICES:
-            context[scheme] = self.get_urn_display(scheme=scheme, org=org) or ''
+            if keys is None or scheme in keys or (scheme == TWITTERID_SCHEME and TWITTER_SCHEME in keys):
+                context[scheme] = self.get_urn_display(scheme=scheme, org=org) or ''
 
         # populate twitter address if we have a twitter id
-        if context[TWITTERID_SCHEME] and not context[TWITTER_SCHEME]:
+        if context.get(TWITTERID_SCHEME) and TWITTER_SCHEME in context and not context[TWITTER_SCHEME]:
             context[TWITTER_SCHEME] = context[TWITTERID_SCHEME]
 
         # add all active fields to our context
         for field in org.cached_contact_fields:
-            field_value = Contact.serialize_field_value(field, self.get_field(field.key), org=org)
-            context[field.key] = field_value if field_value is not None else ''
+            if keys is None or field.key in keys:
+                field_value = Contact.serialize_field_value(field, self.get_field(field.key), org=org)
+                context[field.key] = field_value if field_value is not None else ''
 
         return context
 
@@ -1740,6 +2006,8 @@ class Contact(TembaModel):
         if hasattr(self, '__urns'):
             delattr(self, '__urns')
 
+        Contact.invalidate_state(self.id)
+
     def get_urns(self):
         """
         Gets all URNs ordered by priority
@@ -1748,7 +2016,12 @@ class Contact(TembaModel):
         if hasattr(self, cache_attr):
             return getattr(self, cache_attr)
 
-        urns = self.urns.order_by('-priority', 'pk')
+        state = self.get_cached_state()
+        if state is not None:
+            urns = [copy.copy(u) for u in state['urns']]
+        else:
+            urns = self.urns.order_by('-priority', 'pk')
+
         setattr(self, cache_attr, urns)
         return urns
 
@@ -1799,6 +2072,9 @@ class Contact(TembaModel):
 
                 # unassigned URN or assigned to someone else
                 elif not urn.contact or urn.contact != self:
+                    if urn.contact:
+                        Contact.invalidate_state(urn.contact_id)
+
                     urn.contact = self
                     urn.priority = priority
                     urn.save()
@@ -1826,8 +2102,7 @@ class Contact(TembaModel):
         self.handle_update(urns=[six.text_type(u) for u in (urns_created + urns_attached + urns_detached)])
 
         # clear URN cache
-        if hasattr(self, '__urns'):
-            delattr(self, '__urns')
+        self.clear_urn_cache()
 
     def update_static_groups(self, user, groups):
         """
@@ -1855,11 +2130,26 @@ class Contact(TembaModel):
         if for_field:
             affected_dynamic_groups = affected_dynamic_groups.filter(query_fields=for_field)
 
+        affected_dynamic_groups = list(affected_dynamic_groups)
+        if not affected_dynamic_groups:
+            return False
+
+        # fetch our current membership of all these groups at once, and only touch the groups where that changes
+        current_group_ids = set(ContactGroup.contacts.through.objects.filter(
+            contact_id=self.id, contactgroup_id__in=[g.id for g in affected_dynamic_groups]
+        ).values_list('contactgroup_id', flat=True))
+
+        # membership is always decided on our current field values and URNs rather than any we might have cached
+        Contact.bulk_cache_initialize(self.org, [self], fresh=True)
+
+        user = get_anonymous_user()
         group_change = False
         for group in affected_dynamic_groups:
             group.org = self.org
-            changed = group.reevaluate_contacts([self])
-            if changed:
+            qualifies = group._check_dynamic_membership(self)
+
+            if qualifies != (group.id in current_group_ids):
+                group._update_contacts(user, [self], qualifies)
                 group_change = True
 
         return group_change
@@ -2042,6 +2332,9 @@ class ContactURN(models.Model):
         if not priority:
             priority = cls.PRIORITY_DEFAULTS.get(scheme, cls.PRIORITY_STANDARD)
 
+        if contact:
+            Contact.invalidate_state(contact.id)
+
         return cls.objects.create(org=org, contact=contact, priority=priority, channel=channel, auth=auth,
                                   scheme=scheme, path=path, identity=urn_as_string, display=display)
 
@@ -2071,6 +2364,9 @@ class ContactURN(models.Model):
             self.auth = auth
             self.save(update_fields=['auth'])
 
+            if self.contact_id:
+                Contact.invalidate_state(self.contact_id)
+
     def update_affinity(self, channel):
         """
         Checks and optionally updates the affinity for this contact URN
@@ -2079,6 +2375,9 @@ class ContactURN(models.Model):
             self.channel = channel
             self.save(update_fields=['channel'])
 
+            if self.contact_id:
+                Contact.invalidate_state(self.contact_id)
+
     def ensure_number_normalization(self, country_code):
         """
         Tries to normalize our phone number from a possible 10 digit (0788 383 383) to a 12 digit number
@@ -2312,14 +2611,18 @@ class ContactGroup(TembaModel):
         if self.group_type != self.TYPE_USER_DEFINED or not self.is_dynamic:  # pragma: no cover
             raise ValueError("Can't re-evaluate contacts against system or static groups")
 
+        # membership is always decided on current field values and URNs rather than any cached on these contacts
+        contacts = list(OrderedDict((c.id, c) for c in contacts).values())
+        Contact.bulk_cache_initialize(self.org, contacts, fresh=True)
+
         user = get_anonymous_user()
-        changed = set()
+        to_add, to_remove = [], []
         for contact in contacts:
-            qualifies = self._check_dynamic_membership(contact)
-            changed = self._update_contacts(user, [contact], qualifies)
-            if changed:
-                changed.add(contact)
-        return changed
+            (to_add if self._check_dynamic_membership(contact) else to_remove).append(contact)
+
+        changed_ids = self._update_contacts(user, to_add, add=True) | self._update_contacts(user, to_remove, add=False)
+
+        return {c for c in contacts if c.id in changed_ids}
 
     def remove_contacts(self, user, contacts):
         """
@@ -2335,27 +2638,29 @@ class ContactGroup(TembaModel):
         Adds or removes contacts from this group - used for both non-dynamic and dynamic groups
         """
         changed = set()
-        group_contacts = self.contacts.all()
+        contacts = list(OrderedDict((c.id, c) for c in contacts).values())
 
-        for contact in contacts:
-            if add and (contact.is_blocked or contact.is_stopped or not contact.is_active):  # pragma: no cover
-                raise ValueError("Blocked, stopped and deleted contacts can't be added to groups")
+        if not contacts:
+            return changed
 
-            contact_changed = False
+        if add:
+            for contact in contacts:
+                if contact.is_blocked or contact.is_stopped or not contact.is_active:  # pragma: no cover
+                    raise ValueError("Blocked, stopped and deleted contacts can't be added to groups")
 
-            # if we are adding the contact to the group, and this contact is not in this group
+        # find which of these contacts are already in this group, and add or remove the others with single queries
+        member_ids = set(self.contacts.filter(id__in=[c.id for c in contacts]).values_list('id', flat=True))
+        changed_contacts = [c for c in contacts if (c.id in member_ids) != add]
+
+        if changed_contacts:
             if add:
-                if not group_contacts.filter(id=contact.id):
-                    self.contacts.add(contact)
-                    contact_changed = True
+                self.contacts.add(*changed_contacts)
             else:
-                if group_contacts.filter(id=contact.id):
-                    self.contacts.remove(contact)
-                    contact_changed = True
+                self.contacts.remove(*changed_contacts)
 
-            if contact_changed:
-                changed.add(contact.pk)
-                contact.handle_update(group=self)
+        for contact in changed_contacts:
+            changed.add(contact.pk)
+            contact.handle_update(group=self)
 
         if changed:
             # update modified on in small batches to avoid long table lock, and having too many non-unique values for
@@ -2406,12 +2711,37 @@ class ContactGroup(TembaModel):
         except SearchException:  # pragma: no cover
             return Contact.objects.none()
 
-    @time_monitor(threshold=10000)
     def _check_dynamic_membership(self, contact):
         """
-        For dynamic groups, determines whether the given contact belongs in the group
+        For dynamic groups, determines whether the given contact belongs in the group. Like _get_dynamic_members, only
+        contacts in the all contacts group can belong.
         """
-        return self._get_dynamic_members(base_set=[contact]).exists()
+        if contact.org_id != self.org_id or not contact.is_active or contact.is_blocked or contact.is_stopped or contact.is_test:
+            return False
+
+        return self.get_member_predicate()(contact)
+
+    def get_member_predicate(self):
+        """
+        Gets our query compiled into a function which determines whether a contact matches it. These are cached for
+        each version of our query and the org settings and fields it depends on, so are shared between contacts.
+        """
+        from .search import parse_query, SearchException
+
+        org = self.org
+        fields = tuple((f.key, f.value_type) for f in org.cached_contact_fields)
+        version = (self.query, org.is_anon, six.text_type(org.timezone), org.date_format, fields)
+
+        predicate = group_predicate_cache.get(self.id, version)
+        if predicate is None:
+            try:
+                predicate = parse_query(self.query, as_anon=org.is_anon).as_predicate(org)
+            except SearchException:  # pragma: no cover
+                predicate = _matches_no_contacts
+
+            group_predicate_cache.set(self.id, version, predicate)
+
+        return predicate
 
     @classmethod
     def get_system_group_counts(cls, org, group_types=None):
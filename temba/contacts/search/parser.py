@@ -76,6 +76,15 @@ class ContactQuery(object):
 
         return self.root.as_query(org, prop_map, base_set)
 
+    def as_predicate(self, org):
+        """
+        Compiles this query into a function which determines whether a contact matches it, using the contact's
+        (possibly cached) field values and URNs rather than querying for matching contacts
+        """
+        prop_map = self.get_prop_map(org)
+
+        return self.root.as_predicate(org, prop_map)
+
     def as_text(self):
         return self.root.as_text()
 
@@ -141,6 +150,9 @@ class QueryNode(object):
     def as_query(self, org, prop_map, base_set):  # pragma: no cover
         pass
 
+    def as_predicate(self, org, prop_map):  # pragma: no cover
+        pass
+
     def as_text(self):  # pragma: no cover
         pass
 
@@ -171,6 +183,16 @@ class Condition(QueryNode):
 
     COMPARATOR_ALIASES = {'is': '=', 'has': '~'}
 
+    # python equivalents of the lookups used to filter values
+    VALUE_LOOKUP_OPERATORS = {
+        'exact': operator.eq,
+        'gt': operator.gt,
+        'gte': operator.ge,
+        'lt': operator.lt,
+        'lte': operator.le,
+        'in': lambda actual, expected: actual in expected,
+    }
+
     def __init__(self, prop, comparator, value):
         self.prop = prop
         self.comparator = self.COMPARATOR_ALIASES[comparator] if comparator in self.COMPARATOR_ALIASES else comparator
@@ -192,6 +214,84 @@ class Condition(QueryNode):
         else:
             return self._build_attr_query(prop_obj)
 
+    def as_predicate(self, org, prop_map):
+        prop_type, prop_obj = prop_map[self.prop]
+
+        if prop_type == ContactQuery.PROP_FIELD:
+            value_test = self.build_value_test(prop_obj)
+
+            def predicate(contact):
+                return value_test(contact.get_field(prop_obj.key))
+
+        elif prop_type == ContactQuery.PROP_SCHEME:
+            if org.is_anon:
+                return lambda contact: False
+
+            path_test = self._build_string_test(self.ATTR_OR_URN_LOOKUPS, _("Can't query contact URNs with %s"))
+
+            def predicate(contact):
+                return any(urn.scheme == prop_obj and path_test(urn.path) for urn in contact.get_urns())
+        else:
+            attr_test = self._build_string_test(self.ATTR_OR_URN_LOOKUPS, _("Can't query contact properties with %s"))
+
+            def predicate(contact):
+                return attr_test(getattr(contact, prop_obj))
+
+        return predicate
+
+    def _build_string_test(self, lookups, error):
+        lookup = lookups.get(self.comparator)
+        if not lookup:
+            raise SearchException(error % self.comparator)
+
+        expected = self.value.upper()
+
+        def test(actual):
+            if actual is None:
+                return False
+
+            actual = six.text_type(actual).upper()
+            return actual == expected if lookup == 'iexact' else expected in actual
+
+        return test
+
+    def build_value_test(self, field):
+        """
+        Builds a function which determines whether a contact field value matches this condition, equivalent to
+        filtering values with build_value_query_params
+        """
+        tests = []
+        for lookup, expected in six.iteritems(self.build_value_query_params(field)):
+            if lookup == 'contact_field':
+                continue
+
+            attr, __, lookup = lookup.partition('__')
+
+            # locations are matched by id so fetch them once now rather than each time we test a value
+            if attr == 'location_value':
+                attr, expected = 'location_value_id', set(expected.values_list('id', flat=True))
+            elif lookup == 'in':
+                expected = set(expected)
+
+            tests.append((attr, self.VALUE_LOOKUP_OPERATORS[lookup or 'exact'], expected))
+
+        def test(value):
+            if value is None or value.contact_field_id != field.id:
+                return False
+
+            for attr, op, expected in tests:
+                if attr == 'field_and_string_value':
+                    actual = '%d|%s' % (value.contact_field_id, (value.string_value or '')[:STRING_VALUE_COMPARISON_LIMIT].upper())
+                else:
+                    actual = getattr(value, attr)
+
+                if actual is None or not op(actual, expected):
+                    return False
+
+            return True
+
+        return test
+
     def _build_attr_query(self, attr):
         lookup = self.ATTR_OR_URN_LOOKUPS.get(self.comparator)
         if not lookup:
@@ -372,6 +472,32 @@ class IsSetCondition(Condition):
             where_not_set = Q(**{prop_obj: ""}) | Q(**{prop_obj: None})
             return ~where_not_set if is_set else where_not_set
 
+    def as_predicate(self, org, prop_map):
+        prop_type, prop_obj = prop_map[self.prop]
+
+        if self.comparator.lower() in self.IS_SET_LOOKUPS:
+            is_set = True
+        elif self.comparator.lower() in self.IS_NOT_SET_LOOKUPS:
+            is_set = False
+        else:
+            raise SearchException(_("Invalid operator for empty string comparison"))
+
+        if prop_type == ContactQuery.PROP_FIELD:
+            def predicate(contact):
+                return (contact.get_field(prop_obj.key) is not None) == is_set
+
+        elif prop_type == ContactQuery.PROP_SCHEME:
+            if org.is_anon:
+                return lambda contact: False
+
+            def predicate(contact):
+                return any(urn.scheme == prop_obj for urn in contact.get_urns()) == is_set
+        else:
+            def predicate(contact):
+                return (getattr(contact, prop_obj) not in ("", None)) == is_set
+
+        return predicate
+
 
 @six.python_2_unicode_compatible
 class BoolCombination(QueryNode):
@@ -439,6 +565,15 @@ class BoolCombination(QueryNode):
     def as_query(self, org, prop_map, base_set):
         return reduce(self.op, [child.as_query(org, prop_map, base_set) for child in self.children])
 
+    def as_predicate(self, org, prop_map):
+        children = [child.as_predicate(org, prop_map) for child in self.children]
+        combine = all if self.op == self.AND else any
+
+        def predicate(contact):
+            return combine(child(contact) for child in children)
+
+        return predicate
+
     def as_text(self):
         op = ' OR ' if self.op == self.OR else ' AND '
         children = []
@@ -9,6 +9,7 @@ from datetime import datetime, date, timedelta
 from django.core.files.base import ContentFile
 from django.core.urlresolvers import reverse
 from django.conf import settings
+from django.db import connection
 from django.db.models import Value as DbValue
 from django.db.models.functions import Substr, Concat
 from django.test import TestCase
@@ -20,7 +21,7 @@ from smartmin.tests import _CRUDLTest
 from smartmin.csv_imports.models import ImportTask
 from temba.api.models import WebHookEvent, WebHookResult
 from temba.campaigns.models import Campaign, CampaignEvent, EventFire
-from temba.channels.models import Channel, ChannelEvent, ChannelLog
+from temba.channels.models import Channel, ChannelCount, ChannelEvent, ChannelLog
 from temba.contacts.search import is_it_a_phonenumber
 from temba.flows.models import FlowRun
 from temba.ivr.models import IVRCall
@@ -33,7 +34,7 @@ from temba.triggers.models import Trigger
 from temba.utils.dates import datetime_to_str, datetime_to_ms, get_datetime_format
 from temba.values.models import Value
 from .models import Contact, ContactGroup, ContactField, ContactURN, ExportContactsTask, URN, EXTERNAL_SCHEME
-from .models import TEL_SCHEME, TWITTER_SCHEME, EMAIL_SCHEME, ContactGroupCount
+from .models import TEL_SCHEME, TWITTER_SCHEME, EMAIL_SCHEME, ContactGroupCount, contact_state_cache
 from .search import parse_query, ContactQuery, Condition, IsSetCondition, BoolCombination, SinglePropCombination, SearchException
 from .tasks import squash_contactgroupcounts
 from .templatetags.contacts import contact_field, activity_icon, history_class
@@ -718,6 +719,28 @@ class ContactTest(TembaTest):
         new_test_contact = Contact.get_test_contact(self.user)
         self.assertNotEqual(new_test_contact.get_urn(TEL_SCHEME), test_urn)
 
+    def test_contact_is_test_lookup(self):
+        test_contact = Contact.get_test_contact(self.admin)
+        joe = self.create_contact("Joe", "+250788111111")
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT temba_contact_is_test(%s), temba_contact_is_test(%s), temba_contact_is_test(-1)',
+                           [test_contact.id, joe.id])
+            self.assertEqual(cursor.fetchone(), (True, False, False))
+
+            cursor.execute('SELECT temba_flows_contact_is_test(%s), temba_flows_contact_is_test(%s)',
+                           [test_contact.id, joe.id])
+            self.assertEqual(cursor.fetchone(), (True, False))
+
+        # test contacts aren't included in group or channel counts
+        group = self.create_group("Testers", [test_contact, joe])
+        self.assertEqual(ContactGroupCount.get_totals([group]), {group: 1})
+
+        self.create_msg(contact=test_contact, direction='I', text="Test", channel=self.channel)
+        self.create_msg(contact=joe, direction='I', text="Real", channel=self.channel)
+        today = timezone.now().date()
+        self.assertEqual(ChannelCount.get_day_count(self.channel, ChannelCount.INCOMING_MSG_TYPE, today), 1)
+
     def test_contact_create(self):
         self.login(self.admin)
 
@@ -1111,6 +1134,62 @@ class ContactTest(TembaTest):
         self.assertIsNone(getattr(self.frank, '__field__nick'))
         self.assertIsNone(getattr(self.billy, '__field__nick'))
 
+    def test_contact_state_cache(self):
+        ContactField.get_or_create(self.org, self.admin, 'age', "Age", value_type='N')
+
+        self.joe.set_field(self.user, 'age', 32)
+
+        org = Org.objects.get(pk=self.org.pk)
+        Contact.bulk_cache_initialize(org, [Contact.objects.get(pk=self.joe.pk)])
+
+        # a fresh instance of the same contact can be initialized from our cached state
+        joe = Contact.objects.get(pk=self.joe.pk)
+        with self.assertNumQueries(0):
+            Contact.bulk_cache_initialize(org, [joe])
+
+            self.assertEqual(joe.get_field('age').decimal_value, 32)
+            self.assertEqual([u.scheme for u in joe.get_urns()], [TWITTER_SCHEME, TEL_SCHEME])
+
+        # as can single field and URN lookups
+        joe = Contact.objects.get(pk=self.joe.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(joe.get_field('age').decimal_value, 32)
+            self.assertEqual([u.scheme for u in joe.get_urns()], [TWITTER_SCHEME, TEL_SCHEME])
+
+        # cached instances are copied so changes to them aren't shared
+        frank = Contact.objects.get(pk=self.joe.pk)
+        joe.get_field('age').string_value = "99"
+        joe.get_urns()[0].priority = 1
+        self.assertEqual(frank.get_field('age').string_value, "32")
+        self.assertNotEqual(frank.get_urns()[0].priority, 1)
+
+        # state invalidated by another process is no longer used even if it is still cached by this process
+        state = joe.get_cached_state()
+        version = Contact.get_state_versions([joe])[joe.id]
+        Contact.invalidate_state(joe.id)
+        contact_state_cache.set(joe.id, version, state)
+        self.assertIsNone(joe.get_cached_state())
+
+        joe = Contact.objects.get(pk=self.joe.pk)
+        Contact.bulk_cache_initialize(org, [joe])
+        self.assertIsNotNone(joe.get_cached_state())
+
+        # setting a field invalidates that state
+        joe.set_field(self.user, 'age', 33)
+        self.assertIsNone(joe.get_cached_state())
+
+        joe = Contact.objects.get(pk=self.joe.pk)
+        Contact.bulk_cache_initialize(org, [joe])
+        self.assertEqual(joe.get_field('age').decimal_value, 33)
+
+        # as does updating URNs
+        joe.update_urns(self.user, ['tel:+250781111111'])
+        self.assertIsNone(joe.get_cached_state())
+
+        joe = Contact.objects.get(pk=self.joe.pk)
+        Contact.bulk_cache_initialize(org, [joe])
+        self.assertEqual([six.text_type(u) for u in joe.get_urns()], ['tel:+250781111111'])
+
     def test_contact_search_parsing(self):
         # implicit condition on name
         self.assertEqual(parse_query('will'), ContactQuery(Condition('name', '~', 'will')))
@@ -1389,6 +1468,70 @@ class ContactTest(TembaTest):
         self.assertRaises(SearchException, q, 'tel < ""')  # unsupported comparator for an empty string
         self.assertRaises(SearchException, q, 'data=“not empty”')  # unicode “,” are not accepted characters
 
+    def test_group_member_predicate(self):
+        ContactField.get_or_create(self.org, self.admin, 'age', "Age", value_type='N')
+        ContactField.get_or_create(self.org, self.admin, 'join_date', "Join Date", value_type='D')
+        ContactField.get_or_create(self.org, self.admin, 'home', "Home District", value_type='I')
+        ContactField.get_or_create(self.org, self.admin, 'profession', "Profession", value_type='T')
+
+        districts = ['Gatsibo', 'Kayônza', 'Rwamagana']
+        date_format = get_datetime_format(True)[0]
+
+        for i in range(12):
+            contact = self.create_contact(name="Bob %d" % i, number="0788382%s" % str(i).zfill(3),
+                                          twitter=("tweep_%d" % i) if (i % 3 == 0) else None)
+            contact.set_field(self.user, 'age', str(i + 10))
+            contact.set_field(self.user, 'join_date', datetime_to_str(date(2014, 1, 1) + timedelta(days=i), date_format))
+            contact.set_field(self.user, 'home', districts[i % len(districts)])
+            if i % 2 == 0:
+                contact.set_field(self.user, 'profession', "Farmer")
+
+        contacts = list(Contact.objects.filter(org=self.org, is_active=True, is_test=False))
+        Contact.bulk_cache_initialize(self.org, contacts)
+
+        # predicates should agree with the database for every kind of condition
+        for q, query in enumerate(('bob', 'name = "Bob 3"', 'age > 15', 'age <= 12', 'age = 11', 'join_date < 05-01-2014',
+                      'join_date = 03-01-2014', 'home = kayonza', 'home = Gatsibo', 'profession = farmer',
+                      'profession = ""', 'profession != ""', 'twitter = tweep_3', 'twitter != ""', 'tel has 38200',
+                      'age > 12 and profession = farmer', 'age < 12 or home = rwamagana',
+                      '(age > 12 or twitter != "") and home != ""')):
+            group = self.create_group("Dynamic %d" % q, query=query)
+
+            expected = set(Contact.search(self.org, query)[0].values_list('id', flat=True))
+            matched = {c.id for c in contacts if group._check_dynamic_membership(c)}
+            self.assertEqual(matched, expected, "mismatch for query '%s'" % query)
+
+        # predicates are cached until the query changes
+        group = self.create_group("Old Folk", query='age > 18')
+        predicate = group.get_member_predicate()
+        self.assertIs(group.get_member_predicate(), predicate)
+
+        group.query = 'age > 20'
+        self.assertIsNot(group.get_member_predicate(), predicate)
+
+        # reevaluating adds and removes contacts in bulk, only reporting those which actually changed
+        group.query = 'age > 18'
+        group.save(update_fields=('query',))
+        group.contacts.clear()
+        group.contacts.add(*[c for c in contacts if c.get_field('age') and c.get_field('age').decimal_value == 10])
+
+        changed = group.reevaluate_contacts(contacts)
+        self.assertEqual({c.id for c in changed},
+                         {c.id for c in contacts if c.get_field('age') and c.get_field('age').decimal_value in (10, 19, 20, 21)})
+        self.assertEqual(set(group.contacts.values_list('id', flat=True)),
+                         set(Contact.search(self.org, 'age > 18')[0].values_list('id', flat=True)))
+
+        # and doing it again is a no-op
+        self.assertEqual(group.reevaluate_contacts(contacts), set())
+
+        # membership is decided on current field values rather than those cached on the contacts
+        bob = next(c for c in contacts if c.get_field('age').decimal_value == 10)
+        Value.objects.filter(contact=bob, contact_field__key='age').update(string_value="30", decimal_value=30)
+        self.assertEqual(bob.get_field('age').decimal_value, 10)
+
+        self.assertEqual(group.reevaluate_contacts(contacts), {bob})
+        self.assertTrue(group.contacts.filter(id=bob.id).exists())
+
     def test_omnibox(self):
         # add a group with members and an empty group
         self.create_field('gender', "Gender")
@@ -2706,6 +2849,46 @@ class ContactTest(TembaTest):
 
         return response
 
+    @patch('temba.contacts.models.IMPORT_BATCH_SIZE', 2)
+    def test_contact_import_in_batches(self):
+        records, task = self.do_import(self.user, 'sample_contacts_update.csv')
+        self.assertEqual(4, len(records))
+        self.assertEqual(json.loads(task.import_results),
+                         dict(records=4, errors=0, error_messages=[], creates=4, updates=0))
+
+        group = ContactGroup.user_groups.get(import_task=task)
+        self.assertEqual(set(group.contacts.values_list('id', flat=True)), set(records))
+
+        # progress was reported outside of the import's transaction after each batch
+        progress = Contact.get_import_progress(task)
+        self.assertEqual(progress['records'], 4)
+        self.assertEqual(progress['errors'], 0)
+        self.assertEqual(progress['rows'], 4)
+
+        # URNs of existing contacts can be looked up for a whole batch at once
+        self.org.is_anon = True
+        self.org.save()
+        existing = Contact.get_existing_import_urns(self.org, ['tel:0788382382', 'tel:+250788999999', 'twitter:nyaruka'], 'RW')
+        self.assertEqual(existing, {'tel:+250788382382'})
+
+        self.create_contact("Nyaruka", twitter="nyaruka")
+        existing = Contact.get_existing_import_urns(self.org, ['tel:0788382382', 'twitter:nyaruka'], 'RW')
+        self.assertEqual(existing, {'tel:+250788382382', 'twitter:nyaruka'})
+
+        # and these can't be imported as updates
+        records, task = self.do_import(self.user, 'sample_contacts_update.csv')
+        self.assertEqual(0, len(records))
+        self.assertEqual(json.loads(task.import_results)['errors'], 4)
+
+        # nor can a URN repeated in the same batch update the contact created by an earlier row
+        Contact.objects.filter(org=self.org).update(is_active=False)
+        ContactURN.objects.filter(org=self.org).update(contact=None)
+
+        records, task = self.do_import(self.user, 'sample_contacts_repeated_urns.csv')
+        self.assertEqual(2, len(records))
+        self.assertEqual(json.loads(task.import_results)['errors'], 1)
+        self.assertEqual(Contact.objects.get(urns__path='+250788382382').name, "Eric Newcomer")
+
     @patch.object(ContactGroup, "MAX_ORG_CONTACTGROUPS", new=10)
     def test_contact_import(self):
         #
@@ -3767,6 +3950,11 @@ class ContactTest(TembaTest):
         self.assertEqual("SeaHawks", context['team'])
         self.assertNotIn('color', context)
 
+        # contexts can be limited to the keys that will actually be used
+        context = self.joe.build_expressions_context(keys={'first_name', 'team', 'twitter'})
+        self.assertEqual(context, {'first_name': "Joe", 'team': "SeaHawks", 'twitter': "therealjoe",
+                                   'twitterid': "therealjoe"})
+
         # switch our org to anonymous
         with AnonymousOrg(self.org):
             self.joe.org.refresh_from_db()
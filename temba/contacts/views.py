@@ -665,6 +665,7 @@ class ContactCRUDL(SmartCRUDL):
                     context['task'] = task
                     context['show_form'] = False
                     context['results'] = json.loads(task.import_results) if task.import_results else dict()
+                    context['progress'] = Contact.get_import_progress(task)
 
                     groups = ContactGroup.user_groups.filter(import_task=task)
 
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+SQL = """
+----------------------------------------------------------------------
+-- Registers a default for the setting which tells the path change trigger
+-- that the application has counted a transaction's path changes, for new
+-- sessions and for this one. Sessions opened before this (e.g. pooled server
+-- connections) need to be reconnected.
+----------------------------------------------------------------------
+DO $$
+BEGIN
+  EXECUTE format('ALTER DATABASE %I SET temba.path_counts = %L', current_database(), '');
+END;
+$$;
+
+SET temba.path_counts = '';
+
+----------------------------------------------------------------------
+-- Utility function to check whether the current transaction has already
+-- counted the path changes it is making application side
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION temba_flowrun_paths_counted() RETURNS BOOLEAN AS $$
+BEGIN
+  -- the database has a default for this setting, so unlike an unregistered setting, reading it never errors
+  RETURN current_setting('temba.path_counts') = 'app';
+END;
+$$ LANGUAGE plpgsql STABLE;
+
+----------------------------------------------------------------------
+-- Handles changes relating to a flow run's path
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION temba_flowrun_path_change() RETURNS TRIGGER AS $$
+DECLARE
+  p INT;
+  _old_is_active BOOL;
+  _old_path TEXT;
+  _new_path TEXT;
+  _old_path_json JSON;
+  _new_path_json JSON;
+  _old_path_len INT;
+  _new_path_len INT;
+BEGIN
+  -- Handles one of the following changes to a flow run:
+  --  1. flow path unchanged and is_active becomes false (run interrupted or expired)
+  --  2. flow path added to and is_active becomes false (run completed)
+  --  3. flow path added to and is_active remains true (run continues)
+  --  4. deletion
+  --
+
+  -- restrict changes to runs
+  IF TG_OP = 'UPDATE' THEN
+    IF NEW.is_active AND NOT OLD.is_active THEN RAISE EXCEPTION 'Cannot re-activate an inactive flow run'; END IF;
+    IF NOT OLD.is_active AND NEW.path != OLD.path THEN RAISE EXCEPTION 'Cannot modify path on an inactive flow run'; END IF;
+  END IF;
+
+  -- ignore changes whose path and node counts have been written by the application
+  IF temba_flowrun_paths_counted() THEN RETURN NULL; END IF;
+
+  IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+    _old_is_active := OLD.is_active;
+    _old_path := OLD.path;
+  END IF;
+
+  IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+    -- ignore test contacts
+    IF temba_contact_is_test(NEW.contact_id) THEN RETURN NULL; END IF;
+
+    _new_path := NEW.path;
+
+    -- don't differentiate between empty array and NULL
+    IF _old_path IS NULL THEN _old_path := '[]'; END IF;
+    IF _new_path IS NULL THEN _new_path := '[]'; END IF;
+
+    _old_path_json := _old_path::json;
+    _new_path_json := _new_path::json;
+    _old_path_len := json_array_length(_old_path_json);
+    _new_path_len := json_array_length(_new_path_json);
+
+    -- we don't support rewinding run paths, so the new path must be longer than the old
+    IF _new_path_len < _old_path_len THEN RAISE EXCEPTION 'Cannot rewind a flow run path'; END IF;
+
+    -- update the node counts
+    IF _old_path_len > 0 AND _old_is_active THEN
+      PERFORM temba_insert_flownodecount(NEW.flow_id, UUID(_old_path_json->(_old_path_len-1)->>'node_uuid'), -1);
+    END IF;
+
+    IF _new_path_len > 0 AND NEW.is_active THEN
+      PERFORM temba_insert_flownodecount(NEW.flow_id, UUID(_new_path_json->(_new_path_len-1)->>'node_uuid'), 1);
+    END IF;
+
+    -- if we have old steps, we start at the end of the old path
+    IF _old_path_len > 0 THEN p := _old_path_len; ELSE p := 1; END IF;
+
+    LOOP
+      EXIT WHEN p >= _new_path_len;
+      PERFORM temba_insert_flowpathcount(
+          NEW.flow_id,
+          UUID(_new_path_json->(p-1)->>'exit_uuid'),
+          UUID(_new_path_json->p->>'node_uuid'),
+          timestamptz(_new_path_json->p->>'arrived_on'),
+          1
+      );
+      p := p + 1;
+    END LOOP;
+
+  ELSIF TG_OP = 'DELETE' THEN
+    -- ignore test contacts
+    IF temba_contact_is_test(OLD.contact_id) THEN RETURN NULL; END IF;
+
+    -- do nothing if path was empty
+    IF _old_path IS NULL OR _old_path = '[]' THEN RETURN NULL; END IF;
+
+    -- parse path as JSON
+    _old_path_json := _old_path::json;
+    _old_path_len := json_array_length(_old_path_json);
+
+    -- decrement node count at last node in this path if this was an active run
+    IF _old_is_active THEN
+      PERFORM temba_insert_flownodecount(OLD.flow_id, UUID(_old_path_json->(_old_path_len-1)->>'node_uuid'), -1);
+    END IF;
+
+    -- decrement all path counts
+    p := 1;
+    LOOP
+      EXIT WHEN p >= _old_path_len;
+
+      -- it's possible that steps from old flows don't have exit_uuid
+      IF (_old_path_json->(p-1)->'exit_uuid') IS NOT NULL THEN
+        PERFORM temba_insert_flowpathcount(
+          OLD.flow_id,
+          UUID(_old_path_json->(p-1)->>'exit_uuid'),
+          UUID(_old_path_json->p->>'node_uuid'),
+          timestamptz(_old_path_json->p->>'arrived_on'),
+          -1
+        );
+      END IF;
+
+      p := p + 1;
+    END LOOP;
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('flows', '0139_fix_results'),
+    ]
+
+    operations = [
+        migrations.RunSQL(SQL)
+    ]
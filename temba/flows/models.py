@@ -1,18 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function, unicode_literals
 
+import copy
+import iso8601
 import json
 import logging
 import numbers
 import phonenumbers
 import regex
 import six
+import threading
 import time
 import traceback
 import urllib2
 
-from array import array
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from datetime import timedelta, datetime
 from decimal import Decimal
 from django.conf import settings
@@ -22,7 +25,7 @@ from django.core.files.temp import NamedTemporaryFile
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, Group
 from django.contrib.postgres.fields import ArrayField
-from django.db import models, connection as db_connection
+from django.db import models, transaction, connection as db_connection
 from django.db.models import Q, Count, QuerySet, Sum, Max, Prefetch
 from django.utils import timezone
 from django.utils.functional import cached_property
@@ -31,6 +34,7 @@ from django.utils.html import escape
 from django_redis import get_redis_connection
 from enum import Enum
 from openpyxl import Workbook
+from psycopg2.extras import execute_values
 from six.moves import range
 from smartmin.models import SmartModel
 from temba.airtime.models import AirtimeTransfer
@@ -42,6 +46,7 @@ from temba.msgs.models import Broadcast, Msg, FLOW, INBOX, INCOMING, QUEUED, FAI
 from temba.msgs.models import PENDING, DELIVERED, USSD as MSG_TYPE_USSD, OUTGOING
 from temba.orgs.models import Org, Language, get_current_export_version
 from temba.utils import analytics, chunk_list, on_transaction_commit
+from temba.utils.cache import LRUCache
 from temba.utils.dates import get_datetime_format, str_to_datetime, datetime_to_str, json_date_to_datetime
 from temba.utils.email import is_valid_address
 from temba.utils.export import BaseExportTask, BaseExportAssetStore
@@ -58,6 +63,10 @@ logger = logging.getLogger(__name__)
 FLOW_DEFAULT_EXPIRES_AFTER = 60 * 12
 START_FLOW_BATCH_SIZE = 500
 
+# the id of the last run checked by an expiration sweep, so that an interrupted sweep can resume where it left off
+RUN_EXPIRATION_CURSOR_KEY = 'run_expiration_cursor'
+RUN_EXPIRATION_CHUNK_SIZE = 1000
+
 
 class FlowException(Exception):
     pass
@@ -87,6 +96,9 @@ FLOW_PROP_CACHE_TTL = 24 * 60 * 60 * 7  # 1 week
 
 UNREAD_FLOW_RESPONSES = 'unread_flow_responses'
 
+# rules compiled from each revision of a ruleset, shared by all the messages this process handles
+compiled_rules_cache = LRUCache(max_size=2000, ttl=300)
+
 
 class FlowLock(Enum):
     """
@@ -1227,6 +1239,38 @@ class Flow(TembaModel):
         from temba.triggers.models import Trigger
         Trigger.objects.filter(flow=self).update(is_archived=True)
 
+    def update_run_expirations(self):
+        """
+        Recalculates the expirations of this flow's active runs after its expiration period has changed, as set-based
+        updates over id-ordered chunks of runs. Runs which have now expired are left for the next expiration sweep.
+        """
+        if not self.expires_after_minutes:
+            return
+
+        last_id = 0
+        while True:
+            run_ids = list(self.runs.filter(is_active=True, id__gt=last_id).order_by('id')
+                           .values_list('id', flat=True)[:RUN_EXPIRATION_CHUNK_SIZE])
+            if not run_ids:
+                break
+
+            # each run expires a fixed period after it arrived at its current step
+            with db_connection.cursor() as cursor:
+                cursor.execute('UPDATE flows_flowrun r SET expires_on = s.arrived_on + %s * INTERVAL \'1 minute\', '
+                               'modified_on = NOW() FROM flows_flowstep s '
+                               'WHERE s.run_id = r.id AND s.left_on IS NULL AND r.id = ANY(%s) '
+                               'RETURNING r.parent_id, r.expires_on', [self.expires_after_minutes, run_ids])
+                parent_expirations = [(parent_id, expires_on) for parent_id, expires_on in cursor.fetchall() if parent_id]
+
+            # parents should always have a later expiration than their children
+            if parent_expirations:
+                parents_by_id = FlowRun.objects.select_related('flow').in_bulk([p[0] for p in parent_expirations])
+                for parent_id, expires_on in parent_expirations:
+                    parents_by_id[parent_id].update_expiration(expires_on)
+
+            analytics.gauge('temba.run_expiration_updates_chunk', len(run_ids))
+            last_id = run_ids[-1]
+
     def restore(self):
         if self.flow_type == Flow.VOICE:  # pragma: needs cover
             if not self.org.supports_ivr():
@@ -1588,30 +1632,7 @@ class Flow(TembaModel):
             started_flows = []
 
         # for each send action, we need to create a broadcast, we'll group our created messages under these
-        broadcasts = []
-
-        if len(all_contact_ids) > 1:
-
-            # create the broadcast for this flow
-            send_actions = self.get_entry_send_actions()
-
-            for send_action in send_actions:
-                # check that we either have text or media, available for the base language
-                if (send_action.msg and send_action.msg.get(self.base_language)) or (send_action.media and send_action.media.get(self.base_language)):
-
-                    broadcast = Broadcast.create(self.org, self.created_by, send_action.msg, [],
-                                                 media=send_action.media,
-                                                 base_language=self.base_language,
-                                                 send_all=send_action.send_all,
-                                                 quick_replies=send_action.quick_replies)
-                    broadcast.update_contacts(all_contact_ids)
-
-                    # manually set our broadcast status to QUEUED, our sub processes will send things off for us
-                    broadcast.status = QUEUED
-                    broadcast.save(update_fields=['status'])
-
-                    # add it to the list of broadcasts in this flow start
-                    broadcasts.append(broadcast)
+        broadcasts = self.create_entry_broadcasts(all_contact_ids) if len(all_contact_ids) > 1 else []
 
         # if there are fewer contacts than our batch size, do it immediately
         if len(all_contact_ids) < START_FLOW_BATCH_SIZE:
@@ -1641,8 +1662,35 @@ class Flow(TembaModel):
 
             return []
 
+    def create_entry_broadcasts(self, all_contact_ids):
+        """
+        Creates a broadcast for each of the entry reply actions so that their messages can be created in bulk
+        """
+        broadcasts = []
+
+        for send_action in self.get_entry_send_actions():
+            # check that we either have text or media, available for the base language
+            if (send_action.msg and send_action.msg.get(self.base_language)) or (send_action.media and send_action.media.get(self.base_language)):
+
+                broadcast = Broadcast.create(self.org, self.created_by, send_action.msg, [],
+                                             media=send_action.media,
+                                             base_language=self.base_language,
+                                             send_all=send_action.send_all,
+                                             quick_replies=send_action.quick_replies)
+                broadcast.update_contacts(all_contact_ids)
+
+                # manually set our broadcast status to QUEUED, our sub processes will send things off for us
+                broadcast.status = QUEUED
+                broadcast.save(update_fields=['status'])
+
+                # add it to the list of broadcasts in this flow start
+                broadcasts.append(broadcast)
+
+        return broadcasts
+
     def start_msg_flow_batch(self, batch_contact_ids, broadcasts, started_flows, start_msg=None,
-                             extra=None, flow_start=None, parent_run=None):
+                             extra=None, flow_start=None, parent_run=None, batch_mode=True):
+        start_time = time.time()
 
         batch_contacts = Contact.objects.filter(id__in=batch_contact_ids)
         Contact.bulk_cache_initialize(self.org, batch_contacts)
@@ -1729,7 +1777,28 @@ class Flow(TembaModel):
         msgs = []
         optimize_sending_action = len(broadcasts) > 0
 
-        for run in runs:
+        # if every run will take the same route through our entry node, take them through it together
+        batch_nodes = None
+        if batch_mode and len(runs) > 1 and not simulation and not start_msg and not parent_run:
+            batch_nodes = self.get_batch_start_nodes(entry_actions, entry_rules, broadcasts)
+
+        unbatched_runs = runs
+
+        if batch_nodes:
+            # keep the initial state of our runs so that if the batch fails, they can still be started one at a time
+            # and only the runs which fail on their own are interrupted
+            initial_runs = [copy.copy(r) for r in runs]
+            try:
+                with transaction.atomic():
+                    msgs = self.start_runs_batch(runs, batch_nodes, message_map)
+                unbatched_runs = []
+            except Exception:
+                logger.error('Failed batch starting flow %d, starting runs individually' % self.id, exc_info=1,
+                             extra={'stack': True})
+                runs = unbatched_runs = initial_runs
+                msgs = []
+
+        for run in unbatched_runs:
             contact = run.contact
 
             # each contact maintains its own list of started flows
@@ -1809,8 +1878,133 @@ class Flow(TembaModel):
         if flow_start:
             flow_start.update_status()
 
+        analytics.gauge('temba.flow_start_batch_rate', len(batch_contact_ids) / max(time.time() - start_time, 0.001))
+
         return runs
 
+    def get_batch_start_nodes(self, entry_actions, entry_rules, broadcasts):
+        """
+        Returns the nodes a batch of new runs will visit when started in this flow, if entering the flow can't
+        execute anything contact specific, otherwise None. That is the case when the entry node is an action set
+        of reply actions which are all being sent as broadcasts, followed by either nothing or a ruleset which waits
+        for a message, or when the entry node is itself a ruleset which waits for a message.
+        """
+        def is_wait(node):
+            return isinstance(node, RuleSet) and node.is_pause() and not node.is_ussd()
+
+        if entry_actions:
+            # leading reply actions are only skipped when we have broadcasts to send them
+            if not broadcasts:
+                return None
+
+            for action in entry_actions.get_actions():
+                if not isinstance(action, ReplyAction) or isinstance(action, EndUssdAction):
+                    return None
+
+            if not entry_actions.destination:
+                return [entry_actions]
+
+            destination = Flow.get_node(self, entry_actions.destination, entry_actions.destination_type)
+            return [entry_actions, destination] if is_wait(destination) else None
+
+        elif entry_rules:
+            return [entry_rules] if is_wait(entry_rules) else None
+
+        return None
+
+    def start_runs_batch(self, runs, nodes, message_map):
+        """
+        Takes a batch of new runs through the given entry nodes together, writing steps, path updates, completions
+        and message associations as bulk statements. This is equivalent to taking each run through add_step,
+        handle_destination and set_completed individually.
+        """
+        now = timezone.now()
+        entry_node, last_node = nodes[0], nodes[-1]
+        completed = isinstance(last_node, ActionSet)
+        timeout = last_node.get_timeout() if isinstance(last_node, RuleSet) else None
+
+        # every run arrives at the same nodes at the same time so shares a single path
+        path = []
+        for node in nodes:
+            if path:
+                path[-1][FlowRun.PATH_EXIT_UUID] = entry_node.exit_uuid
+            path.append({FlowRun.PATH_NODE_UUID: node.uuid, FlowRun.PATH_ARRIVED_ON: now.isoformat()})
+
+        # create the steps for every run at once
+        steps = []
+        for run in runs:
+            for n, node in enumerate(nodes):
+                step = FlowStep(run=run, contact=run.contact, step_type=node.get_step_type(), step_uuid=node.uuid,
+                                arrived_on=now)
+                if n < len(nodes) - 1:
+                    step.left_on = now
+                    step.rule_uuid = entry_node.exit_uuid
+                    step.next_uuid = nodes[n + 1].uuid
+                elif completed:
+                    step.left_on = now
+
+                steps.append(step)
+
+        steps = FlowStep.objects.bulk_create(steps)
+        entry_steps = steps[::len(nodes)]
+
+        # associate the broadcast messages with the entry steps, and record them on the first path segment
+        step_msgs = []
+        step_broadcasts = []
+        recent_msgs = []
+        msgs = []
+
+        for run, step in zip(runs, entry_steps):
+            run_msgs = message_map.get(run.contact_id, [])
+            run_broadcast_ids = set()
+
+            for msg in run_msgs:
+                step_msgs.append(FlowStep.messages.through(flowstep_id=step.id, msg_id=msg.id))
+
+                if msg.broadcast_id not in run_broadcast_ids:
+                    run_broadcast_ids.add(msg.broadcast_id)
+                    step_broadcasts.append(FlowStep.broadcasts.through(flowstep_id=step.id,
+                                                                       broadcast_id=msg.broadcast_id))
+
+                if len(nodes) > 1:
+                    recent_msgs.append(FlowPathRecentMessage(from_uuid=entry_node.exit_uuid, to_uuid=last_node.uuid,
+                                                             run=run, text=msg.text, created_on=msg.created_on))
+
+            run.path = json.dumps(path)
+            run.current_node_uuid = last_node.uuid
+            run.message_ids = [m.id for m in run_msgs]
+            run.start_msgs = run_msgs
+            msgs += run_msgs
+
+        FlowStep.messages.through.objects.bulk_create(step_msgs)
+        FlowStep.broadcasts.through.objects.bulk_create(step_broadcasts)
+        FlowPathRecentMessage.objects.bulk_create(recent_msgs)
+
+        # update all our runs with their shared state in a single statement
+        run_updates = dict(path=json.dumps(path), current_node_uuid=last_node.uuid, modified_on=now)
+        if timeout:
+            run_updates['timeout_on'] = now + timedelta(minutes=timeout)
+        if completed:
+            run_updates.update(exit_type=FlowRun.EXIT_TYPE_COMPLETED, exited_on=now, is_active=False)
+
+        # runs share a path so for orgs which count paths in the application, count them all at once
+        if self.org.has_app_path_counts():
+            counter = FlowPathCounter(self)
+            counter.add_path_change([], path, True, not completed, count=len([r for r in runs if not r.contact.is_test]))
+
+            with counter.writing():
+                FlowRun.objects.filter(id__in=[r.id for r in runs]).update(**run_updates)
+        else:
+            FlowRun.objects.filter(id__in=[r.id for r in runs]).update(**run_updates)
+
+        for run in runs:
+            for field, value in six.iteritems(run_updates):
+                setattr(run, field, value)
+
+        FlowRun.bulk_set_message_ids([r for r in runs if r.message_ids])
+
+        return msgs
+
     def add_step(self, run, node, msgs=None, exit_uuid=None, category=None, is_start=False, previous_step=None, arrived_on=None):
         if msgs is None:
             msgs = []
@@ -1843,21 +2037,10 @@ class Flow(TembaModel):
         # for each message, associate it with this step and set the label on it
         run.add_messages(msgs, step=step)
 
-        path = run.get_path()
-
-        # complete previous step
-        if path and exit_uuid:
-            path[-1][FlowRun.PATH_EXIT_UUID] = exit_uuid
-
-        # create new step
-        path.append({FlowRun.PATH_NODE_UUID: node.uuid, FlowRun.PATH_ARRIVED_ON: arrived_on.isoformat()})
-
-        # trim path to ensure it can't grow indefinitely
-        if len(path) > FlowRun.PATH_MAX_STEPS:
-            path = path[len(path) - FlowRun.PATH_MAX_STEPS:]
-
-        run.path = json.dumps(path)
-        run.current_node_uuid = path[-1][FlowRun.PATH_NODE_UUID]
+        # complete previous step and create new step, leaving the trigger to count single steps as writing the counts
+        # ourselves would take more queries than it saves
+        run.path = FlowRun.extend_path(run.path, node.uuid, arrived_on, exit_uuid)
+        run.current_node_uuid = node.uuid
         run.save(update_fields=('path', 'current_node_uuid'))
 
         return step
@@ -2734,6 +2917,46 @@ class FlowRun(RequireUpdateFieldsMixin, models.Model):
         else:
             return six.text_type(fields), count + 1
 
+    @classmethod
+    def expire_runs(cls, time_limit=None):
+        """
+        Sweeps expired runs in id-ordered chunks, each exited in its own transaction. Progress is saved in Redis after
+        every chunk, so if a time limit is given and reached, the next sweep resumes from the same place. Returns the
+        number of runs expired.
+        """
+        r = get_redis_connection()
+        start = time.time()
+        cursor = int(r.get(RUN_EXPIRATION_CURSOR_KEY) or 0)
+        num_expired = 0
+
+        while True:
+            chunk_start = time.time()
+            expired = cls.objects.filter(is_active=True, expires_on__lte=timezone.now(), id__gt=cursor).order_by('id')
+            run_ids = list(expired.values_list('id', flat=True)[:RUN_EXPIRATION_CHUNK_SIZE])
+
+            # we've reached the end so the next sweep starts again from the beginning
+            if not run_ids:
+                r.delete(RUN_EXPIRATION_CURSOR_KEY)
+                break
+
+            with transaction.atomic():
+                cls.bulk_exit(cls.objects.filter(id__in=run_ids), cls.EXIT_TYPE_EXPIRED)
+
+            cursor = run_ids[-1]
+            r.set(RUN_EXPIRATION_CURSOR_KEY, cursor, ex=60 * 60 * 24)
+
+            num_expired += len(run_ids)
+
+            chunk_time = time.time() - chunk_start
+            analytics.gauge('temba.run_expirations_chunk', len(run_ids))
+            analytics.gauge('temba.run_expirations_chunk_time', chunk_time)
+            logger.info("Expired %d runs up to #%d in %.3fs" % (len(run_ids), cursor, chunk_time))
+
+            if time_limit and (time.time() - start) > time_limit:
+                break
+
+        return num_expired
+
     @classmethod
     def bulk_exit(cls, runs, exit_type):
         """
@@ -2765,6 +2988,19 @@ class FlowRun(RequireUpdateFieldsMixin, models.Model):
             # continue the parent flows to continue async
             on_transaction_commit(lambda: continue_parent_flows.delay(id_batch))
 
+    @classmethod
+    def bulk_set_message_ids(cls, runs):
+        """
+        Saves the message ids of the given runs with a single statement
+        """
+        if not runs:
+            return
+
+        with db_connection.cursor() as cursor:
+            execute_values(cursor, 'UPDATE flows_flowrun r SET message_ids = v.message_ids '
+                                   'FROM (VALUES %s) AS v(id, message_ids) WHERE r.id = v.id',
+                           [(r.id, r.message_ids) for r in runs], template='(%s, %s::bigint[])')
+
     def add_messages(self, msgs, step=None):
         """
         Associates the given messages with this run
@@ -3087,10 +3323,58 @@ class FlowRun(RequireUpdateFieldsMixin, models.Model):
         return msg
 
     def get_results(self):
-        return json.loads(self.results) if self.results else dict()
+        return self._get_decoded('results', dict)
 
     def get_path(self):
-        return json.loads(self.path) if self.path else []
+        return self._get_decoded('path', list)
+
+    def _get_decoded(self, field, default):
+        """
+        Decodes one of our JSON fields, caching the decoded value against the encoded value so that we only decode it
+        again if the field changes
+        """
+        encoded = getattr(self, field)
+        if not encoded:
+            return default()
+
+        cache_attr = '_decoded_%s' % field
+        cached = self.__dict__.get(cache_attr)
+        if cached and cached[0] is encoded:
+            return cached[1]
+
+        decoded = json.loads(encoded)
+        self.__dict__[cache_attr] = (encoded, decoded)
+        return decoded
+
+    @classmethod
+    def extend_path(cls, path, node_uuid, arrived_on, exit_uuid=None):
+        """
+        Adds a step to an encoded path, setting the exit of the previous step and trimming the path to PATH_MAX_STEPS,
+        and returns the new encoded path. Path steps are flat objects of UUIDs and timestamps which never contain
+        braces, so we can find step boundaries in the encoded path rather than decoding and re-encoding all of it.
+        """
+        step = json.dumps({cls.PATH_NODE_UUID: node_uuid, cls.PATH_ARRIVED_ON: arrived_on.isoformat()})
+
+        steps = path.strip()[1:-1].strip() if path else ''
+        if not steps:
+            return '[%s]' % step
+
+        # complete previous step, which is the only one we need to decode
+        if exit_uuid:
+            last_start = steps.rindex('{')
+            last_step = json.loads(steps[last_start:])
+            last_step[cls.PATH_EXIT_UUID] = exit_uuid
+            steps = steps[:last_start] + json.dumps(last_step)
+
+        # trim path to ensure it can't grow indefinitely
+        num_to_trim = steps.count('{') + 1 - cls.PATH_MAX_STEPS
+        if num_to_trim > 0:
+            start = 0
+            for n in range(num_to_trim):
+                start = steps.index('{', start + 1)
+            steps = steps[start:]
+
+        return '[%s, %s]' % (steps, step)
 
     @classmethod
     def serialize_value(cls, value):
@@ -3111,8 +3395,8 @@ class FlowRun(RequireUpdateFieldsMixin, models.Model):
         # slug our name
         key = Flow.label_to_slug(name)
 
-        # create our result dict
-        results = self.get_results()
+        # create our result dict, copying so we don't modify our cached decoded results
+        results = dict(self.get_results())
         results[key] = {
             FlowRun.RESULT_NAME: name,
             FlowRun.RESULT_NODE_UUID: node_uuid,
@@ -3533,7 +3817,7 @@ class RuleSet(models.Model):
         context = run.flow.build_expressions_context(run.contact, msg, run=run)
 
         if resume_after_timeout:
-            for rule in self.get_rules():
+            for rule in self.get_compiled_rules():
                 if isinstance(rule.test, TimeoutTest):
                     (result, value) = rule.matches(run, msg, context, orig_text)
                     if result > 0:
@@ -3612,7 +3896,7 @@ class RuleSet(models.Model):
                 status_code = 418
 
             # find our matching rule, we pass in the status from our calls
-            for rule in self.get_rules():
+            for rule in self.get_compiled_rules():
                 (result, value) = rule.matches(run, msg, context, str(status_code))
                 if result > 0:
                     return rule, body
@@ -3651,7 +3935,7 @@ class RuleSet(models.Model):
                 text = airtime.status
 
             try:
-                rules = self.get_rules()
+                rules = self.get_compiled_rules()
                 for rule in rules:
                     (result, value) = rule.matches(run, msg, context, text)
                     if result > 0:
@@ -3664,7 +3948,7 @@ class RuleSet(models.Model):
         return None, None  # pragma: no cover
 
     def find_interrupt_rule(self, step, run, msg):
-        rules = self.get_rules()
+        rules = self.get_compiled_rules()
         for rule in rules:
             result, value = rule.matches(run, msg, {}, "")
 
@@ -3691,6 +3975,19 @@ class RuleSet(models.Model):
     def get_rules(self):
         return Rule.from_json_array(self.flow.org, json.loads(self.rules))
 
+    def get_compiled_rules(self):
+        """
+        Gets our rules compiled for matching messages against. These are cached for each revision of our rules so are
+        shared between messages and shouldn't be modified.
+        """
+        rules = compiled_rules_cache.get(self.uuid, self.rules)
+        if rules is None:
+            rules = self.get_rules()
+            KeywordIndex.compile([rule.test for rule in rules])
+            compiled_rules_cache.set(self.uuid, self.rules, rules)
+
+        return rules
+
     def get_rule_uuids(self):  # pragma: needs cover
         return [rule['uuid'] for rule in json.loads(self.rules)]
 
@@ -4013,6 +4310,108 @@ class FlowPathCount(SquashableModel):
         index_together = ['flow', 'from_uuid', 'to_uuid', 'period']
 
 
+class FlowPathCounter(object):
+    """
+    Counts the changes to path and node counts caused by changes to the paths of runs, so that for orgs which count
+    paths in the application, those of batch starts can be aggregated and written in bulk, rather than by the
+    temba_flowrun_path_change trigger for each run, which has to decode both versions of each path and writes one row
+    per step.
+    """
+    def __init__(self, flow):
+        self.flow = flow
+        self.node_counts = defaultdict(int)
+        self.path_counts = defaultdict(int)
+
+    def add_path_change(self, old_path, new_path, was_active, is_active, count=1):
+        """
+        Counts a change to the decoded path of a run (or to the paths of count runs), in the same way as the trigger
+        """
+        if len(new_path) < len(old_path):
+            raise ValueError("Cannot rewind a flow run path")
+
+        if old_path and was_active:
+            self.node_counts[old_path[-1][FlowRun.PATH_NODE_UUID]] -= count
+
+        if new_path and is_active:
+            self.node_counts[new_path[-1][FlowRun.PATH_NODE_UUID]] += count
+
+        # if we have old steps, we start at the end of the old path
+        for p in range(max(len(old_path), 1), len(new_path)):
+            exit_uuid = new_path[p - 1].get(FlowRun.PATH_EXIT_UUID)
+            node_uuid = new_path[p][FlowRun.PATH_NODE_UUID]
+            period = iso8601.parse_date(new_path[p][FlowRun.PATH_ARRIVED_ON]).astimezone(timezone.utc)
+
+            self.path_counts[(exit_uuid, node_uuid, period.replace(minute=0, second=0, microsecond=0))] += count
+
+    @contextmanager
+    def writing(self):
+        """
+        Context manager for writing the run changes we've counted, during which the trigger is told to ignore them, and
+        after which we write our counts in the same transaction
+        """
+        with transaction.atomic():
+            self._set_trigger_mode('app')
+            yield
+
+            # the mode outlives our savepoint so has to be reset here, whereas if the block fails, rolling back our
+            # savepoint reverts it
+            self._set_trigger_mode('')
+            self.save()
+
+    @staticmethod
+    def _set_trigger_mode(mode):
+        with db_connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('temba.path_counts', %s, TRUE)", [mode])
+
+    def save(self):
+        FlowNodeCount.objects.bulk_create([
+            FlowNodeCount(flow=self.flow, node_uuid=node_uuid, count=count)
+            for node_uuid, count in six.iteritems(self.node_counts) if count
+        ])
+        FlowPathCount.objects.bulk_create([
+            FlowPathCount(flow=self.flow, from_uuid=from_uuid, to_uuid=to_uuid, period=period, count=count)
+            for (from_uuid, to_uuid, period), count in six.iteritems(self.path_counts) if count
+        ])
+
+        self.node_counts.clear()
+        self.path_counts.clear()
+
+    @classmethod
+    def check_flow(cls, flow):
+        """
+        Checks the path and node counts of the given flow against counts calculated from the paths of its runs, which
+        is what either counting mode should produce. Steps trimmed from long paths were counted but can't be seen,
+        so the returned number of runs with trimmed paths should be taken into account when interpreting differences.
+
+        @returns tuple of dicts of mismatched node counts and path counts, keyed like get_totals, each value being a
+        tuple of the stored and expected counts, and the number of runs with trimmed paths
+        """
+        counter = cls(flow)
+        num_trimmed = 0
+
+        runs = FlowRun.objects.filter(flow=flow, contact__is_test=False).exclude(path=None).only('path', 'is_active')
+        for run in runs.iterator():
+            path = run.get_path()
+            counter.add_path_change([], path, True, run.is_active)
+
+            if len(path) >= FlowRun.PATH_MAX_STEPS:
+                num_trimmed += 1
+
+        expected_nodes = {six.text_type(node_uuid): count for node_uuid, count in six.iteritems(counter.node_counts) if count}
+        expected_paths = defaultdict(int)
+        for (from_uuid, to_uuid, period), count in six.iteritems(counter.path_counts):
+            expected_paths['%s:%s' % (from_uuid, to_uuid)] += count
+
+        def diff(stored, expected):
+            return {key: (stored.get(key, 0), expected.get(key, 0)) for key in set(stored) | set(expected)
+                    if stored.get(key, 0) != expected.get(key, 0)}
+
+        stored_paths = {key: count for key, count in six.iteritems(FlowPathCount.get_totals(flow)) if count}
+        expected_paths = {key: count for key, count in six.iteritems(expected_paths) if count}
+
+        return diff(FlowNodeCount.get_totals(flow), expected_nodes), diff(stored_paths, expected_paths), num_trimmed
+
+
 class FlowPathRecentMessage(models.Model):
     """
     Maintains recent messages for a flow path segment. Doesn't store references to actual steps or messages as these
@@ -4185,6 +4584,8 @@ class ExportFlowResultsTask(BaseExportTask):
     RESPONDED_ONLY = 'responded_only'
     EXTRA_URNS = 'extra_urns'
 
+    EXPORT_BATCH_SIZE = 1000
+
     flows = models.ManyToManyField(Flow, related_name='exports', help_text=_("The flows to export"))
 
     config = models.TextField(null=True,
@@ -4331,28 +4732,36 @@ class ExportFlowResultsTask(BaseExportTask):
         contacts_sheet = self._add_contacts_sheet(book, contacts_columns)
         msgs_sheet = None
 
-        # grab the ids of the runs we're going to be exporting..
+        # stream the ids of the runs we're going to be exporting from a server-side cursor, rather than holding them
+        # all in memory. These are ordered by contact so that we can merge each contact's runs as we go.
         runs = FlowRun.objects.filter(flow__in=flows).order_by('contact', 'id')
         if responded_only:
             runs = runs.filter(responded=True)
-        run_ids = array(str('l'), runs.values_list('id', flat=True))
+        run_ids = runs.values_list('id', flat=True).iterator()
+
+        user_groups = ContactGroup.all_groups.filter(group_type=ContactGroup.TYPE_USER_DEFINED).only('id', 'name', 'group_type')
 
         # for tracking performance
         runs_exported = 0
         start = time.time()
 
-        for id_batch in chunk_list(run_ids, 1000):
-            run_batch = (
+        for id_batch in chunk_list(run_ids, self.EXPORT_BATCH_SIZE):
+            run_batch = list(
                 FlowRun.objects.filter(id__in=id_batch, contact__is_test=False)
                 .prefetch_related(
                     'contact',
+                    Prefetch('contact__all_groups', user_groups),
                     Prefetch('steps', FlowStep.objects.only('id', 'run')),
                     'steps__messages__contact_urn',
                     'steps__messages__channel'
                 )
+                .select_related('submitted_by')
                 .order_by('contact', 'id')
             )
 
+            # fetch the field values and URNs of this batch's contacts in one go
+            Contact.bulk_cache_initialize(self.org, list({run.contact for run in run_batch}))
+
             for run in run_batch:
                 # is this a new contact?
                 if run.contact != current_contact:
@@ -4425,8 +4834,9 @@ class ExportFlowResultsTask(BaseExportTask):
 
                 runs_exported += 1
                 if runs_exported % 10000 == 0:  # pragma: needs cover
-                    print("Result export of for org #%d - %d%% complete in %0.2fs" %
-                          (self.org.id, runs_exported * 100 / len(run_ids), time.time() - start))
+                    elapsed = time.time() - start
+                    print("Result export for org #%d - %d runs exported in %0.2fs (%d runs/sec)" %
+                          (self.org.id, runs_exported, elapsed, runs_exported / elapsed))
 
         if current_contact:
             merged_sheet_row = []
@@ -6342,6 +6752,95 @@ class NotEmptyTest(Test):
         return 0, None
 
 
+def tokenize_text(text):
+    """
+    Tokenizes the given text, returning its lowercase and original tokens. The last text tokenized by each thread is
+    remembered so that all the tests of a ruleset share a single tokenization of a message.
+    """
+    last = getattr(_last_tokenized, 'value', None)
+    if last is None or last[0] != text:
+        last = (text, (tokenize(text.lower()), tokenize(text)))
+        _last_tokenized.value = last
+
+    return last[1]
+
+
+_last_tokenized = threading.local()
+
+
+class KeywordIndex(object):
+    """
+    An index of the static keywords of the contains tests in a ruleset, so that a message is tokenized and matched
+    against all of them in a single pass. Words are looked up directly, and longer words are compared only against
+    keywords of a similar length with the same first letter, which gives the same matches as ContainsTest.test_in_words.
+    """
+    def __init__(self, tests):
+        self.tokens = {}
+        self.keywords = set()
+        self.fuzzy_keywords = defaultdict(list)
+
+        for test in tests:
+            localized = test.test.values() if isinstance(test.test, dict) else [test.test]
+            for text in localized:
+                if isinstance(text, six.string_types) and text.find('@') < 0 and text not in self.tokens:
+                    self.tokens[text] = [t for t in tokenize(text.lower()) if t != '']
+                    self.keywords.update(self.tokens[text])
+
+        for keyword in self.keywords:
+            if len(keyword) > 4:
+                self.fuzzy_keywords[(keyword[0], len(keyword))].append(keyword)
+
+    @classmethod
+    def compile(cls, tests):
+        """
+        Indexes the keywords of the given tests, including those nested in and/or tests
+        """
+        contains_tests = []
+        while tests:
+            test = tests.pop()
+            if isinstance(test, (AndTest, OrTest)):
+                tests += test.tests
+            elif type(test) in (ContainsTest, ContainsAnyTest):
+                contains_tests.append(test)
+
+        if contains_tests:
+            index = cls(contains_tests)
+            for test in contains_tests:
+                test.keyword_index = index
+
+    def find(self, text):
+        """
+        Finds our keywords in the given text, returning its raw words and a map of each keyword found to the indexes of
+        the words it matched
+        """
+        # indexes are shared between threads by the compiled rules cache, so the last result is remembered per thread
+        last = getattr(_last_found, 'value', None)
+        if last is None or last[0] is not self or last[1] != text:
+            words, raw_words = tokenize_text(text)
+            words = [elt for elt in words if elt != '']
+            raw_words = [elt for elt in raw_words if elt != '']
+
+            found = defaultdict(list)
+            for index, word in enumerate(words):
+                if word in self.keywords:
+                    found[word].append(index)
+
+                # words are over 4 characters and start with the same letter with an edit distance of 1 or less
+                if len(word) > 4:
+                    for length in (len(word) - 1, len(word), len(word) + 1):
+                        for keyword in self.fuzzy_keywords.get((word[0], length), ()):
+                            if keyword != word and edit_distance(word, keyword) <= 1:
+                                found[keyword].append(index)
+
+            last = (self, text, (raw_words, found))
+            _last_found.value = last
+
+        return last[2]
+
+
+_last_found = threading.local()
+
+
 class ContainsTest(Test):
     """
     { op: "contains", "test": "red" }
@@ -6351,6 +6850,7 @@ class ContainsTest(Test):
 
     def __init__(self, test):
         self.test = test
+        self.keyword_index = None
 
     @classmethod
     def from_json(cls, org, json):
@@ -6375,27 +6875,41 @@ class ContainsTest(Test):
 
         return matches
 
-    def evaluate(self, run, sms, context, text):
-        # substitute any variables
+    def match_tests(self, run, context, text):
+        """
+        Tokenizes our test and the given text, returning our test words, the raw words of the text and the indexes of
+        the words matched by each of our test words
+        """
         test = run.flow.get_localized_text(self.test, run.contact)
+
+        # if our test is static we can use the keyword index of our ruleset
+        tests = self.keyword_index.tokens.get(test) if self.keyword_index else None
+        if tests is not None:
+            raw_words, found = self.keyword_index.find(text)
+            return tests, raw_words, [found.get(t, []) for t in tests]
+
+        # substitute any variables
         test, errors = Msg.evaluate_template(test, context, org=run.flow.org)
 
         # tokenize our test
         tests = tokenize(test.lower())
 
         # tokenize our sms
-        words = tokenize(text.lower())
-        raw_words = tokenize(text)
+        words, raw_words = tokenize_text(text)
 
         tests = [elt for elt in tests if elt != '']
         words = [elt for elt in words if elt != '']
         raw_words = [elt for elt in raw_words if elt != '']
 
+        return tests, raw_words, [self.test_in_words(t, words, raw_words) for t in tests]
+
+    def evaluate(self, run, sms, context, text):
+        tests, raw_words, test_matches = self.match_tests(run, context, text)
+
         # run through each of our tests
         matches = set()
         matched_tests = 0
-        for test in tests:
-            match = self.test_in_words(test, words, raw_words)
+        for match in test_matches:
             if match:
                 matched_tests += 1
                 matches.update(match)
@@ -6446,25 +6960,11 @@ class ContainsAnyTest(ContainsTest):
         return dict(type=ContainsAnyTest.TYPE, test=self.test)
 
     def evaluate(self, run, sms, context, text):
-        # substitute any variables
-        test = run.flow.get_localized_text(self.test, run.contact)
-        test, errors = Msg.evaluate_template(test, context, org=run.flow.org)
-
-        # tokenize our test
-        tests = tokenize(test.lower())
-
-        # tokenize our sms
-        words = tokenize(text.lower())
-        raw_words = tokenize(text)
-
-        tests = [elt for elt in tests if elt != '']
-        words = [elt for elt in words if elt != '']
-        raw_words = [elt for elt in raw_words if elt != '']
+        tests, raw_words, test_matches = self.match_tests(run, context, text)
 
         # run through each of our tests
         matches = set()
-        for test in tests:
-            match = self.test_in_words(test, words, raw_words)
+        for match in test_matches:
             if match:
                 matches.update(match)
 
@@ -6496,8 +6996,7 @@ class ContainsOnlyPhraseTest(ContainsTest):
         tests = tokenize(test.lower())
 
         # tokenize our sms
-        words = tokenize(text.lower())
-        raw_words = tokenize(text)
+        words, raw_words = tokenize_text(text)
 
         # they are the same? then we matched
         if tests == words:
@@ -6525,8 +7024,7 @@ class ContainsPhraseTest(ContainsTest):
         tests = tokenize(test.lower())
 
         # tokenize our sms
-        words = tokenize(text.lower())
-        raw_words = tokenize(text)
+        words, raw_words = tokenize_text(text)
 
         # look for the phrase
         test_idx = 0
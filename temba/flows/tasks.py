@@ -1,21 +1,43 @@
 from __future__ import print_function, unicode_literals
 
 import logging
+import six
 import time
 
 from celery.task import task
+from collections import defaultdict
 from django.utils import timezone
 from temba.msgs.models import Broadcast, Msg, TIMEOUT_EVENT, HANDLER_QUEUE, HANDLE_EVENT_TASK
 from temba.orgs.models import Org
+from temba.utils import chunk_list
 from temba.utils.cache import QueueRecord
 from temba.utils.dates import datetime_to_epoch
-from temba.utils.queues import start_task, complete_task, push_task, nonoverlapping_task
-from .models import ExportFlowResultsTask, Flow, FlowStart, FlowRun, FlowStep
+from temba.utils.queues import start_tasks, complete_task, push_task, nonoverlapping_task
+from .models import ExportFlowResultsTask, Flow, FlowStart, FlowRun
 from .models import FlowRunCount, FlowNodeCount, FlowPathCount, FlowPathRecentMessage, FlowCategoryCount
 
 FLOW_TIMEOUT_KEY = 'flow_timeouts_%y_%m_%d'
 logger = logging.getLogger(__name__)
 
+# the maximum number of start batches a single flow start task will pop off our queue at once. A celery task is still
+# sent for each batch that is queued, so this saves queue round trips and lets one worker take a burst of batches, but
+# doesn't reduce the number of task invocations, those which find the queue already drained return straight away.
+START_MSG_FLOW_BATCH_TASK_SIZE = 5
+
+# the maximum number of run timeouts queued in a single handler event, kept small enough that resuming them all fits in
+# the time a handler task allows for each event
+TIMEOUT_BATCH_SIZE = 5
+
+# how long a run expiration sweep can hold its lock
+CHECK_FLOWS_LOCK_TIMEOUT = 900
+
+
+def get_queued_timeouts():
+    """
+    Gets the record of which run timeouts, as tuples of run id and timeout, have been queued for handling
+    """
+    return QueueRecord('flow_timeouts', lambda t: '%d:%d' % (t[0], datetime_to_epoch(t[1])))
+
 
 @task(track_started=True, name='send_email_action_task')
 def send_email_action_task(org_id, recipients, subject, message):
@@ -29,20 +51,19 @@ def update_run_expirations_task(flow_id):
     """
     Update all of our current run expirations according to our new expiration period
     """
-    for step in FlowStep.objects.filter(run__flow__id=flow_id, run__is_active=True, left_on=None).distinct('run'):  # pragma: needs cover
-        step.run.update_expiration(step.arrived_on)
+    Flow.objects.get(id=flow_id).update_run_expirations()
 
     # force an expiration update
     check_flows_task.apply()
 
 
-@nonoverlapping_task(track_started=True, name='check_flows_task', lock_key='check_flows')  # pragma: no cover
+@nonoverlapping_task(track_started=True, name='check_flows_task', lock_key='check_flows', lock_timeout=CHECK_FLOWS_LOCK_TIMEOUT)  # pragma: no cover
 def check_flows_task():
     """
     See if any flow runs need to be expired
     """
-    runs = FlowRun.objects.filter(is_active=True, expires_on__lte=timezone.now())
-    FlowRun.bulk_exit(runs, FlowRun.EXIT_TYPE_EXPIRED)
+    # stop well before our lock could expire, the next sweep will pick up where this one stopped
+    FlowRun.expire_runs(time_limit=CHECK_FLOWS_LOCK_TIMEOUT / 2)
 
 
 @nonoverlapping_task(track_started=True, name='check_flow_timeouts_task', lock_key='check_flow_timeouts', lock_timeout=3600)  # pragma: no cover
@@ -51,21 +72,31 @@ def check_flow_timeouts_task():
     See if any flow runs have timed out
     """
     # find any runs that should have timed out
-    runs = FlowRun.objects.filter(is_active=True, timeout_on__lte=timezone.now())
-    runs = runs.only('id', 'org', 'timeout_on')
+    runs = FlowRun.objects.filter(is_active=True, timeout_on__lte=timezone.now()).order_by('org_id', 'timeout_on')
+    runs = runs.values_list('id', 'org_id', 'timeout_on')
 
-    queued_timeouts = QueueRecord('flow_timeouts', lambda r: '%d:%d' % (r.id, datetime_to_epoch(r.timeout_on)))
+    queued_timeouts = get_queued_timeouts()
 
+    # group runs by org, as that's how the handler queue is partitioned
+    timeouts_by_org = defaultdict(list)
     for run in runs:
-        # ignore any run which was locked by previous calls to this task
-        if not queued_timeouts.is_queued(run):
-            try:
-                task_payload = dict(type=TIMEOUT_EVENT, run=run.id, timeout_on=run.timeout_on)
-                push_task(run.org_id, HANDLER_QUEUE, HANDLE_EVENT_TASK, task_payload)
+        timeouts_by_org[run[1]].append(run)
+
+    for org_id, org_timeouts in six.iteritems(timeouts_by_org):
+        for timeout_batch in chunk_list(org_timeouts, TIMEOUT_BATCH_SIZE):
+
+            # ignore any run which was locked by previous calls to this task
+            timeout_batch = queued_timeouts.filter_unqueued([(r[0], r[2]) for r in timeout_batch])
+
+            if timeout_batch:
+                try:
+                    task_payload = dict(type=TIMEOUT_EVENT, timeouts=timeout_batch)
+                    push_task(org_id, HANDLER_QUEUE, HANDLE_EVENT_TASK, task_payload)
 
-                queued_timeouts.set_queued([run])
-            except Exception:  # pragma: no cover
-                logger.error("Error queuing timeout task for run #%d" % run.id, exc_info=True)
+                    queued_timeouts.set_queued(timeout_batch)
+                except Exception:  # pragma: no cover
+                    run_ids_str = ','.join(six.text_type(t[0]) for t in timeout_batch)
+                    logger.error("Error queuing timeout tasks for runs: %s" % run_ids_str, exc_info=True)
 
 
 @task(track_started=True, name='continue_parent_flows')  # pragma: no cover
@@ -96,35 +127,49 @@ def start_flow_task(start_id):
 
 @task(track_started=True, name='start_msg_flow_batch')
 def start_msg_flow_batch_task():
-    # pop off the next task
-    org_id, task_obj = start_task(Flow.START_MSG_FLOW_BATCH)
+    # pop off the next tasks
+    org_id, task_objs = start_tasks(Flow.START_MSG_FLOW_BATCH, START_MSG_FLOW_BATCH_TASK_SIZE)
 
-    # it is possible that somehow we might get None back if more workers were started than tasks got added, bail if so
-    if task_obj is None:  # pragma: needs cover
+    # it is possible that somehow we might get nothing back if more workers were started than tasks got added, bail if so
+    if not task_objs:  # pragma: needs cover
         return
 
-    start = time.time()
-
     try:
-        # instantiate all the objects we need that were serialized as JSON
-        flow = Flow.objects.filter(pk=task_obj['flow'], is_active=True).first()
-        if not flow:  # pragma: needs cover
-            return
-
-        broadcasts = [] if not task_obj['broadcasts'] else Broadcast.objects.filter(pk__in=task_obj['broadcasts'])
-        started_flows = [] if not task_obj['started_flows'] else task_obj['started_flows']
-        start_msg = None if not task_obj['start_msg'] else Msg.objects.filter(id=task_obj['start_msg']).first()
-        extra = task_obj['extra']
-        flow_start = None if not task_obj['flow_start'] else FlowStart.objects.filter(pk=task_obj['flow_start']).first()
-        contacts = task_obj['contacts']
-
-        # and go do our work
-        flow.start_msg_flow_batch(contacts, broadcasts=broadcasts,
-                                  started_flows=started_flows, start_msg=start_msg,
-                                  extra=extra, flow_start=flow_start)
+        while task_objs:
+            task_obj = task_objs.pop(0)
+            try:
+                start_msg_flow_batch(task_obj)
+            except Exception:
+                logger.error('Failed starting flow batch for flow %d' % task_obj['flow'], exc_info=1,
+                             extra={'stack': True})
     finally:
         complete_task(Flow.START_MSG_FLOW_BATCH, org_id)
 
+        # requeue any batches we didn't get to, so they can be started by another worker
+        for task_obj in task_objs:  # pragma: no cover
+            push_task(org_id, 'flows', Flow.START_MSG_FLOW_BATCH, task_obj)
+
+
+def start_msg_flow_batch(task_obj):
+    start = time.time()
+
+    # instantiate all the objects we need that were serialized as JSON
+    flow = Flow.objects.filter(pk=task_obj['flow'], is_active=True).first()
+    if not flow:  # pragma: needs cover
+        return
+
+    broadcasts = [] if not task_obj['broadcasts'] else Broadcast.objects.filter(pk__in=task_obj['broadcasts'])
+    started_flows = [] if not task_obj['started_flows'] else task_obj['started_flows']
+    start_msg = None if not task_obj['start_msg'] else Msg.objects.filter(id=task_obj['start_msg']).first()
+    extra = task_obj['extra']
+    flow_start = None if not task_obj['flow_start'] else FlowStart.objects.filter(pk=task_obj['flow_start']).first()
+    contacts = task_obj['contacts']
+
+    # and go do our work
+    flow.start_msg_flow_batch(contacts, broadcasts=broadcasts,
+                              started_flows=started_flows, start_msg=start_msg,
+                              extra=extra, flow_start=flow_start)
+
     print("Started batch of %d contacts in flow %d [%d] in %0.3fs"
           % (len(contacts), flow.id, flow.org_id, time.time() - start))
 
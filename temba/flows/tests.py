@@ -18,13 +18,15 @@ from openpyxl import load_workbook
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.test.utils import override_settings
+from django.db import connection, transaction
+from django.test.utils import override_settings, CaptureQueriesContext
 from django.utils import timezone
+from django_redis import get_redis_connection
 
 from temba.airtime.models import AirtimeTransfer
 from temba.api.models import WebHookEvent, WebHookResult, Resthook
 from temba.channels.models import Channel, ChannelEvent
-from temba.contacts.models import Contact, ContactGroup, ContactField, ContactURN, URN, TEL_SCHEME
+from temba.contacts.models import Contact, ContactGroup, ContactField, ContactURN, URN, TEL_SCHEME, contact_state_cache
 from temba.ivr.models import IVRCall
 from temba.ussd.models import USSDSession
 from temba.locations.models import AdminBoundary, BoundaryAlias
@@ -34,6 +36,7 @@ from temba.tests import TembaTest, MockResponse, FlowFileTest
 from temba.triggers.models import Trigger
 from temba.utils.dates import datetime_to_str
 from temba.utils.profiler import QueryTracker
+from temba.utils.queues import push_task, start_tasks
 from temba.values.models import Value
 
 from .flow_migrations import (
@@ -42,19 +45,20 @@ from .flow_migrations import (
     migrate_to_version_11_2, map_actions
 )
 from .models import (
-    Flow, FlowStep, FlowRun, FlowLabel, FlowStart, FlowRevision, FlowException, ExportFlowResultsTask, ActionSet,
-    RuleSet, Action, Rule, FlowRunCount, FlowPathCount, InterruptTest, get_flow_user, FlowCategoryCount,
+    RUN_EXPIRATION_CURSOR_KEY, Flow, FlowStep, FlowRun, FlowLabel, FlowStart, FlowRevision, FlowException, ExportFlowResultsTask, ActionSet,
+    RuleSet, Action, Rule, FlowRunCount, FlowPathCount, FlowPathCounter, InterruptTest, get_flow_user, FlowCategoryCount,
     FlowPathRecentMessage, Test, TrueTest, FalseTest, AndTest, OrTest, PhoneTest, NumberTest, EqTest, LtTest, LteTest,
     GtTest, GteTest, BetweenTest, ContainsOnlyPhraseTest, ContainsPhraseTest, DateEqualTest, DateAfterTest,
     DateBeforeTest, DateTest, StartsWithTest, ContainsTest, ContainsAnyTest, RegexTest, NotEmptyTest, HasStateTest,
     HasDistrictTest, HasWardTest, HasEmailTest, SendAction, AddLabelAction, AddToGroupAction, ReplyAction,
     SaveToContactAction, SetLanguageAction, SetChannelAction, EmailAction, StartFlowAction, TriggerFlowAction,
     DeleteFromGroupAction, WebhookAction, ActionLog, VariableContactAction, UssdAction,
-    FlowUserConflictException, FlowVersionConflictException, FlowInvalidCycleException
+    FlowUserConflictException, FlowVersionConflictException, FlowInvalidCycleException, KeywordIndex
 )
 
 from .views import FlowCRUDL
 from .tasks import update_run_expirations_task, prune_recentmessages, squash_flowruncounts, squash_flowpathcounts
+from .tasks import start_msg_flow_batch_task
 
 
 class FlowTest(TembaTest):
@@ -946,6 +950,30 @@ class FlowTest(TembaTest):
                                             contact1_out2.created_on, "OUT",
                                             "That is a funny color. Try again.", "Test Channel"], tz)
 
+    def test_export_results_queries(self):
+        self.create_group('Devs', [self.contact, self.contact2, self.contact3, self.contact4])
+
+        def export_queries(contacts):
+            for contact in contacts:
+                self.flow.start([], [contact], restart_participants=True)
+                Flow.find_and_handle(self.create_msg(direction=INCOMING, contact=contact, text="red"))
+
+            contact_state_cache.clear()
+
+            with CaptureQueriesContext(connection) as queries:
+                workbook = self.export_flow_results(self.flow)
+
+            return len(queries), workbook
+
+        num_queries, workbook = export_queries([self.contact, self.contact2])
+        self.assertEqual(3, len(list(workbook.worksheets[1].rows)))
+
+        # exporting more contacts doesn't mean more queries, as contacts, groups, fields and messages are all fetched
+        # per batch of runs
+        more_num_queries, workbook = export_queries([self.contact3, self.contact4])
+        self.assertEqual(5, len(list(workbook.worksheets[1].rows)))
+        self.assertEqual(num_queries, more_num_queries)
+
     def test_export_results_remove_control_characters(self):
         contact1_run1 = self.flow.start([], [self.contact])[0]
 
@@ -1269,6 +1297,55 @@ class FlowTest(TembaTest):
             expected_tz = expected_value.astimezone(tz)
             self.assertTrue(abs((expected_tz - value).total_seconds()) < 60, "%s does not match expected %s" % (value, expected_tz))
 
+    def test_keyword_index(self):
+        self.sms = self.create_msg(contact=self.contact, text="")
+
+        def create_tests():
+            return [
+                ContainsTest(test=dict(base="Green")),
+                ContainsTest(test=dict(base="red red, blue")),
+                ContainsAnyTest(test=dict(base="klab Kacyiru good")),
+                ContainsAnyTest(test=dict(base="colour yello", fre="jaune")),
+                ContainsAnyTest(test=dict(base="@contact.name")),
+                OrTest([FalseTest(), ContainsAnyTest(test=dict(base="purple violet"))]),
+                ContainsPhraseTest(test=dict(base="kLab is")),
+            ]
+
+        indexed_tests = create_tests()
+        KeywordIndex.compile(list(indexed_tests))
+
+        self.assertIsNone(indexed_tests[4].keyword_index.tokens.get("@contact.name"))
+        self.assertEqual(['red', 'red', 'blue'], indexed_tests[1].keyword_index.tokens["red red, blue"])
+        self.assertEqual(indexed_tests[0].keyword_index, indexed_tests[5].tests[1].keyword_index)
+
+        texts = ["GReen is my favorite!", "kLab is good", "the color is yelow", "RED and blue", "red, or is it blu",
+                 "Eric likes the colours and purpl", "violets are green", "", "   ", "Greenish yellowy"]
+
+        run = FlowRun.create(self.flow, self.contact)
+        context = run.flow.build_expressions_context(run.contact, None)
+
+        self.assertEqual((1, "color"), indexed_tests[3].evaluate(run, self.sms, context, "the color is yelow"))
+
+        # indexed tests should give exactly the same results as unindexed tests
+        for text in texts:
+            for indexed_test, test in zip(indexed_tests, create_tests()):
+                self.assertEqual(test.evaluate(run, self.sms, context, text),
+                                 indexed_test.evaluate(run, self.sms, context, text))
+
+        # rulesets compile their rules once per revision
+        ruleset = RuleSet.objects.filter(flow=self.flow).first()
+        rules = ruleset.get_compiled_rules()
+        self.assertIs(rules, RuleSet.objects.get(id=ruleset.id).get_compiled_rules())
+
+        rules_json = ruleset.get_rules_dict()
+        rules_json[0]['category']['base'] = "Other Color"
+        ruleset.rules = json.dumps(rules_json)
+        ruleset.save(update_fields=('rules',))
+
+        new_rules = RuleSet.objects.get(id=ruleset.id).get_compiled_rules()
+        self.assertIsNot(rules, new_rules)
+        self.assertEqual("Other Color", new_rules[0].category['base'])
+
     def test_location_tests(self):
         sms = self.create_msg(contact=self.contact, text="")
         self.sms = sms
@@ -4902,6 +4979,102 @@ class FlowsTest(FlowFileTest):
         squash_flowruncounts()
         self.assertEqual(max_id, FlowRunCount.objects.all().order_by('-id').first().id)
 
+    @patch('temba.flows.models.FlowRunCount.SQUASH_MIN_BATCH_SIZE', 2)
+    @patch('temba.flows.models.FlowRunCount.SQUASH_STATEMENTS_PER_QUERY', 2)
+    def test_squash_run_counts_in_batches(self):
+        flows = [self.get_flow('favorites'), self.get_flow('pick_a_number'), self.get_flow('color')]
+        for flow in flows:
+            for exit_type in (None, 'C', 'I'):
+                FlowRunCount.objects.create(flow=flow, count=2, exit_type=exit_type)
+                FlowRunCount.objects.create(flow=flow, count=1, exit_type=exit_type)
+
+        # if we run out of time, we report how many rows are still unsquashed
+        with patch('temba.utils.analytics.gauge') as mock_gauge:
+            self.assertEqual(FlowRunCount.squash(time_limit=0), 18)
+
+            mock_gauge.assert_called_once_with('temba.squash_lag.flowruncount', 18)
+
+        # otherwise we keep squashing in growing batches until we catch up
+        self.assertEqual(FlowRunCount.squash(), 0)
+        self.assertEqual(FlowRunCount.objects.count(), 9)
+        self.assertFalse(FlowRunCount.get_unsquashed().exists())
+
+        for flow in flows:
+            self.assertEqual(FlowRunCount.get_totals(flow), {'A': 3, 'C': 3, 'E': 0, 'I': 3})
+
+    def test_app_path_counts(self):
+        flow = self.get_flow('favorites')
+
+        # take one contact through the flow with path counts written by the trigger
+        for text in ('chartreuse', 'blue', 'primus'):
+            self.send_message(flow, text)
+
+        trigger_active, trigger_visited = flow.get_activity()
+
+        # and another through the same steps for an org which counts paths itself, which still leaves single steps to the trigger
+        self.org.set_app_path_counts(True)
+
+        ryan = self.create_contact('Ryan Lewis', '+12065550725')
+        for text in ('chartreuse', 'blue', 'primus'):
+            self.send_message(flow, text, contact=ryan)
+
+        active, visited = flow.get_activity()
+        self.assertEqual(active, {node_uuid: count * 2 for node_uuid, count in six.iteritems(trigger_active)})
+        self.assertEqual(visited, {path: count * 2 for path, count in six.iteritems(trigger_visited)})
+
+        # batch starts count all of their runs at once
+        contacts = [self.create_contact('Contact %d' % i, '+12065551%03d' % i) for i in range(3)]
+        flow.start([], contacts, restart_participants=True)
+
+        active, visited = flow.get_activity()
+        color_question = ActionSet.objects.get(y=0, flow=flow)
+        color = RuleSet.objects.get(label='Color', flow=flow)
+        self.assertEqual(active[color.uuid], 3)
+        self.assertEqual(visited['%s:%s' % (color_question.exit_uuid, color.uuid)], 5)
+
+        # counts from both modes are consistent with the paths of the runs
+        self.assertEqual(FlowPathCounter.check_flow(flow), ({}, {}, 0))
+
+        # a mismatch is reported
+        FlowPathCount.objects.create(flow=flow, from_uuid=color_question.exit_uuid, to_uuid=color.uuid,
+                                     period=timezone.now(), count=1)
+
+        self.assertEqual(FlowPathCounter.check_flow(flow), ({}, {'%s:%s' % (color_question.exit_uuid, color.uuid): (6, 5)}, 0))
+
+        def paths_counted():
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT temba_flowrun_paths_counted()')
+                return cursor.fetchone()[0]
+
+        self.assertFalse(paths_counted())
+
+        # the trigger goes back to counting paths if writing fails and the caller carries on
+        with transaction.atomic():
+            try:
+                with FlowPathCounter(flow).writing():
+                    self.assertTrue(paths_counted())
+                    raise ValueError("boom")
+            except ValueError:
+                pass
+
+            self.assertFalse(paths_counted())
+
+        with FlowPathCounter(flow).writing():
+            self.assertTrue(paths_counted())
+
+        self.assertFalse(paths_counted())
+
+        # writing takes the same number of queries however many runs and steps have been counted, i.e. savepoint, set
+        # mode, update runs, reset mode, insert node counts, insert path counts and release savepoint
+        counter = FlowPathCounter(flow)
+        counter.add_path_change([], FlowRun.objects.get(contact=ryan).get_path(), True, True, count=10)
+
+        with self.assertNumQueries(7):
+            with counter.writing():
+                FlowRun.objects.filter(flow=flow).update(modified_on=timezone.now())
+
+        self.assertFalse(paths_counted())
+
     def test_activity(self):
         flow = self.get_flow('favorites')
         color_question = ActionSet.objects.get(y=0, flow=flow)
@@ -5975,6 +6148,31 @@ class FlowsTest(FlowFileTest):
         run.update_expiration(None)
         self.assertTrue(run.expires_on > previous_expiration)
 
+    def test_expire_runs(self):
+        flow = self.get_flow('favorites')
+        contacts = [self.create_contact("Contact %d" % c, "+25078855555%d" % c) for c in range(3)]
+        flow.start([], contacts)
+
+        runs = list(FlowRun.objects.filter(flow=flow).order_by('id'))
+        FlowRun.objects.all().update(expires_on=timezone.now() - timedelta(minutes=1))
+
+        r = get_redis_connection()
+
+        # sweep with chunks of 2 runs and a time limit which stops us after the first chunk
+        with patch('temba.flows.models.RUN_EXPIRATION_CHUNK_SIZE', 2):
+            self.assertEqual(FlowRun.expire_runs(time_limit=0.000001), 2)
+
+            self.assertEqual(int(r.get(RUN_EXPIRATION_CURSOR_KEY)), runs[1].id)
+            self.assertEqual(FlowRun.objects.filter(is_active=False, exit_type=FlowRun.EXIT_TYPE_EXPIRED).count(), 2)
+
+            # next sweep resumes from where we stopped and resets the cursor once it reaches the end
+            self.assertEqual(FlowRun.expire_runs(time_limit=0.000001), 1)
+            self.assertEqual(FlowRun.expire_runs(time_limit=0.000001), 0)
+
+        self.assertIsNone(r.get(RUN_EXPIRATION_CURSOR_KEY))
+        self.assertEqual(FlowRun.objects.filter(is_active=True).count(), 0)
+        self.assertEqual(FlowStep.objects.filter(run__in=runs, left_on=None).count(), 0)
+
     def test_parsing(self):
         # test a preprocess url
         flow = self.get_flow('preprocess')
@@ -6680,6 +6878,41 @@ class FlowsTest(FlowFileTest):
         ])
         self.assertEqual(str(run.current_node_uuid), beerRuleSet.uuid)
 
+    @patch('temba.flows.models.FlowRun.PATH_MAX_STEPS', 3)
+    def test_extend_path(self):
+        arrived_on = datetime.datetime(2017, 10, 1, 12, 0, 0, tzinfo=pytz.UTC)
+
+        def extend_decoded(path, node_uuid, exit_uuid=None):
+            path = json.loads(path) if path else []
+            if path and exit_uuid:
+                path[-1]['exit_uuid'] = exit_uuid
+            path.append({'node_uuid': node_uuid, 'arrived_on': arrived_on.isoformat()})
+            return path[-FlowRun.PATH_MAX_STEPS:]
+
+        path = None
+        for n in range(6):
+            exit_uuid = 'exit-%d' % n if n % 2 else None
+            expected = extend_decoded(path, 'node-%d' % n, exit_uuid)
+            path = FlowRun.extend_path(path, 'node-%d' % n, arrived_on, exit_uuid)
+
+            self.assertEqual(json.loads(path), expected)
+
+        self.assertEqual([s['node_uuid'] for s in json.loads(path)], ['node-3', 'node-4', 'node-5'])
+        self.assertEqual(FlowRun.extend_path('[]', 'node-1', arrived_on), json.dumps([
+            {'node_uuid': 'node-1', 'arrived_on': arrived_on.isoformat()}
+        ]))
+
+        # decoded path and results are cached until the field is changed
+        run = FlowRun(path=path, results=json.dumps({'color': {'value': "red"}}))
+        self.assertIs(run.get_path(), run.get_path())
+        self.assertIs(run.get_results(), run.get_results())
+
+        run.results = json.dumps({'color': {'value': "blue"}})
+        self.assertEqual(run.get_results(), {'color': {'value': "blue"}})
+
+        run.results = None
+        self.assertEqual(run.get_results(), {})
+
 
 class FlowMigrationTest(FlowFileTest):
 
@@ -7641,6 +7874,17 @@ class TriggerStartTest(FlowFileTest):
 @patch('temba.flows.models.START_FLOW_BATCH_SIZE', 10)
 class FlowBatchTest(FlowFileTest):
 
+    def test_start_msg_flow_batch_task(self):
+        for b in range(3):
+            push_task(self.org, None, Flow.START_MSG_FLOW_BATCH, dict(flow=b + 1, contacts=[]))
+
+        # a batch which fails doesn't stop the batches after it being started
+        with patch('temba.flows.tasks.start_msg_flow_batch', side_effect=[ValueError("boom"), None, None]) as mock_start:
+            start_msg_flow_batch_task()
+
+        self.assertEqual([c[0][0]['flow'] for c in mock_start.call_args_list], [1, 2, 3])
+        self.assertEqual(start_tasks(Flow.START_MSG_FLOW_BATCH, 5), (None, []))
+
     def test_flow_batch_start(self):
         """
         Tests starting a flow for a group of contacts
@@ -7683,6 +7927,81 @@ class FlowBatchTest(FlowFileTest):
         self.assertEqual(1, Msg.objects.filter(contact=stopped, status=FAILED).count())
         self.assertEqual(1, FlowRun.objects.filter(contact=stopped, exit_type=FlowRun.EXIT_TYPE_INTERRUPTED).count())
 
+    def test_flow_batch_start_bulk(self):
+        """
+        Tests that taking a batch of runs through the entry nodes together matches taking them through one at a time
+        """
+        flow = self.get_flow('color')
+        entry = ActionSet.objects.get(uuid=flow.entry_uuid)
+        color_ruleset = RuleSet.objects.get(flow=flow, label="color")
+
+        self.assertEqual(flow.get_batch_start_nodes(entry, None, [Broadcast()]), [entry, color_ruleset])
+        self.assertIsNone(flow.get_batch_start_nodes(entry, None, []))
+
+        batched = [self.create_contact("Batched %d" % i, "+25078800000%d" % i) for i in range(5)]
+        unbatched = [self.create_contact("Unbatched %d" % i, "+25078811111%d" % i) for i in range(5)]
+
+        # start our first set of contacts all together, then our second set one at a time
+        flow.start([], batched)
+
+        with patch('temba.flows.models.Flow.get_batch_start_nodes', return_value=None):
+            flow.start([], unbatched)
+
+        def run_state(contact):
+            run = FlowRun.objects.get(contact=contact)
+            path = [(p['node_uuid'], p.get('exit_uuid')) for p in run.get_path()]
+            steps = [(s.step_uuid, s.rule_uuid, s.next_uuid, s.left_on is not None, s.messages.count(), s.broadcasts.count())
+                     for s in run.steps.order_by('id')]
+            return (run.is_active, run.exit_type, str(run.current_node_uuid), path, steps, len(run.message_ids or []),
+                    run.recent_messages.count())
+
+        batched_state = run_state(batched[0])
+
+        # all our batched runs are waiting at the color question with the question message
+        self.assertEqual(batched_state[:4], (True, None, color_ruleset.uuid,
+                                             [(entry.uuid, entry.exit_uuid), (color_ruleset.uuid, None)]))
+        self.assertEqual(batched_state[4], [(entry.uuid, entry.exit_uuid, color_ruleset.uuid, True, 1, 1),
+                                            (color_ruleset.uuid, None, None, False, 0, 0)])
+        self.assertEqual(batched_state[5:], (1, 1))
+
+        for contact in batched[1:]:
+            self.assertEqual(run_state(contact), batched_state)
+
+        # and they continue like any other run
+        self.send_message(flow, "orange", contact=batched[0])
+        self.assertEqual(FlowRun.objects.get(contact=batched[0]).get_results()["color"]["category"], "Orange")
+
+        # and contacts taken through one at a time end up in exactly the same state
+        for contact in unbatched:
+            self.assertEqual(run_state(contact), batched_state)
+
+        # if taking a batch through together fails, its writes are rolled back and its runs are started individually
+        fallback = [self.create_contact("Fallback %d" % i, "+25078822222%d" % i) for i in range(3)]
+        start_runs_batch = Flow.start_runs_batch
+
+        def fail_after_writes(self, *args):
+            start_runs_batch(self, *args)
+            raise ValueError("boom")
+
+        with patch('temba.flows.models.Flow.start_runs_batch', autospec=True, side_effect=fail_after_writes):
+            runs = flow.start([], fallback)
+
+        self.assertEqual(len(runs), 3)
+        for contact in fallback:
+            self.assertEqual(run_state(contact), batched_state)
+
+        # when our entry node completes the run, so does the batch
+        single = self.create_flow()
+        runs = single.start([], batched, restart_participants=True)
+        self.assertEqual(len(runs), 5)
+
+        for run in FlowRun.objects.filter(flow=single):
+            self.assertFalse(run.is_active)
+            self.assertEqual(run.exit_type, FlowRun.EXIT_TYPE_COMPLETED)
+            self.assertEqual(len(run.get_path()), 1)
+            self.assertEqual(len(run.message_ids), 1)
+            self.assertIsNotNone(run.steps.get().left_on)
+
 
 class TwoInRowTest(FlowFileTest):
 
@@ -8014,6 +8333,95 @@ class TimeoutTest(FlowFileTest):
         last_msg = run.get_last_msg(OUTGOING)
         self.assertEqual(last_msg.text, "Cool, got it..")
 
+    def create_timed_out_runs(self):
+        """
+        Starts two contacts in a flow and times out both their runs
+        """
+        flow = self.get_flow('multi_timeout')
+
+        contact2 = self.create_contact("Bob", "+250788555555")
+
+        for contact, name in ((self.contact, "Wilson"), (contact2, "Bob")):
+            flow.start([], [contact])
+            Flow.find_and_handle(self.create_msg(contact=contact, direction='I', text=name))
+
+            last_msg = FlowRun.objects.get(contact=contact).get_last_msg(OUTGOING)
+            last_msg.sent_on = timezone.now() - timedelta(minutes=10)
+            last_msg.save()
+
+        time.sleep(1)
+        FlowRun.objects.all().update(timeout_on=timezone.now())
+
+        return FlowRun.objects.get(contact=self.contact), FlowRun.objects.get(contact=contact2)
+
+    def test_batched_timeouts(self):
+        from temba.flows.tasks import check_flow_timeouts_task
+        from temba.utils.queues import push_task
+
+        self.create_timed_out_runs()
+
+        # both timeouts should be queued in a single task
+        with patch('temba.flows.tasks.push_task', side_effect=push_task) as mock_push:
+            check_flow_timeouts_task()
+
+            self.assertEqual(mock_push.call_count, 1)
+            self.assertEqual(len(mock_push.call_args[0][3]['timeouts']), 2)
+
+        for run in FlowRun.objects.all():
+            self.assertFalse(run.is_active)
+            self.assertEqual(run.exit_type, FlowRun.EXIT_TYPE_COMPLETED)
+
+        self.assertEqual(set(Msg.objects.filter(direction=OUTGOING, text__startswith="Thanks").values_list('text', flat=True)),
+                         {"Thanks, Wilson", "Thanks, Bob"})
+
+    def test_batched_timeouts_with_error(self):
+        from temba.msgs.tasks import process_run_timeouts
+
+        run1, run2 = self.create_timed_out_runs()
+        resume_after_timeout = FlowRun.resume_after_timeout
+
+        def fail_first_run(run, timeout_on):
+            if run.id == run1.id:
+                raise ValueError("boom")
+            return resume_after_timeout(run, timeout_on)
+
+        # a run which fails to resume doesn't stop the rest of the batch being handled
+        with patch('temba.flows.models.FlowRun.resume_after_timeout', autospec=True, side_effect=fail_first_run):
+            process_run_timeouts([(run1.id, run1.timeout_on), (run2.id, run2.timeout_on)])
+
+        run1.refresh_from_db()
+        run2.refresh_from_db()
+        self.assertTrue(run1.is_active)
+        self.assertFalse(run2.is_active)
+        self.assertEqual(run2.exit_type, FlowRun.EXIT_TYPE_COMPLETED)
+
+    def test_batched_timeouts_with_soft_time_limit(self):
+        from celery.exceptions import SoftTimeLimitExceeded
+        from temba.flows.tasks import check_flow_timeouts_task, get_queued_timeouts
+        from temba.msgs.tasks import process_run_timeouts
+
+        run1, run2 = self.create_timed_out_runs()
+        timeouts = [(run1.id, run1.timeout_on), (run2.id, run2.timeout_on)]
+        get_queued_timeouts().set_queued(timeouts)
+
+        # running out of time isn't treated as a failure of the run being resumed, it stops the whole batch
+        with patch('temba.flows.models.FlowRun.resume_after_timeout', side_effect=SoftTimeLimitExceeded()):
+            self.assertRaises(SoftTimeLimitExceeded, process_run_timeouts, timeouts)
+
+        run1.refresh_from_db()
+        run2.refresh_from_db()
+        self.assertTrue(run1.is_active)
+        self.assertTrue(run2.is_active)
+
+        # and the timeouts we didn't get to are no longer marked as queued, so the next sweep queues them again
+        self.assertEqual(get_queued_timeouts().filter_unqueued(timeouts), timeouts)
+
+        check_flow_timeouts_task()
+
+        for run in FlowRun.objects.all():
+            self.assertFalse(run.is_active)
+            self.assertEqual(run.exit_type, FlowRun.EXIT_TYPE_COMPLETED)
+
     def test_multi_timeout(self):
         from temba.flows.tasks import check_flow_timeouts_task
         flow = self.get_flow('multi_timeout')
@@ -3,16 +3,30 @@ from __future__ import unicode_literals
 
 import geojson
 import logging
+import regex
 import six
 
+from collections import defaultdict
 from django.contrib.gis.db import models
 from django.db.models.functions import Concat
 from django.db.models import Value, F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
 from mptt.models import MPTTModel, TreeForeignKey
 from smartmin.models import SmartModel
+from temba.utils import on_transaction_commit
+from temba.utils.cache import LRUCache
+from uuid import uuid4
 
 logger = logging.getLogger(__name__)
 
+GAZETTEER_VERSION_KEY = 'boundaries:%d:cache:gazetteer_version'
+GAZETTEER_VERSION_TTL = 60 * 60 * 24  # 1 day
+
+# boundary gazetteers for countries used by this process, keyed by boundary tree and versioned by a Redis stamp
+gazetteer_cache = LRUCache(max_size=50, ttl=300)
+
 
 # default manager for AdminBoundary, doesn't load geometries
 class NoGeometryManager(models.GeoManager):
@@ -96,6 +110,9 @@ class AdminBoundary(MPTTModel, models.Model):
     def update(self, **kwargs):
         AdminBoundary.objects.filter(id=self.id).update(**kwargs)
 
+        # bulk updates bypass save signals so invalidate the gazetteer of this boundary's country ourselves
+        Gazetteer.invalidate(self.tree_id)
+
         # if our name changed, update the category on any of our values
         name = kwargs.get('name', self.name)
         if name != self.name:
@@ -136,3 +153,118 @@ class BoundaryAlias(SmartModel):
     @classmethod
     def create(cls, org, user, boundary, name):
         return cls.objects.create(org=org, boundary=boundary, name=name, created_by=user, modified_by=user)
+
+
+class Gazetteer(object):
+    """
+    An in-memory index of the names and aliases of all the boundaries of a country, so that location strings can be
+    parsed without querying for each of the names they might contain
+    """
+    def __init__(self, names, aliases):
+        self.names = names
+        self.aliases = aliases
+
+    @classmethod
+    def get(cls, country):
+        """
+        Gets the gazetteer for the given country, rebuilding it if it has been invalidated
+        """
+        r = get_redis_connection()
+        key = GAZETTEER_VERSION_KEY % country.tree_id
+        version = r.get(key)
+        if version is None:
+            r.set(key, uuid4().hex, ex=GAZETTEER_VERSION_TTL, nx=True)
+            version = r.get(key)
+
+        gazetteer = gazetteer_cache.get(country.tree_id, version)
+        if gazetteer is None:
+            gazetteer = cls.build(country)
+            gazetteer_cache.set(country.tree_id, version, gazetteer)
+
+        return gazetteer
+
+    @classmethod
+    def invalidate(cls, tree_id):
+        """
+        Invalidates the gazetteers held by all processes for the given boundary tree, once the current transaction
+        commits
+        """
+        key = GAZETTEER_VERSION_KEY % tree_id
+        on_transaction_commit(lambda: get_redis_connection().set(key, uuid4().hex, ex=GAZETTEER_VERSION_TTL))
+
+    @classmethod
+    def build(cls, country):
+        boundaries = AdminBoundary.objects.filter(tree_id=country.tree_id).exclude(level=AdminBoundary.LEVEL_COUNTRY)
+        boundaries = {b.id: b for b in boundaries.order_by('id')}
+
+        # both are keyed by level and upper-cased name, like the iexact lookups they replace
+        names = defaultdict(list)
+        for boundary in six.itervalues(boundaries):
+            names[(boundary.level, boundary.name.upper())].append(boundary)
+
+        aliases = defaultdict(list)
+        for name, boundary_id in BoundaryAlias.objects.filter(boundary_id__in=boundaries.keys()).order_by('id').values_list('name', 'boundary_id'):
+            boundary = boundaries[boundary_id]
+            aliases[(boundary.level, name.upper())].append(boundary)
+
+        for matches in six.itervalues(names):
+            matches.sort(key=lambda b: b.id)
+
+        return cls(dict(names), dict(aliases))
+
+    def find(self, name, level, parent=None):
+        """
+        Finds the boundaries at the given level, and optionally with the given parent, which have the given name. If
+        there are none, the boundary of the first alias with that name is returned.
+        """
+        key = (level, name.upper())
+        parent_id = parent.id if parent else None
+
+        matches = [b for b in self.names.get(key, ()) if parent_id is None or b.parent_id == parent_id]
+
+        if not matches:
+            alias = next((b for b in self.aliases.get(key, ()) if parent_id is None or b.parent_id == parent_id), None)
+            if alias:
+                matches = [alias]
+
+        return matches
+
+    def parse(self, location_string, level, parent=None):
+        """
+        Finds the boundaries at the given level matching the given location string by its full name, its name without
+        punctuation, any of its words, or any pair of adjacent words - in that order of preference
+        """
+        for candidate in self._get_candidates(location_string):
+            matches = self.find(candidate, level, parent)
+            if matches:
+                return matches
+
+        return []
+
+    @staticmethod
+    def _get_candidates(location_string):
+        yield location_string
+
+        yield regex.sub(r"\W+", " ", location_string, flags=regex.UNICODE | regex.V0).strip()
+
+        words = regex.split(r"\W+", location_string.lower(), flags=regex.UNICODE | regex.V0)
+        if len(words) > 1:
+            for word in words:
+                yield word
+
+            for i in range(0, len(words) - 1):
+                yield " ".join(words[i:i + 2])
+
+
+@receiver(post_save, sender=AdminBoundary)
+@receiver(post_delete, sender=AdminBoundary)
+def invalidate_gazetteer_on_boundary_change(sender, instance, **kwargs):
+    Gazetteer.invalidate(instance.tree_id)
+
+
+@receiver(post_save, sender=BoundaryAlias)
+@receiver(post_delete, sender=BoundaryAlias)
+def invalidate_gazetteer_on_alias_change(sender, instance, **kwargs):
+    tree_id = AdminBoundary.objects.filter(id=instance.boundary_id).values_list('tree_id', flat=True).first()
+    if tree_id is not None:
+        Gazetteer.invalidate(tree_id)
@@ -9,7 +9,7 @@ import tempfile
 from django.core.management import call_command
 from django.core.urlresolvers import reverse
 from temba.tests import TembaTest
-from .models import AdminBoundary
+from .models import AdminBoundary, BoundaryAlias
 
 
 class LocationTest(TembaTest):
@@ -154,6 +154,37 @@ class LocationTest(TembaTest):
         response_json = response.json()
         self.assertEqual(len(response_json.get('features')), 1)
 
+    def test_gazetteer(self):
+        BoundaryAlias.create(self.org, self.admin, self.state1, "Kigs")
+
+        # first use builds the gazetteer, after which locations are parsed without queries
+        self.assertEqual(self.org.parse_location("Kigali City", AdminBoundary.LEVEL_STATE), [self.state1])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.org.parse_location("kigali city", AdminBoundary.LEVEL_STATE), [self.state1])
+            self.assertEqual(self.org.parse_location("KIGS", AdminBoundary.LEVEL_STATE), [self.state1])
+            self.assertEqual(self.org.parse_location("I live in Gatsibo!", AdminBoundary.LEVEL_DISTRICT), [self.district1])
+            self.assertEqual(self.org.parse_location("Kigali City!", AdminBoundary.LEVEL_STATE), [self.state1])
+            self.assertEqual(self.org.parse_location("gatsibo", AdminBoundary.LEVEL_DISTRICT, self.state2), [self.district1])
+            self.assertEqual(self.org.parse_location("gatsibo", AdminBoundary.LEVEL_DISTRICT, self.state1), [])
+            self.assertEqual(self.org.parse_location("gatsibo", AdminBoundary.LEVEL_STATE), [])
+            self.assertEqual(self.org.parse_location("Nowhere", AdminBoundary.LEVEL_STATE), [])
+
+        # adding an alias invalidates it
+        BoundaryAlias.create(self.org, self.admin, self.district1, "Gats")
+        self.assertEqual(self.org.parse_location("gats", AdminBoundary.LEVEL_DISTRICT), [self.district1])
+
+        # as does updating or adding a boundary
+        self.district3.update(name="Nyarugenge Town")
+        self.assertEqual(self.org.parse_location("nyarugenge town", AdminBoundary.LEVEL_DISTRICT), [self.district3])
+
+        district5 = AdminBoundary.objects.create(osm_id='1711999', name='Gasabo', level=2, parent=self.state1)
+        self.assertEqual(self.org.parse_location("Gasabo", AdminBoundary.LEVEL_DISTRICT), [district5])
+
+        # or removing an alias
+        BoundaryAlias.objects.filter(name="Kigs").delete()
+        self.assertEqual(self.org.parse_location("kigs", AdminBoundary.LEVEL_STATE), [])
+
 
 class DownloadGeoJsonTest(TembaTest):
 
@@ -1,5 +1,6 @@
 from __future__ import print_function, unicode_literals
 
+import heapq
 import json
 import logging
 import pytz
@@ -15,15 +16,16 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import ArrayField
 from django.core.files.temp import NamedTemporaryFile
-from django.db import models, transaction
-from django.db.models import Count, Prefetch, Sum
+from django.db import connection, models, transaction
+from django.db.models import Count, Prefetch, Sum, prefetch_related_objects
 from django.db.models.functions import Upper
 from django.utils import timezone
 from django.utils.html import escape
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django_redis import get_redis_connection
+from temba_expressions import EvaluationError
 from temba_expressions.evaluator import EvaluationContext, DateStyle
-from temba.channels.courier import push_courier_msgs
+from temba.channels.courier import push_courier_batches
 from temba.assets.models import register_asset_store
 from temba.contacts.models import Contact, ContactGroup, ContactURN, URN
 from temba.channels.models import Channel, ChannelEvent
@@ -32,9 +34,10 @@ from temba.schedules.models import Schedule
 from temba.utils import analytics, chunk_list, on_transaction_commit, dict_to_json, get_anonymous_user
 from temba.utils.dates import get_datetime_format, datetime_to_str, datetime_to_s
 from temba.utils.export import BaseExportTask, BaseExportAssetStore
-from temba.utils.expressions import evaluate_template
+from temba.utils.expressions import evaluate_template, get_template_variables
 from temba.utils.http import http_headers
 from temba.utils.models import SquashableModel, TembaModel, TranslatableField
+from temba.utils.profiler import StageTimer
 from temba.utils.queues import DEFAULT_PRIORITY, push_task, LOW_PRIORITY, HIGH_PRIORITY
 from temba.utils.text import clean_string
 from .handler import MessageHandler
@@ -52,6 +55,7 @@ FIRE_EVENT = 'fire'
 TIMEOUT_EVENT = 'timeout'
 
 BATCH_SIZE = 500
+RECIPIENT_BATCH_SIZE = 1000
 
 INITIALIZING = 'I'
 PENDING = 'P'
@@ -115,28 +119,116 @@ def get_message_handlers():
     return __message_handlers
 
 
-def get_unique_recipients(urns, contacts, groups):
+def get_unique_contact_ids(contact_ids, groups, exclude_ids=(), batch_size=None):
     """
-    Builds a list of the unique contacts and URNs by merging urns, contacts and groups
+    Generates the unique ids of the passed in contacts and the members of the passed in groups in ascending order.
+    Group memberships are paged through by contact id so we only hold a page per group in memory, and as each page
+    is sorted, duplicates are always adjacent when the pages are merged.
     """
-    unique_urns = set()
-    unique_contacts = set()
-    included_by_urn = set()  # contact ids of contacts included by URN
+    GroupMembership = ContactGroup.contacts.through
+    batch_size = batch_size or RECIPIENT_BATCH_SIZE
 
-    for urn in urns:
-        unique_urns.add(urn)
-        included_by_urn.add(urn.contact_id)
+    def get_member_ids(group):
+        last_id = 0
+        while True:
+            page = list(GroupMembership.objects.filter(contactgroup_id=group.id, contact_id__gt=last_id)
+                        .order_by('contact_id').values_list('contact_id', flat=True)[:batch_size])
+            for contact_id in page:
+                yield contact_id
 
-    for group in groups:
-        for contact in group.contacts.all():
-            if contact.id not in included_by_urn:
-                unique_contacts.add(contact)
+            if len(page) < batch_size:
+                return
 
-    for contact in contacts:
-        if contact.id not in included_by_urn:
-            unique_contacts.add(contact)
+            last_id = page[-1]
 
-    return unique_urns, unique_contacts
+    last_id = None
+    for contact_id in heapq.merge(iter(sorted(contact_ids)), *[get_member_ids(g) for g in groups]):
+        if contact_id != last_id and contact_id not in exclude_ids:
+            yield contact_id
+
+        last_id = contact_id
+
+
+def get_recipient_batches(urns, contact_ids, groups, batch_size=None):
+    """
+    Generates batches of unique URNs and contacts by merging urns, contacts and groups, as tuples of (urns, contacts).
+    All the URNs are in the first batch and contacts are loaded a batch at a time.
+    """
+    batch_size = batch_size or RECIPIENT_BATCH_SIZE
+    urns = list(set(urns))
+    included_by_urn = {urn.contact_id for urn in urns}  # contact ids of contacts included by URN
+
+    if urns:
+        yield urns, []
+
+    unique_contact_ids = get_unique_contact_ids(contact_ids, groups, included_by_urn, batch_size)
+
+    for id_batch in chunk_list(unique_contact_ids, batch_size):
+        yield [], list(Contact.objects.filter(id__in=id_batch).order_by('id'))
+
+
+class CompiledTemplate(object):
+    """
+    A message template which is parsed once to find the context variables it references, so that it can be rendered
+    for many recipients while building only the parts of each context it uses. Rendered output is reused for any
+    recipients whose referenced variables have the same values.
+    """
+    MAX_RENDERED = 1000
+
+    def __init__(self, text):
+        self.text = text
+        self.needs_evaluation = bool(text) and '@' in text
+        self.variables = sorted(get_template_variables(text)) if self.needs_evaluation else []
+        self.top_levels = {v.split('.')[0] for v in self.variables}
+        self._rendered = {}
+
+    def get_contact_keys(self):
+        """
+        Gets the keys of the contact context referenced by this template, or None if it uses the whole context
+        """
+        keys = set()
+        for variable in self.variables:
+            parts = variable.split('.')
+            if parts[0] == 'step':
+                parts = parts[1:]
+
+            if parts and parts[0] == 'contact':
+                if len(parts) == 1:
+                    return None
+                keys.add(parts[1])
+
+        return keys
+
+    def render(self, context, org):
+        """
+        Renders this template using the given context
+        """
+        if not self.needs_evaluation:
+            return self.text
+
+        eval_context = Msg.build_evaluation_context(context, org)
+
+        key = tuple(self._resolve(eval_context, v) for v in self.variables)
+        try:
+            rendered = self._rendered.get(key)
+        except TypeError:  # pragma: no cover
+            return evaluate_template(self.text, eval_context)[0]
+
+        if rendered is None:
+            rendered, errors = evaluate_template(self.text, eval_context)
+
+            if len(self._rendered) >= self.MAX_RENDERED:
+                self._rendered.clear()
+            self._rendered[key] = rendered
+
+        return rendered
+
+    @staticmethod
+    def _resolve(eval_context, variable):
+        try:
+            return eval_context.resolve_variable(variable)
+        except EvaluationError:
+            return None
 
 
 class UnreachableException(Exception):
@@ -280,9 +372,6 @@ class Broadcast(models.Model):
         self.recipient_count = len(contact_ids)
         self.save(update_fields=('recipient_count',))
 
-        # cache on object for use in subsequent send(..) calls
-        delattr(self, '_recipient_cache')
-
     def update_recipients(self, recipients):
         """
         Updates the recipients which may be contact groups, contacts or contact URNs. Normally you can't update a
@@ -310,17 +399,13 @@ class Broadcast(models.Model):
         self.groups.clear()
         self.groups.add(*groups)
 
-        urns, contacts = get_unique_recipients(urns, contacts, groups)
+        included_by_urn = {urn.contact_id for urn in urns}
+        num_contacts = sum(1 for c in get_unique_contact_ids([c.id for c in contacts], groups, included_by_urn))
 
         # update the recipient count - the number of messages we intend to send
-        self.recipient_count = len(urns) + len(contacts)
+        self.recipient_count = len(set(urns)) + num_contacts
         self.save(update_fields=('recipient_count',))
 
-        # cache on object for use in subsequent send(..) calls
-        setattr(self, '_recipient_cache', (urns, contacts))
-
-        return urns, contacts
-
     def has_pending_fire(self):  # pragma: needs cover
         return self.schedule and self.schedule.has_pending_fire()
 
@@ -412,6 +497,24 @@ class Broadcast(models.Model):
         preferred_languages = self.get_preferred_languages(contact, org)
         return Language.get_localized_text(self.media, preferred_languages)
 
+    def get_compiled_translations(self, contact):
+        """
+        Gets the compiled templates for the text, quick replies and media translations for the given contact
+        """
+        text = self.get_translated_text(contact)
+        quick_replies = self.get_translated_quick_replies(contact)
+
+        media = self.get_translated_media(contact)
+        if media:
+            media_type, media_url = media.split(':', 1)
+            # arbitrary media urls don't have a full content type, so only
+            # make uploads into fully qualified urls
+            if media_url and len(media_type.split('/')) > 1:
+                media = "%s:https://%s/%s" % (media_type, settings.AWS_BUCKET_DOMAIN, media_url)
+
+        return (CompiledTemplate(text), [CompiledTemplate(r) for r in quick_replies],
+                CompiledTemplate(media) if media else None)
+
     def send(self, trigger_send=True, expressions_context=None, response_to=None, status=PENDING, msg_type=INBOX,
              created_on=None, partial_recipients=None, run_map=None, high_priority=False):
         """
@@ -427,120 +530,145 @@ class Broadcast(models.Model):
 
         if partial_recipients:
             # if flow is being started, it'll provide a batch of unique contacts itself
-            urns, contacts = partial_recipients
-        elif hasattr(self, '_recipient_cache'):
-            # look to see if previous call to update_recipients left a cached value
-            urns, contacts = self._recipient_cache
+            recipient_batches = [partial_recipients]
         else:
-            # otherwise fetch everything and calculate
-            urns, contacts = get_unique_recipients(self.urns.all(), self.contacts.all(), self.groups.all())
-
-        Contact.bulk_cache_initialize(self.org, contacts)
-        recipients = list(urns) + list(contacts)
-
-        if self.send_all:
-            recipients = list(urns)
-            contact_list = list(contacts)
-            for contact in contact_list:
-                contact_urns = contact.get_urns()
-                for c_urn in contact_urns:
-                    recipients.append(c_urn)
-
-            recipients = set(recipients)
+            # otherwise stream through our recipients a batch at a time
+            recipient_batches = get_recipient_batches(self.urns.select_related('contact'),
+                                                      self.contacts.values_list('id', flat=True),
+                                                      self.groups.all())
 
         RelatedRecipient = Broadcast.recipients.through
 
         # we batch up our SQL calls to speed up the creation of our SMS objects
         batch = []
         batch_recipients = []
-        existing_recipients = set(BroadcastRecipient.objects.filter(broadcast_id=self.id).values_list('contact_id', flat=True))
+        num_recipients = 0
 
         # if they didn't pass in a created on, create one ourselves
         if not created_on:
             created_on = timezone.now()
 
-        for recipient in recipients:
-            contact = recipient if isinstance(recipient, Contact) else recipient.contact
-            contact.org = self.org
-
-            # get the appropriate translation for this contact
-            text = self.get_translated_text(contact)
-
-            # get the appropriate quick replies translation for this contact
-            quick_replies = self.get_translated_quick_replies(contact)
-
-            media = self.get_translated_media(contact)
-            if media:
-                media_type, media_url = media.split(':', 1)
-                # arbitrary media urls don't have a full content type, so only
-                # make uploads into fully qualified urls
-                if media_url and len(media_type.split('/')) > 1:
-                    media = "%s:https://%s/%s" % (media_type, settings.AWS_BUCKET_DOMAIN, media_url)
-
-            # build our message specific context
-            if expressions_context is not None:
-                message_context = expressions_context.copy()
-                if 'contact' not in message_context:
-                    message_context['contact'] = contact.build_expressions_context()
-            else:
-                message_context = None
-
-            # add in our parent context if the message references @parent
-            if run_map:
-                run = run_map.get(recipient.pk, None)
-                if run and run.flow:
-                    # a bit kludgy here, but should avoid most unnecessary context creations.
-                    # since this path is an optimization for flow starts, we don't need to
-                    # worry about the @child context.
-                    if 'parent' in text:
-                        if run.parent:
-                            run.parent.org = self.org
-                            message_context.update(dict(parent=run.parent.build_expressions_context()))
+        # translations and their compiled templates, by contact language
+        translations = {}
+
+        for urns, contacts in recipient_batches:
+            Contact.bulk_cache_initialize(self.org, contacts)
+            recipients = list(urns) + list(contacts)
+
+            if self.send_all:
+                recipients = list(urns)
+                contact_list = list(contacts)
+                for contact in contact_list:
+                    contact_urns = contact.get_urns()
+                    for c_urn in contact_urns:
+                        recipients.append(c_urn)
+
+                recipients = set(recipients)
+
+            num_recipients += len(recipients)
+
+            recipient_contact_ids = {r.id if isinstance(r, Contact) else r.contact_id for r in recipients}
+            existing_recipients = set(BroadcastRecipient.objects.filter(broadcast_id=self.id, contact_id__in=recipient_contact_ids)
+                                      .values_list('contact_id', flat=True))
+
+            # reserve credits for all our non-test recipients with a single call, any we don't use are released at the
+            # end and if we blow up before that, the ledger will get them back when it's next reconciled
+            num_credits = len([r for r in recipients if not (r if isinstance(r, Contact) else r.contact).is_test])
+            credits = self.org.reserve_credits(num_credits)
+
+            for recipient in recipients:
+                contact = recipient if isinstance(recipient, Contact) else recipient.contact
+                contact.org = self.org
+
+                # get the appropriate translations for this contact
+                if contact.language not in translations:
+                    translations[contact.language] = self.get_compiled_translations(contact)
+
+                text, quick_replies, media = translations[contact.language]
+                templates = [text] + quick_replies + ([media] if media else [])
+                top_levels = set().union(*[t.top_levels for t in templates])
+
+                # build our message specific context, including only what our templates reference
+                if expressions_context is not None:
+                    message_context = expressions_context.copy()
+                    if 'contact' not in message_context and ('contact' in top_levels or 'step' in top_levels):
+                        contact_keys = [t.get_contact_keys() for t in templates]
+                        contact_keys = None if None in contact_keys else set().union(*contact_keys)
+                        message_context['contact'] = contact.build_expressions_context(keys=contact_keys)
+                else:
+                    message_context = None
+
+                # add in our parent context if the message references @parent
+                if run_map:
+                    run = run_map.get(recipient.pk, None)
+                    if run and run.flow:
+                        # since this path is an optimization for flow starts, we don't need to
+                        # worry about the @child context.
+                        if 'parent' in top_levels:
+                            if run.parent:
+                                run.parent.org = self.org
+                                message_context.update(dict(parent=run.parent.build_expressions_context()))
+
+                # unless our templates reference the channel, which is only known once the message is created, render
+                # them now so the message doesn't need to evaluate them again
+                if message_context is not None and 'channel' not in top_levels:
+                    msg_text = text.render(message_context, self.org)
+                    msg_quick_replies = [r.render(message_context, self.org) or r.text for r in quick_replies]
+                    msg_media = media.render(message_context, self.org) if media else None
+                    msg_context = None
+                else:
+                    msg_text = text.text
+                    msg_quick_replies = [r.text for r in quick_replies]
+                    msg_media = media.text if media else None
+                    msg_context = message_context
 
-            try:
-                msg = Msg.create_outgoing(self.org,
-                                          self.created_by,
-                                          recipient,
-                                          text,
-                                          broadcast=self,
-                                          channel=self.channel,
-                                          response_to=response_to,
-                                          expressions_context=message_context,
-                                          status=status,
-                                          msg_type=msg_type,
-                                          high_priority=high_priority,
-                                          insert_object=False,
-                                          attachments=[media] if media else None,
-                                          created_on=created_on,
-                                          quick_replies=quick_replies)
-
-            except UnreachableException:
-                # there was no way to reach this contact, do not create a message
-                msg = None
-
-            # only add it to our batch if it was legit
-            if msg:
-                batch.append(msg)
-
-                # if this isn't an existing recipient, add it as one
-                if msg.contact_id not in existing_recipients:
-                    existing_recipients.add(msg.contact_id)
-                    batch_recipients.append(RelatedRecipient(contact_id=msg.contact_id, broadcast_id=self.id))
-
-            # we commit our messages in batches
-            if len(batch) >= BATCH_SIZE:
-                Msg.objects.bulk_create(batch)
-                RelatedRecipient.objects.bulk_create(batch_recipients)
-
-                # send any messages
-                if trigger_send:
-                    self.org.trigger_send(Msg.objects.filter(broadcast=self, created_on=created_on).select_related('contact', 'contact_urn', 'channel'))
-
-                    # increment our created on so we can load our next batch
-                    created_on = created_on + timedelta(seconds=1)
-
-                batch = []
-                batch_recipients = []
+                try:
+                    msg = Msg.create_outgoing(self.org,
+                                              self.created_by,
+                                              recipient,
+                                              msg_text,
+                                              broadcast=self,
+                                              channel=self.channel,
+                                              response_to=response_to,
+                                              expressions_context=msg_context,
+                                              status=status,
+                                              msg_type=msg_type,
+                                              high_priority=high_priority,
+                                              insert_object=False,
+                                              attachments=[msg_media] if media else None,
+                                              created_on=created_on,
+                                              quick_replies=msg_quick_replies,
+                                              credits=credits)
+
+                except UnreachableException:
+                    # there was no way to reach this contact, do not create a message
+                    msg = None
+
+                # only add it to our batch if it was legit
+                if msg:
+                    batch.append(msg)
+
+                    # if this isn't an existing recipient, add it as one
+                    if msg.contact_id not in existing_recipients:
+                        existing_recipients.add(msg.contact_id)
+                        batch_recipients.append(RelatedRecipient(contact_id=msg.contact_id, broadcast_id=self.id))
+
+                # we commit our messages in batches
+                if len(batch) >= BATCH_SIZE:
+                    Msg.objects.bulk_create(batch)
+                    RelatedRecipient.objects.bulk_create(batch_recipients)
+
+                    # send any messages
+                    if trigger_send:
+                        self.org.trigger_send(Msg.objects.filter(broadcast=self, created_on=created_on).select_related('contact', 'contact_urn', 'channel'))
+
+                        # increment our created on so we can load our next batch
+                        created_on = created_on + timedelta(seconds=1)
+
+                    batch = []
+                    batch_recipients = []
+
+            credits.release()
 
         # commit any remaining objects
         if batch:
@@ -554,7 +682,7 @@ class Broadcast(models.Model):
         # we do this as with the high concurrency of sending we can run into postgresl deadlocks
         # (this could be our fault, or could be: http://www.postgresql.org/message-id/20140731233051.GN17765@andrew-ThinkPad-X230)
         if not partial_recipients:
-            self.status = QUEUED if len(recipients) > 0 else SENT
+            self.status = QUEUED if num_recipients > 0 else SENT
             self.save(update_fields=('status',))
 
     def update(self):
@@ -761,15 +889,19 @@ class Msg(models.Model):
         """
         rapid_batches = []
         courier_batches = []
+        timer = StageTimer()
 
         # we send in chunks of 1,000 to help with contention
         for msgs in chunk_list(all_msgs, 1000):
-            # build our id list
-            msg_ids = set([m.id for m in msgs])
+            # load the channels, contacts and URNs we need to queue these messages in bulk
+            with timer.stage('load'):
+                cls._prefetch_send_relations(msgs)
+
+            with timer.stage('classify'):
+                queued_ids, rapid_msgs, courier_msgs = cls._classify_for_send(msgs)
 
             with transaction.atomic():
                 queued_on = timezone.now()
-                courier_msgs = []
                 task_msgs = []
 
                 task_priority = None
@@ -777,20 +909,15 @@ class Msg(models.Model):
                 last_channel = None
 
                 # update them to queued
-                send_messages = Msg.objects.filter(id__in=msg_ids)\
-                                           .exclude(channel__channel_type=Channel.TYPE_ANDROID)\
-                                           .exclude(msg_type=IVR)\
-                                           .exclude(topup=None)\
-                                           .exclude(contact__is_test=True)
-                send_messages.update(status=QUEUED, queued_on=queued_on, modified_on=queued_on)
-
-                # now push each onto our queue
-                for msg in msgs:
-                    if (msg.msg_type != IVR and msg.channel and msg.channel.channel_type != Channel.TYPE_ANDROID) and msg.topup and not msg.contact.is_test:
-                        if msg.channel.channel_type in settings.COURIER_CHANNELS and msg.uuid:
-                            courier_msgs.append(msg)
-                            continue
-
+                with timer.stage('update'):
+                    if queued_ids:
+                        with connection.cursor() as cursor:
+                            cursor.execute('UPDATE msgs_msg SET status = %s, queued_on = %s, modified_on = %s '
+                                           'WHERE id = ANY(%s)', [QUEUED, queued_on, queued_on, queued_ids])
+
+                with timer.stage('batch'):
+                    # now push each onto our queue
+                    for msg in rapid_msgs:
                         # if this is a different contact than our last, and we have msgs, queue the task
                         if task_msgs and last_contact != msg.contact_id:
                             # if no priority was set, default to DEFAULT
@@ -810,32 +937,68 @@ class Msg(models.Model):
                         task_msgs.append(task)
                         last_contact = msg.contact_id
 
-                if task_msgs:
-                    task_priority = DEFAULT_PRIORITY if task_priority is None else task_priority
-                    rapid_batches.append(dict(org=task_msgs[0]['org'], msgs=task_msgs, priority=task_priority))
-                    task_msgs = []
+                    if task_msgs:
+                        task_priority = DEFAULT_PRIORITY if task_priority is None else task_priority
+                        rapid_batches.append(dict(org=task_msgs[0]['org'], msgs=task_msgs, priority=task_priority))
+                        task_msgs = []
+
+                    # ok, now push our courier msgs
+                    last_contact = None
+                    last_channel = None
+                    for msg in courier_msgs:
+                        if task_msgs and (last_contact != msg.contact_id or last_channel != msg.channel_id):
+                            courier_batches.append(dict(channel=task_msgs[0].channel, msgs=task_msgs,
+                                                        high_priority=task_msgs[0].high_priority))
+                            task_msgs = []
 
-                # ok, now push our courier msgs
-                last_contact = None
-                last_channel = None
-                for msg in courier_msgs:
-                    if task_msgs and (last_contact != msg.contact_id or last_channel != msg.channel_id):
+                        last_contact = msg.contact_id
+                        last_channel = msg.channel_id
+                        task_msgs.append(msg)
+
+                    # push any remaining courier msgs
+                    if task_msgs:
                         courier_batches.append(dict(channel=task_msgs[0].channel, msgs=task_msgs,
                                                     high_priority=task_msgs[0].high_priority))
-                        task_msgs = []
 
-                    last_contact = msg.contact_id
-                    last_channel = msg.channel_id
-                    task_msgs.append(msg)
+        # send our batches
+        def send_batches():
+            with timer.stage('push'):
+                cls._send_rapid_msg_batches(rapid_batches)
+                cls._send_courier_msg_batches(courier_batches)
 
-                # push any remaining courier msgs
-                if task_msgs:
-                    courier_batches.append(dict(channel=task_msgs[0].channel, msgs=task_msgs,
-                                                high_priority=task_msgs[0].high_priority))
+            timer.report('temba.msg_sending')
 
-        # send our batches
-        on_transaction_commit(lambda: cls._send_rapid_msg_batches(rapid_batches))
-        on_transaction_commit(lambda: cls._send_courier_msg_batches(courier_batches))
+        on_transaction_commit(send_batches)
+
+    @classmethod
+    def _classify_for_send(cls, msgs):
+        """
+        Classifies the passed in msgs for sending, returning the ids of msgs to mark as queued, the msgs to queue for
+        sending by RapidPro and the msgs to queue for sending by courier
+        """
+        queued_ids = []
+        rapid_msgs = []
+        courier_msgs = []
+
+        for msg in msgs:
+            if msg.msg_type == IVR or not msg.topup_id or msg.contact.is_test:
+                continue
+
+            channel = msg.channel
+            if channel and channel.channel_type == Channel.TYPE_ANDROID:
+                continue
+
+            # msgs without a channel are marked as queued but there is nothing to send them with
+            queued_ids.append(msg.id)
+            if not channel:
+                continue
+
+            if channel.channel_type in settings.COURIER_CHANNELS and msg.uuid:
+                courier_msgs.append(msg)
+            else:
+                rapid_msgs.append(msg)
+
+        return queued_ids, rapid_msgs, courier_msgs
 
     @classmethod
     def _send_rapid_msg_batches(cls, batches):
@@ -844,41 +1007,55 @@ class Msg(models.Model):
 
     @classmethod
     def _send_courier_msg_batches(cls, batches):
-        for batch in batches:
-            push_courier_msgs(batch['channel'], batch['msgs'], batch['high_priority'])
+        push_courier_batches(batches)
+
+    @classmethod
+    def _prefetch_send_relations(cls, msgs):
+        """
+        Loads the orgs, channels, contacts and URNs of the passed in msgs which haven't already been loaded
+        """
+        for field in ('org', 'channel', 'contact', 'contact_urn'):
+            cache_name = cls._meta.get_field(field).get_cache_name()
+            unloaded = [m for m in msgs if not hasattr(m, cache_name)]
+            if unloaded:
+                prefetch_related_objects(unloaded, field)
 
     @classmethod
-    def process_message(cls, msg):
+    def process_message(cls, msg, timer=None):
         """
-        Processes a message, running it through all our handlers
+        Processes a message, running it through all our handlers. If a stage timer is provided then the time spent in
+        the handlers and marking the message as handled is recorded in it.
         """
         from temba.orgs.models import CHATBASE_TYPE_USER
 
         handlers = get_message_handlers()
+        timer = timer or StageTimer()
 
-        if msg.contact.is_blocked:
-            msg.visibility = Msg.VISIBILITY_ARCHIVED
-            msg.save(update_fields=['visibility', 'modified_on'])
-        else:
-            for handler in handlers:
-                try:
-                    start = None
-                    if settings.DEBUG:  # pragma: no cover
-                        start = time.time()
+        with timer.stage('handle'):
+            if msg.contact.is_blocked:
+                msg.visibility = Msg.VISIBILITY_ARCHIVED
+                msg.save(update_fields=['visibility', 'modified_on'])
+            else:
+                for handler in handlers:
+                    try:
+                        start = None
+                        if settings.DEBUG:  # pragma: no cover
+                            start = time.time()
 
-                    handled = handler.handle(msg)
+                        handled = handler.handle(msg)
 
-                    if start:  # pragma: no cover
-                        print("[%0.2f] %s for %d" % (time.time() - start, handler.name, msg.pk or 0))
+                        if start:  # pragma: no cover
+                            print("[%0.2f] %s for %d" % (time.time() - start, handler.name, msg.pk or 0))
 
-                    if handled:
-                        break
-                except Exception as e:  # pragma: no cover
-                    import traceback
-                    traceback.print_exc(e)
-                    logger.exception("Error in message handling: %s" % e)
+                        if handled:
+                            break
+                    except Exception as e:  # pragma: no cover
+                        import traceback
+                        traceback.print_exc(e)
+                        logger.exception("Error in message handling: %s" % e)
 
-        cls.mark_handled(msg)
+        with timer.stage('mark_handled'):
+            cls.mark_handled(msg)
 
         # chatbase parameters to track logs
         chatbase_not_handled = msg.msg_type != FLOW
@@ -1383,6 +1560,16 @@ class Msg(models.Model):
         if not text or text.find('@') < 0:
             return text, []
 
+        context = cls.build_evaluation_context(context, org)
+
+        # returns tuple of output and errors
+        return evaluate_template(text, context, url_encode, partial_vars)
+
+    @classmethod
+    def build_evaluation_context(cls, context, org=None):
+        """
+        Adds the step and date variables to the given context and wraps it as an evaluation context for the org
+        """
         # add 'step.contact' if it isn't populated for backwards compatibility
         if 'step' not in context:
             context['step'] = dict()
@@ -1410,15 +1597,13 @@ class Msg(models.Model):
         }
 
         date_style = DateStyle.DAY_FIRST if dayfirst else DateStyle.MONTH_FIRST
-        context = EvaluationContext(context, tz, date_style)
-
-        # returns tuple of output and errors
-        return evaluate_template(text, context, url_encode, partial_vars)
+        return EvaluationContext(context, tz, date_style)
 
     @classmethod
     def create_outgoing(cls, org, user, recipient, text, broadcast=None, channel=None, high_priority=False,
                         created_on=None, response_to=None, expressions_context=None, status=PENDING, insert_object=True,
-                        attachments=None, topup_id=None, msg_type=INBOX, connection=None, quick_replies=None):
+                        attachments=None, topup_id=None, msg_type=INBOX, connection=None, quick_replies=None,
+                        credits=None):
 
         if not org or not user:  # pragma: no cover
             raise ValueError("Trying to create outgoing message with no org or user")
@@ -1479,12 +1664,12 @@ class Msg(models.Model):
         if evaluated_attachments is not None and len(evaluated_attachments) == 0:
             evaluated_attachments = None
 
-        # if we are doing a single message, check whether this might be a loop of some kind
-        if insert_object:
+        # if we are doing a single message, check whether this might be a loop of some kind. Test contacts have their
+        # own URNs so we can skip this for them, rather than joining contacts to exclude them from the counts below
+        if insert_object and not contact.is_test:
             # prevent the loop of message while the sending phone is the channel
             # get all messages with same text going to same number
             same_msgs = Msg.objects.filter(contact_urn=contact_urn,
-                                           contact__is_test=False,
                                            channel=channel,
                                            attachments=evaluated_attachments,
                                            text=text,
@@ -1503,7 +1688,6 @@ class Msg(models.Model):
             tel = contact.raw_tel()
             if tel and len(tel) < 6:
                 same_msg_count = Msg.objects.filter(contact_urn=contact_urn,
-                                                    contact__is_test=False,
                                                     channel=channel,
                                                     text=text,
                                                     direction=OUTGOING,
@@ -1512,9 +1696,12 @@ class Msg(models.Model):
                     analytics.gauge('temba.msg_shortcode_loop_caught')
                     return None
 
-        # costs 1 credit to send a message
+        # costs 1 credit to send a message, which may have been reserved as part of a batch
         if not topup_id and not contact.is_test:
-            (topup_id, _) = org.decrement_credit()
+            if credits:
+                topup_id = credits.take()
+            else:
+                (topup_id, _) = org.decrement_credit()
 
         if response_to:
             msg_type = response_to.msg_type
@@ -1527,10 +1714,11 @@ class Msg(models.Model):
 
         metadata = None
         if quick_replies:
-            for counter, reply in enumerate(quick_replies):
-                (value, errors) = Msg.evaluate_template(text=reply, context=expressions_context, org=org)
-                if value:
-                    quick_replies[counter] = value
+            if expressions_context is not None:
+                for counter, reply in enumerate(quick_replies):
+                    (value, errors) = Msg.evaluate_template(text=reply, context=expressions_context, org=org)
+                    if value:
+                        quick_replies[counter] = value
             metadata = json.dumps(dict(quick_replies=quick_replies))
 
         msg_args = dict(contact=contact,
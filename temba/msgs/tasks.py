@@ -5,6 +5,7 @@ import six
 import time
 import json
 
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.task import task
 from collections import defaultdict
 from datetime import timedelta
@@ -17,38 +18,100 @@ from temba.contacts.models import Contact, STOP_CONTACT_EVENT
 from temba.channels.models import ChannelEvent, CHANNEL_EVENT
 from temba.utils import json_date_to_datetime, chunk_list, analytics
 from temba.utils.mage import handle_new_message, handle_new_contact
-from temba.utils.queues import start_task, complete_task, nonoverlapping_task
-from .models import Msg, Broadcast, BroadcastRecipient, ExportMessagesTask, PENDING, HANDLE_EVENT_TASK, MSG_EVENT
-from .models import FIRE_EVENT, TIMEOUT_EVENT, LabelCount, SystemLabelCount
+from temba.utils.profiler import StageTimer
+from temba.utils.queues import start_tasks, complete_task, push_task, nonoverlapping_task, HIGH_PRIORITY, DEFAULT_PRIORITY
+from .models import Msg, Broadcast, BroadcastRecipient, ExportMessagesTask, PENDING, HANDLE_EVENT_TASK, HANDLER_QUEUE
+from .models import MSG_EVENT, FIRE_EVENT, TIMEOUT_EVENT, LabelCount, SystemLabelCount
 
 logger = logging.getLogger(__name__)
 
+# the maximum number of events a single handler task will pop off our queue at once
+HANDLE_EVENT_TASK_BATCH_SIZE = 5
+
+# the soft time limit of a handler task, which allows for two minutes per event as when events were handled singly
+HANDLE_EVENT_TASK_TIME_LIMIT = 120 * HANDLE_EVENT_TASK_BATCH_SIZE
+
+# the maximum number of msgs that will be handled for a contact in one hold of their lock
+CONTACT_QUEUE_DRAIN_SIZE = 25
+
 
 def process_run_timeout(run_id, timeout_on):
     """
     Processes a single run timeout
     """
-    from temba.flows.models import FlowRun
+    process_run_timeouts([(run_id, timeout_on)])
+
+
+def process_run_timeouts(timeouts):
+    """
+    Processes a batch of run timeouts, given as tuples of run id and timeout. Runs are loaded together with their flows
+    and contacts so that each one only needs to be reloaded once we hold its contact's lock. Timeouts which aren't
+    handled, because their contact is busy or we run out of time, are unmarked as queued so that they are queued again.
+    """
+    from temba.flows.models import Flow, FlowRun
+    from temba.flows.tasks import get_queued_timeouts
 
     r = get_redis_connection()
-    run = FlowRun.objects.filter(id=run_id, is_active=True, flow__is_active=True).first()
+    timer = StageTimer()
+    num_handled = 0
 
-    if run:
-        key = 'pcm_%d' % run.contact_id
-        if not r.get(key):
-            with r.lock(key, timeout=120):
-                print("T[%09d] Processing timeout" % run.id)
-                start = time.time()
+    timeouts_by_run_id = dict(timeouts)
+
+    with timer.stage('load'):
+        runs = list(FlowRun.objects.filter(id__in=timeouts_by_run_id.keys(), is_active=True, flow__is_active=True)
+                    .select_related('org').order_by('id'))
+
+        # share a single instance of each flow and contact between the runs which use them
+        flows_by_id = Flow.objects.in_bulk({run.flow_id for run in runs})
+        contacts_by_id = Contact.objects.in_bulk({run.contact_id for run in runs})
+
+        for run in runs:
+            run.flow = flows_by_id[run.flow_id]
+            run.contact = contacts_by_id[run.contact_id]
+
+        # runs in a batch all belong to the same org, so can have their contacts' fields and URNs loaded together
+        if runs:
+            Contact.bulk_cache_initialize(runs[0].org, list(contacts_by_id.values()))
+
+    unhandled = []
+    remaining = list(runs)
+    try:
+        while remaining:
+            run = remaining[0]
+            timeout_on = timeouts_by_run_id[run.id]
 
-                run.refresh_from_db()
+            key = 'pcm_%d' % run.contact_id
+            if r.get(key):
+                unhandled.append((run.id, timeout_on))
+                remaining.pop(0)
+                continue
 
-                # this is still the timeout to process (json doesn't have microseconds so close enough)
-                if run.timeout_on and abs(run.timeout_on - timeout_on) < timedelta(milliseconds=1):
-                    run.resume_after_timeout(timeout_on)
-                else:
-                    print("T[%09d] .. skipping timeout, already handled" % run.id)
+            with r.lock(key, timeout=120):
+                with timer.stage('resume'):
+                    # a run which can't be resumed shouldn't prevent the rest of the batch from being handled
+                    try:
+                        run.refresh_from_db()
+
+                        # this is still the timeout to process (json doesn't have microseconds so close enough)
+                        if run.is_active and run.timeout_on and abs(run.timeout_on - timeout_on) < timedelta(milliseconds=1):
+                            run.resume_after_timeout(timeout_on)
+                            num_handled += 1
+                        else:
+                            print("T[%09d] .. skipping timeout, already handled" % run.id)
+                    except SoftTimeLimitExceeded:
+                        raise
+                    except Exception:
+                        logger.error("Error resuming run %d after timeout" % run.id, exc_info=True)
+
+            remaining.pop(0)
+    finally:
+        # let the next timeouts sweep queue anything we didn't get to
+        unhandled += [(run.id, timeouts_by_run_id[run.id]) for run in remaining]
+        get_queued_timeouts().set_unqueued(unhandled)
 
-                print("T[%09d] %08.3f s" % (run.id, time.time() - start))
+    if num_handled:
+        timer.report('temba.timeout_handling')
+        logger.info("Handled %d timeouts (%s)" % (num_handled, timer))
 
 
 def process_fire_events(fire_ids):
@@ -76,73 +139,136 @@ def process_fire_events(fire_ids):
             print("E[%s][%s] Finished batch firing events in %.3f s" % (flow.org.name, flow.name, time.time() - start))
 
 
-def process_message(msg, new_message=False, new_contact=False):
+def process_message(msg, new_message=False, new_contact=False, timer=None):
     """
     Processes the passed in message dealing with new contacts or mage messages appropriately.
     """
-    print("M[%09d] Processing - %s" % (msg.id, msg.text))
-    start = time.time()
-
     # if message was created in Mage...
     if new_message:
         handle_new_message(msg.org, msg)
         if new_contact:
             handle_new_contact(msg.org, msg.contact)
 
-    Msg.process_message(msg)
-    print("M[%09d] %08.3f s - %s" % (msg.id, time.time() - start, msg.text))
+    Msg.process_message(msg, timer=timer)
 
 
 @task(track_started=True, name='process_message_task')
 def process_message_task(msg_event):
     """
-    Given the task JSON from our queue, processes the message, is two implementations to deal with
-    backwards compatibility of using contact queues (second branch can be removed later)
+    Given the task JSON from our queue, processes the message
     """
-    r = get_redis_connection()
-
-    # we have a contact id, we want to get the msg from that queue after acquiring our lock
-    if msg_event.get('contact_id'):
-        key = 'pcm_%d' % msg_event['contact_id']
-        contact_queue = Msg.CONTACT_HANDLING_QUEUE % msg_event['contact_id']
-
-        # wait for the lock as we want to make sure to process the next message as soon as we are free
-        with r.lock(key, timeout=120):
+    process_message_events([msg_event])
 
-            msg = None
 
-            # pop the next message off our contact queue until we find one that needs handling
-            while True:
-                with r.pipeline() as pipe:
-                    pipe.zrange(contact_queue, 0, 0)
-                    pipe.zremrangebyrank(contact_queue, 0, 0)
-                    (contact_msg, deleted) = pipe.execute()
+def process_message_events(msg_events):
+    """
+    Processes a batch of msg events popped from our queue. Is two implementations to deal with backwards compatibility
+    of using contact queues (second branch can be removed later)
+    """
+    r = get_redis_connection()
+    timer = StageTimer()
+    num_handled = 0
 
-                # no more messages in the queue for this contact, we're done
-                if not contact_msg:
-                    return
+    # the msgs these events refer to are usually what we'll find in each contact's queue, so fetch them all at once
+    with timer.stage('load'):
+        msg_ids = [e['id'] for e in msg_events if e.get('id')]
+        msgs_by_id = {m.id: m for m in Msg.objects.filter(id__in=msg_ids).order_by()
+                      .select_related('org', 'contact_urn', 'channel')}
 
-                # we have a message in our contact queue, look it up
-                msg_event = json.loads(contact_msg[0])
-                msg = (
-                    Msg.objects.filter(id=msg_event['id'])
-                    .order_by()
-                    .select_related('org', 'contact', 'contact_urn', 'channel').first()
-                )
+    # we have contact ids, we want to drain the msgs from those queues after acquiring their locks
+    contact_ids = []
+    for msg_event in msg_events:
+        if msg_event.get('contact_id') and msg_event['contact_id'] not in contact_ids:
+            contact_ids.append(msg_event['contact_id'])
 
-                # make sure we are still pending
-                if msg.status == PENDING:
-                    process_message(msg, msg_event.get('from_mage', msg_event.get('new_message', False)), msg_event.get('new_contact', False))
-                    return
+    for contact_id in contact_ids:
+        num_handled += process_contact_queue(r, contact_id, msgs_by_id, timer)
 
     # backwards compatibility for events without contact ids, we handle the message directly
-    else:
+    for msg_event in msg_events:
+        if msg_event.get('contact_id'):
+            continue
+
         msg = Msg.objects.filter(id=msg_event['id']).select_related('org', 'contact', 'contact_urn', 'channel').first()
         if msg and msg.status == PENDING:
             # grab our contact lock and handle this message
             key = 'pcm_%d' % msg.contact_id
             with r.lock(key, timeout=120):
-                process_message(msg, msg_event.get('from_mage', False), msg_event.get('new_contact', False))
+                process_message(msg, msg_event.get('from_mage', False), msg_event.get('new_contact', False), timer)
+                num_handled += 1
+
+    if num_handled:
+        timer.report('temba.msg_handling')
+        logger.info("Handled %d msgs for %d contacts (%s)" % (num_handled, len(contact_ids), timer))
+
+
+def process_contact_queue(r, contact_id, msgs_by_id, timer):
+    """
+    Drains the pending msgs in a contact's queue while holding that contact's lock, returning the number handled
+    """
+    key = 'pcm_%d' % contact_id
+    contact_queue = Msg.CONTACT_HANDLING_QUEUE % contact_id
+
+    # msgs are always added to the contact queue before their event is queued, so if the queue is empty then another
+    # worker has already drained it and there's no need to wait for the lock
+    if not r.zcard(contact_queue):
+        return 0
+
+    unhandled = []
+    num_handled = 0
+
+    # wait for the lock as we want to make sure to process the next message as soon as we are free
+    with timer.stage('lock_wait'):
+        lock = r.lock(key, timeout=120)
+        lock.acquire()
+
+    try:
+        # pop as many as we can off our contact queue in one go, any others will be handled by their own events
+        with r.pipeline() as pipe:
+            pipe.zrange(contact_queue, 0, CONTACT_QUEUE_DRAIN_SIZE - 1)
+            pipe.zremrangebyrank(contact_queue, 0, CONTACT_QUEUE_DRAIN_SIZE - 1)
+            (contact_msgs, deleted) = pipe.execute()
+
+        msg_events = [json.loads(m) for m in contact_msgs]
+
+        with timer.stage('load'):
+            # look up any msgs that weren't prefetched
+            missing_ids = [e['id'] for e in msg_events if e['id'] not in msgs_by_id]
+            if missing_ids:
+                for msg in Msg.objects.filter(id__in=missing_ids).order_by().select_related('org', 'contact_urn',
+                                                                                            'channel'):
+                    msgs_by_id[msg.id] = msg
+
+        for m, msg_event in enumerate(msg_events):
+            msg = msgs_by_id.get(msg_event['id'])
+
+            # make sure we are still pending
+            if not msg or msg.status != PENDING:
+                continue
+
+            try:
+                # handling a msg can change its contact so always give it a freshly loaded one
+                with timer.stage('load'):
+                    msg.contact = Contact.objects.get(id=contact_id)
+
+                process_message(msg, msg_event.get('from_mage', msg_event.get('new_message', False)),
+                                msg_event.get('new_contact', False), timer)
+                num_handled += 1
+
+            except Exception:  # pragma: no cover
+                unhandled = msg_events[m + 1:]
+                raise
+
+    finally:
+        lock.release()
+
+        # requeue any msgs we didn't get to, as their own events may have already found this queue empty
+        for msg_event in unhandled:  # pragma: no cover
+            msg = msgs_by_id.get(msg_event['id'])
+            if msg and msg.status == PENDING:
+                msg.queue_handling(msg_event.get('new_message', False), msg_event.get('new_contact', False))
+
+    return num_handled
 
 
 @task(track_started=True, name='send_broadcast')
@@ -300,49 +426,86 @@ def export_messages_task(export_id):
     ExportMessagesTask.objects.get(id=export_id).perform()
 
 
-@task(track_started=True, name="handle_event_task", time_limit=180, soft_time_limit=120)
+@task(track_started=True, name="handle_event_task", time_limit=HANDLE_EVENT_TASK_TIME_LIMIT + 60,
+      soft_time_limit=HANDLE_EVENT_TASK_TIME_LIMIT)
 def handle_event_task():
     """
     Priority queue task that handles both event fires (when fired) and new incoming
     messages that need to be handled.
 
-    Currently three types of events may be "popped" from our queue:
+    Currently these types of events may be "popped" from our queue:
              msg - Which contains the id of the Msg to be processed
             fire - Which contains the id of the EventFire that needs to be fired
          timeout - Which contains a run that timed out and needs to be resumed
     stop_contact - Which contains the contact id to stop
     """
-    # pop off the next task
-    org_id, event_task = start_task(HANDLE_EVENT_TASK)
+    # pop off the next tasks
+    org_id, event_tasks = start_tasks(HANDLE_EVENT_TASK, HANDLE_EVENT_TASK_BATCH_SIZE)
 
     # it is possible we have no message to send, if so, just return
-    if not event_task:  # pragma: needs cover
+    if not event_tasks:  # pragma: needs cover
         return
 
+    # events are handled in the order they were queued, but consecutive msg events are handled together so that their
+    # msgs can be loaded in bulk and each contact's queue drained
+    event_groups = []
+    for event_task in event_tasks:
+        if event_task['type'] == MSG_EVENT and event_groups and event_groups[-1][0]['type'] == MSG_EVENT:
+            event_groups[-1].append(event_task)
+        else:
+            event_groups.append([event_task])
+
     try:
-        if event_task['type'] == MSG_EVENT:
-            process_message_task(event_task)
+        while event_groups:
+            event_group = event_groups.pop(0)
+            try:
+                handle_events(event_group)
+            except SoftTimeLimitExceeded:  # pragma: no cover
+                raise
+            except Exception:
+                logger.error("Error handling events: %s" % event_group, exc_info=True)
+    finally:
+        complete_task(HANDLE_EVENT_TASK, org_id)
 
-        elif event_task['type'] == FIRE_EVENT:
-            fire_ids = event_task.get('fires') if 'fires' in event_task else [event_task.get('id')]
-            process_fire_events(fire_ids)
+        # requeue any events we didn't get to, e.g. if we ran out of time
+        for event_group in event_groups:  # pragma: no cover
+            for event_task in event_group:
+                priority = HIGH_PRIORITY if event_task['type'] == MSG_EVENT else DEFAULT_PRIORITY
+                push_task(org_id, HANDLER_QUEUE, HANDLE_EVENT_TASK, event_task, priority=priority)
 
-        elif event_task['type'] == TIMEOUT_EVENT:
-            timeout_on = json_date_to_datetime(event_task['timeout_on'])
-            process_run_timeout(event_task['run'], timeout_on)
 
-        elif event_task['type'] == STOP_CONTACT_EVENT:
-            contact = Contact.objects.get(id=event_task['contact_id'])
-            contact.stop(contact.modified_by)
+def handle_events(event_tasks):
+    """
+    Handles the given events, which are either a group of msg events or a single event of another type
+    """
+    if event_tasks[0]['type'] == MSG_EVENT:
+        process_message_events(event_tasks)
+        return
 
-        elif event_task['type'] == CHANNEL_EVENT:
-            event = ChannelEvent.objects.get(id=event_task['event_id'])
-            event.handle()
+    event_task = event_tasks[0]
 
-        else:  # pragma: needs cover
-            raise Exception("Unexpected event type: %s" % event_task)
-    finally:
-        complete_task(HANDLE_EVENT_TASK, org_id)
+    if event_task['type'] == FIRE_EVENT:
+        fire_ids = event_task.get('fires') if 'fires' in event_task else [event_task.get('id')]
+        process_fire_events(fire_ids)
+
+    elif event_task['type'] == TIMEOUT_EVENT:
+        if 'timeouts' in event_task:
+            timeouts = [(run_id, json_date_to_datetime(timeout_on)) for run_id, timeout_on in event_task['timeouts']]
+        else:
+            timeouts = [(event_task['run'], json_date_to_datetime(event_task['timeout_on']))]
+
+        process_run_timeouts(timeouts)
+
+    elif event_task['type'] == STOP_CONTACT_EVENT:
+        contact = Contact.objects.get(id=event_task['contact_id'])
+        contact.stop(contact.modified_by)
+
+    elif event_task['type'] == CHANNEL_EVENT:
+        event = ChannelEvent.objects.get(id=event_task['event_id'])
+        event.handle()
+
+    else:  # pragma: needs cover
+        raise Exception("Unexpected event type: %s" % event_task)
 
 
 @nonoverlapping_task(track_started=True, name='purge_broadcasts_task', time_limit=60 * 60 * 24 * 7)
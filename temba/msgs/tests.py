@@ -22,7 +22,7 @@ from temba.flows.models import RuleSet
 from temba.msgs.models import Msg, ExportMessagesTask, RESENT, FAILED, OUTGOING, PENDING, WIRED, DELIVERED, ERRORED
 from temba.msgs.models import Broadcast, BroadcastRecipient, Label, SystemLabel, SystemLabelCount, UnreachableException
 from temba.msgs.models import Attachment, HANDLED, QUEUED, SENT, INCOMING, INBOX, FLOW, HANDLE_EVENT_TASK
-from temba.msgs.models import HANDLER_QUEUE, MSG_EVENT
+from temba.msgs.models import HANDLER_QUEUE, MSG_EVENT, CompiledTemplate, get_recipient_batches, get_unique_contact_ids
 from temba.orgs.models import Language, Debit, Org
 from temba.schedules.models import Schedule
 from temba.tests import TembaTest, AnonymousOrg
@@ -34,6 +34,7 @@ from temba.values.models import Value
 from temba.msgs import models
 from .management.commands.msg_console import MessageConsole
 from .tasks import squash_labelcounts, clear_old_msg_external_ids, purge_broadcasts_task, process_message_task
+from .tasks import handle_event_task
 from .templatetags.sms import as_icon
 
 
@@ -49,6 +50,39 @@ class MsgTest(TembaTest):
         self.just_joe = self.create_group("Just Joe", [self.joe])
         self.joe_and_frank = self.create_group("Joe and Frank", [self.joe, self.frank])
 
+    def test_send_messages(self):
+        courier = Channel.create(self.org, self.user, 'RW', 'T', name="Courier", address="+250785551313")
+        rapid = Channel.create(self.org, self.user, 'RW', 'EX', name="External", address="+250785551414")
+        simulator = self.create_contact("Simulator", "+250788000000", is_test=True)
+
+        msg1 = self.create_msg(contact=self.joe, text="Courier", direction='O', status=PENDING, channel=courier)
+        msg2 = self.create_msg(contact=self.frank, text="RapidPro", direction='O', status=PENDING, channel=rapid)
+        msg3 = self.create_msg(contact=self.kevin, text="Android", direction='O', status=PENDING, channel=self.channel)
+        msg4 = self.create_msg(contact=self.joe, text="IVR", direction='O', status=PENDING, channel=rapid, msg_type='V')
+        msg5 = self.create_msg(contact=simulator, text="Test", direction='O', status=PENDING, channel=rapid)
+        msg6 = self.create_msg(contact=self.frank, text="No channel", direction='O', status=PENDING, channel=None)
+        msgs = list(Msg.objects.filter(id__in=[m.id for m in (msg1, msg2, msg3, msg4, msg5, msg6)]).order_by('id'))
+
+        with self.settings(COURIER_CHANNELS=['T']):
+            Msg._prefetch_send_relations(msgs)
+            queued_ids, rapid_msgs, courier_msgs = Msg._classify_for_send(msgs)
+
+            self.assertEqual(queued_ids, [msg1.id, msg2.id, msg6.id])
+            self.assertEqual(rapid_msgs, [msg2])
+            self.assertEqual(courier_msgs, [msg1])
+
+            with patch('temba.utils.analytics.gauge') as mock_gauge:
+                Msg.send_messages(msgs)
+
+                self.assertEqual([c[0][0] for c in mock_gauge.call_args_list], [
+                    'temba.msg_sending.load', 'temba.msg_sending.classify', 'temba.msg_sending.update',
+                    'temba.msg_sending.batch', 'temba.msg_sending.push'
+                ])
+
+        self.assertEqual(set(Msg.objects.filter(status=QUEUED).values_list('id', flat=True)), {msg1.id, msg2.id, msg6.id})
+        self.assertEqual(set(Msg.objects.filter(status=PENDING).values_list('id', flat=True)), {msg3.id, msg4.id, msg5.id})
+        self.assertIsNotNone(Msg.objects.get(id=msg2.id).queued_on)
+
     def test_get_sync_commands(self):
         msg1 = Msg.create_outgoing(self.org, self.admin, self.joe, "Hello, we heard from you.")
         msg2 = Msg.create_outgoing(self.org, self.admin, self.frank, "Hello, we heard from you.")
@@ -324,6 +358,58 @@ class MsgTest(TembaTest):
         # calling it again shouldn't do anything, but should return
         process_message_task(dict(contact_id=contact_id))
 
+    def test_contact_queue_draining(self):
+        contact = self.create_contact("Bob", "+250788111111")
+        msgs = [self.create_msg(contact=contact, direction=INCOMING, status=PENDING, text="Message %d" % m)
+                for m in range(3)]
+
+        r = get_redis_connection()
+        contact_queue = Msg.CONTACT_HANDLING_QUEUE % contact.id
+
+        for msg in msgs:
+            payload = dict(type=MSG_EVENT, contact_id=contact.id, id=msg.id, new_message=False, new_contact=False)
+            r.zadd(contact_queue, datetime_to_s(msg.created_on), dict_to_json(payload))
+
+        # handling the event for the first msg handles all of them
+        with patch('temba.utils.analytics.gauge') as mock_gauge:
+            process_message_task(dict(contact_id=contact.id, id=msgs[0].id))
+
+            self.assertEqual({c[0][0] for c in mock_gauge.call_args_list if c[0][0].startswith('temba.msg_handling')},
+                             {'temba.msg_handling.lock_wait', 'temba.msg_handling.load',
+                              'temba.msg_handling.handle', 'temba.msg_handling.mark_handled'})
+
+        for msg in msgs:
+            msg.refresh_from_db()
+            self.assertEqual(msg.status, HANDLED)
+            self.assertEqual(msg.msg_type, INBOX)
+
+        self.assertEqual(r.zcard(contact_queue), 0)
+
+        # events for the other msgs now find nothing to do
+        with self.assertNumQueries(1):
+            process_message_task(dict(contact_id=contact.id, id=msgs[1].id))
+
+    def test_handle_event_task(self):
+        bob = self.create_contact("Bob", "+250788111111")
+        jim = self.create_contact("Jim", "+250788222222")
+
+        events = [dict(type=MSG_EVENT, contact_id=bob.id, id=1), dict(type=MSG_EVENT, contact_id=jim.id, id=2),
+                  dict(type=STOP_CONTACT_EVENT, contact_id=-1), dict(type=MSG_EVENT, contact_id=bob.id, id=3),
+                  dict(type=STOP_CONTACT_EVENT, contact_id=jim.id)]
+
+        for e, event in enumerate(events):
+            push_task(self.org, None, HANDLE_EVENT_TASK, event, priority=e - len(events))
+
+        # events are handled in order with consecutive msg events together, and an event which fails doesn't stop the
+        # events after it being handled
+        with patch('temba.msgs.tasks.process_message_events') as mock_process:
+            handle_event_task()
+
+        self.assertEqual([c[0][0] for c in mock_process.call_args_list], [events[0:2], events[3:4]])
+
+        jim.refresh_from_db()
+        self.assertTrue(jim.is_stopped)
+
     def test_create_incoming(self):
         Msg.create_incoming(self.channel, "tel:250788382382", "It's going well")
         Msg.create_incoming(self.channel, "tel:250788382382", "My name is Frank")
@@ -996,6 +1082,39 @@ class BroadcastTest(TembaTest):
         finally:
             msgs_models.BATCH_SIZE = orig_batch_size
 
+    def test_recipient_batches(self):
+        jim = self.create_contact("Jim", "555")
+        group = self.create_group("Everyone", [self.joe, self.frank, self.kevin, jim])
+
+        joe_urn = self.joe.get_urn()
+
+        # contacts in several groups or also included explicitly are only included once, and those included by URN
+        # aren't included at all
+        batches = list(get_recipient_batches([joe_urn, joe_urn], [self.lucy.id, self.kevin.id],
+                                             [group, self.joe_and_frank], batch_size=2))
+
+        self.assertEqual(batches, [
+            ([joe_urn], []),
+            ([], [self.frank, self.kevin]),
+            ([], [self.lucy, jim]),
+        ])
+
+        self.assertEqual(list(get_unique_contact_ids([jim.id], [self.joe_and_frank], batch_size=1)),
+                         sorted([self.joe.id, self.frank.id, jim.id]))
+
+        # which is also how we count the recipients of a broadcast
+        broadcast = Broadcast.create(self.org, self.user, "Hi", [joe_urn, self.lucy, self.kevin, group, self.joe_and_frank])
+        self.assertEqual(broadcast.recipient_count, 5)
+
+        # and how we send to them a batch at a time
+        with patch('temba.msgs.models.RECIPIENT_BATCH_SIZE', 2):
+            broadcast.send()
+
+        self.assertEqual(set(broadcast.msgs.values_list('contact_id', flat=True)),
+                         {self.joe.id, self.frank.id, self.kevin.id, self.lucy.id, jim.id})
+        self.assertEqual(broadcast.recipients.count(), 5)
+        self.assertEqual(broadcast.status, QUEUED)
+
     def test_broadcast_model(self):
 
         def assertBroadcastStatus(msg, new_msg_status, broadcast_status):
@@ -1410,6 +1529,44 @@ class BroadcastTest(TembaTest):
         self.assertEqual(self.joe.msgs.get(broadcast=broadcast2).text, "Hi @contact.name on @channel")
         self.assertEqual(self.frank.msgs.get(broadcast=broadcast2).text, "Hi @contact.name on @channel")
 
+        # templates which reference the channel are evaluated once the channel is known
+        broadcast3 = Broadcast.create(self.org, self.user, "Hi @contact.first_name on @channel.name", [self.joe, self.kevin])
+        broadcast3.send(trigger_send=False, expressions_context={})
+
+        self.assertEqual(self.joe.msgs.get(broadcast=broadcast3).text, "Hi Joe on Test Channel")
+        self.assertEqual(self.kevin.msgs.get(broadcast=broadcast3).text, "Hi Kevin on Test Channel")
+
+    def test_compiled_template(self):
+        ContactField.get_or_create(self.org, self.admin, "sector", "sector")
+        self.joe.set_field(self.user, "sector", "Kacyiru")
+        self.frank.set_field(self.user, "sector", "Kacyiru")
+
+        template = CompiledTemplate("Hi @contact.first_name from @(UPPER(contact.sector)) @flow.missing")
+        self.assertTrue(template.needs_evaluation)
+        self.assertEqual(template.variables, ['contact.first_name', 'contact.sector', 'flow.missing'])
+        self.assertEqual(template.top_levels, {'contact', 'flow'})
+        self.assertEqual(template.get_contact_keys(), {'first_name', 'sector'})
+
+        def render(contact):
+            context = dict(contact=contact.build_expressions_context(keys=template.get_contact_keys()))
+            return template.render(context, self.org)
+
+        self.assertEqual(render(self.joe), "Hi Joe from KACYIRU @flow.missing")
+        self.assertEqual(render(self.frank), "Hi Frank from KACYIRU @flow.missing")
+        self.assertEqual(render(self.joe), "Hi Joe from KACYIRU @flow.missing")
+
+        # contacts with the same values reuse the same rendered output
+        self.assertEqual(len(template._rendered), 2)
+
+        # templates without expressions are never evaluated
+        template = CompiledTemplate("Hi there @ 5pm")
+        self.assertFalse(template.needs_evaluation)
+        self.assertEqual(template.render(None, self.org), "Hi there @ 5pm")
+
+        # templates which use the whole contact need the whole contact context
+        self.assertIsNone(CompiledTemplate("Hi @contact").get_contact_keys())
+        self.assertEqual(CompiledTemplate("Hi @step.contact.tel").get_contact_keys(), {'tel'})
+
     def test_purge(self):
         today = timezone.now().date()
         long_ago = timezone.now() - timedelta(days=100)
@@ -9,9 +9,9 @@ import os
 import pycountry
 import random
 import re
-import regex
 import six
 import stripe
+import time
 import traceback
 
 from collections import defaultdict
@@ -36,9 +36,9 @@ from enum import Enum
 from requests import Session
 from smartmin.models import SmartModel
 from temba.bundles import get_brand_bundles, get_bundle_map
-from temba.locations.models import AdminBoundary, BoundaryAlias
+from temba.locations.models import AdminBoundary, Gazetteer
 from temba.utils import analytics, languages
-from temba.utils.cache import get_cacheable_result, get_cacheable_attr, incrby_existing
+from temba.utils.cache import get_cacheable_result, get_cacheable_attr
 from temba.utils.currencies import currency_for_country
 from temba.utils.dates import str_to_datetime, get_datetime_format, datetime_to_str
 from temba.utils.email import send_template_email, send_simple_email, send_custom_smtp_email
@@ -120,6 +120,7 @@ CHATBASE_FEEDBACK = 'CHATBASE_FEEDBACK'
 CHATBASE_VERSION = 'CHATBASE_VERSION'
 
 ORG_STATUS = 'STATUS'
+ORG_APP_PATH_COUNTS = 'APP_PATH_COUNTS'
 SUSPENDED = 'suspended'
 RESTORED = 'restored'
 WHITELISTED = 'whitelisted'
@@ -136,7 +137,8 @@ ORG_CREDITS_TOTAL_CACHE_KEY = 'org:%d:cache:credits_total'
 ORG_CREDITS_PURCHASED_CACHE_KEY = 'org:%d:cache:credits_purchased'
 ORG_CREDITS_USED_CACHE_KEY = 'org:%d:cache:credits_used'
 ORG_ACTIVE_TOPUP_KEY = 'org:%d:cache:active_topup'
-ORG_ACTIVE_TOPUP_REMAINING = 'org:%d:cache:credits_remaining:%d'
+ORG_CREDIT_LEDGER_KEY = 'org:%d:cache:credit_ledger'
+ORG_CREDIT_LEDGERS_KEY = 'cache:credit_ledgers'
 ORG_CREDIT_EXPIRING_CACHE_KEY = 'org:%d:cache:credits_expiring_soon'
 ORG_LOW_CREDIT_THRESHOLD_CACHE_KEY = 'org:%d:cache:low_credits_threshold'
 
@@ -304,14 +306,13 @@ class Org(SmartModel):
         Clears the given cache types (currently just credits) for this org. Returns number of keys actually deleted
         """
         r = get_redis_connection()
-        active_topup_keys = [ORG_ACTIVE_TOPUP_REMAINING % (self.pk, topup.pk) for topup in self.topups.all()]
         return r.delete(ORG_CREDITS_TOTAL_CACHE_KEY % self.pk,
                         ORG_CREDIT_EXPIRING_CACHE_KEY % self.pk,
                         ORG_CREDITS_USED_CACHE_KEY % self.pk,
                         ORG_CREDITS_PURCHASED_CACHE_KEY % self.pk,
                         ORG_LOW_CREDIT_THRESHOLD_CACHE_KEY % self.pk,
                         ORG_ACTIVE_TOPUP_KEY % self.pk,
-                        *active_topup_keys)
+                        ORG_CREDIT_LEDGER_KEY % self.pk)
 
     def set_status(self, status):
         config = self.config_json()
@@ -334,6 +335,19 @@ class Org(SmartModel):
     def is_whitelisted(self):
         return self.config_json().get(ORG_STATUS, None) == WHITELISTED
 
+    def set_app_path_counts(self, enabled):
+        config = self.config_json()
+        config[ORG_APP_PATH_COUNTS] = enabled
+        self.config = json.dumps(config)
+        self.save(update_fields=['config'])
+
+    def has_app_path_counts(self):
+        """
+        Whether flow path and node counts for this org's runs are written by the application rather than by the
+        temba_flowrun_path_change trigger
+        """
+        return self.config_json().get(ORG_APP_PATH_COUNTS, False)
+
     @transaction.atomic
     def import_app(self, data, user, site=None):
         from temba.flows.models import Flow
@@ -1043,42 +1057,13 @@ class Org(SmartModel):
 
         return parsed
 
-    def generate_location_query(self, name, level, is_alias=False):
-        if is_alias:
-            query = dict(name__iexact=name, boundary__level=level)
-            query['__'.join(['boundary'] + ['parent'] * level)] = self.country
-        else:
-            query = dict(name__iexact=name, level=level)
-            query['__'.join(['parent'] * level)] = self.country
-
-        return query
-
     def find_boundary_by_name(self, name, level, parent):
         """
         Finds the boundary with the passed in name or alias on this organization at the stated level.
 
         @returns Iterable of matching boundaries
         """
-        # first check if we have a direct name match
-        if parent:
-            boundary = parent.children.filter(name__iexact=name, level=level)
-        else:
-            query = self.generate_location_query(name, level)
-            boundary = AdminBoundary.objects.filter(**query)
-
-        # not found by name, try looking up by alias
-        if not boundary:
-            if parent:
-                alias = BoundaryAlias.objects.filter(name__iexact=name, boundary__level=level,
-                                                     boundary__parent=parent).first()
-            else:
-                query = self.generate_location_query(name, level, True)
-                alias = BoundaryAlias.objects.filter(**query).first()
-
-            if alias:
-                boundary = [alias.boundary]
-
-        return boundary
+        return Gazetteer.get(self.country).find(name, level, parent)
 
     def parse_location(self, location_string, level, parent=None):
         """
@@ -1091,32 +1076,8 @@ class Org(SmartModel):
         if not self.country_id or not isinstance(location_string, six.string_types):
             return []
 
-        # now look up the boundary by full name
-        boundary = self.find_boundary_by_name(location_string, level, parent)
-
-        if not boundary:
-            # try removing punctuation and try that
-            bare_name = regex.sub(r"\W+", " ", location_string, flags=regex.UNICODE | regex.V0).strip()
-            boundary = self.find_boundary_by_name(bare_name, level, parent)
-
-        # if we didn't find it, tokenize it
-        if not boundary:
-            words = regex.split(r"\W+", location_string.lower(), flags=regex.UNICODE | regex.V0)
-            if len(words) > 1:
-                for word in words:
-                    boundary = self.find_boundary_by_name(word, level, parent)
-                    if boundary:
-                        break
-
-                if not boundary:
-                    # still no boundary? try n-gram of 2
-                    for i in range(0, len(words) - 1):
-                        bigram = " ".join(words[i:i + 2])
-                        boundary = self.find_boundary_by_name(bigram, level, parent)
-                        if boundary:  # pragma: needs cover
-                            break
-
-        return boundary
+        # look up the boundary by full name, then tokenize it to try to find the best match, all in memory
+        return Gazetteer.get(self.country).parse(location_string, level, parent)
 
     def get_org_admins(self):
         return self.administrators.all()
@@ -1377,37 +1338,227 @@ class Org(SmartModel):
         Determines the active topup and returns that along with how many credits we were able
         to decrement it by. Amount decremented is not guaranteed to be the full amount requested.
         """
+        version, reserved = self._reserve_credits(amount, max_topups=1)
+        if reserved:
+            return reserved[0]
+
+        return None, 0
+
+    def reserve_credits(self, amount):
+        """
+        Reserves credits for a batch of messages with a single call to our credit ledger. The returned reservation
+        hands out topups to messages as they are created and should be released once the batch is complete.
+        """
+        return CreditReservation(self, amount)
+
+    def _reserve_credits(self, amount, max_topups=0):
+        """
+        Takes up to amount credits from our credit ledger, rolling over between topups in the order their credits
+        should be used, and without touching the database unless the ledger needs to be loaded. Returns the version
+        of the ledger and a list of (topup_id, count) tuples which may add up to less than amount if we run out.
+        """
         r = get_redis_connection()
 
-        # we always consider this a credit 'used' since un-applied msgs are pending
+        # we always consider reserved credits 'used' since un-applied msgs are pending
         # credit expenses for the next purchased topup
-        incrby_existing(ORG_CREDITS_USED_CACHE_KEY % self.id, amount)
+        lua = "local order = redis.call('hget', KEYS[1], 'topups')\n" \
+              "if not order then\n" \
+              "  return false\n" \
+              "end\n" \
+              "local ttl = redis.call('pttl', KEYS[2])\n" \
+              "local used = redis.call('get', KEYS[2])\n" \
+              "if used ~= false then\n" \
+              "  redis.call('set', KEYS[2], tonumber(used) + ARGV[1])\n" \
+              "  if ttl > 0 then\n" \
+              "    redis.call('pexpire', KEYS[2], ttl)\n" \
+              "  end\n" \
+              "end\n" \
+              "local amount = tonumber(ARGV[1])\n" \
+              "local max_topups = tonumber(ARGV[2])\n" \
+              "local result = {redis.call('hget', KEYS[1], 'version'), -1}\n" \
+              "local exhausted = false\n" \
+              "local next_active = 0\n" \
+              "for topup_id in string.gmatch(order, '%d+') do\n" \
+              "  local remaining = tonumber(redis.call('hget', KEYS[1], topup_id) or 0)\n" \
+              "  if amount > 0 and remaining > 0 and (max_topups == 0 or #result < 2 + max_topups * 2) then\n" \
+              "    local count = math.min(remaining, amount)\n" \
+              "    redis.call('hincrby', KEYS[1], topup_id, -count)\n" \
+              "    amount = amount - count\n" \
+              "    remaining = remaining - count\n" \
+              "    table.insert(result, tonumber(topup_id))\n" \
+              "    table.insert(result, count)\n" \
+              "    if remaining == 0 then\n" \
+              "      exhausted = true\n" \
+              "    end\n" \
+              "  end\n" \
+              "  if remaining > 0 and next_active == 0 then\n" \
+              "    next_active = tonumber(topup_id)\n" \
+              "  end\n" \
+              "  if next_active > 0 and (amount == 0 or (max_topups > 0 and #result >= 2 + max_topups * 2)) then\n" \
+              "    break\n" \
+              "  end\n" \
+              "end\n" \
+              "if exhausted then\n" \
+              "  result[2] = next_active\n" \
+              "end\n" \
+              "return result"
+
+        keys = (ORG_CREDIT_LEDGER_KEY % self.id, ORG_CREDITS_USED_CACHE_KEY % self.id)
+        result = r.eval(lua, 2, *(keys + (amount, max_topups)))
+
+        # no ledger yet, load it from the database and try again
+        if result is None:
+            self._load_credit_ledger(r)
+            result = r.eval(lua, 2, *(keys + (amount, max_topups)))
+
+            if result is None:  # pragma: no cover
+                return None, []
+
+        version, next_active, reserved = result[0], int(result[1]), result[2:]
+
+        # we've used up a topup, so our credit figures need recalculating and our active topup has moved on
+        if next_active >= 0:
+            r.delete(ORG_CREDITS_TOTAL_CACHE_KEY % self.id,
+                     ORG_CREDIT_EXPIRING_CACHE_KEY % self.id,
+                     ORG_CREDITS_USED_CACHE_KEY % self.id,
+                     ORG_CREDITS_PURCHASED_CACHE_KEY % self.id,
+                     ORG_LOW_CREDIT_THRESHOLD_CACHE_KEY % self.id)
+
+            next_topup = TopUp.objects.filter(id=next_active).first() if next_active else None
+            r.set(ORG_ACTIVE_TOPUP_KEY % self.id, json.dumps(next_active), self.get_topup_ttl(next_topup))
+
+        return version, [(int(reserved[i]), int(reserved[i + 1])) for i in range(0, len(reserved), 2)]
+
+    def _release_credits(self, version, credits, uncounted):
+        """
+        Returns reserved credits which weren't used to our credit ledger, provided it hasn't been reloaded since they
+        were reserved, and removes uncounted credits from our used count.
+        """
+        r = get_redis_connection()
 
-        # if we have an active topup cache, we need to decrement the amount remaining
-        active_topup_id = self.get_active_topup_id()
-        if active_topup_id:
+        lua = "local ttl = redis.call('pttl', KEYS[2])\n" \
+              "local used = redis.call('get', KEYS[2])\n" \
+              "if used ~= false then\n" \
+              "  redis.call('set', KEYS[2], tonumber(used) - ARGV[2])\n" \
+              "  if ttl > 0 then\n" \
+              "    redis.call('pexpire', KEYS[2], ttl)\n" \
+              "  end\n" \
+              "end\n" \
+              "if redis.call('hget', KEYS[1], 'version') == ARGV[1] then\n" \
+              "  for i = 3, #ARGV, 2 do\n" \
+              "    redis.call('hincrby', KEYS[1], ARGV[i], ARGV[i + 1])\n" \
+              "  end\n" \
+              "end"
 
-            remaining = r.decr(ORG_ACTIVE_TOPUP_REMAINING % (self.id, active_topup_id), amount)
+        args = [version or '', uncounted]
+        for topup_id, count in credits:
+            args += [topup_id, count]
 
-            # near the edge, clear out our cache and calculate from the db
-            if not remaining or int(remaining) < 100:
-                active_topup_id = None
-                self.clear_credit_cache()
+        r.eval(lua, 2, ORG_CREDIT_LEDGER_KEY % self.id, ORG_CREDITS_USED_CACHE_KEY % self.id, *args)
 
-        # calculate our active topup if we need to
-        if not active_topup_id:
-            active_topup = self.get_active_topup(force_dirty=True)
-            if active_topup:
-                active_topup_id = active_topup.id
-                remaining = active_topup.get_remaining()
-                if amount > remaining:
-                    amount = remaining
-                r.decr(ORG_ACTIVE_TOPUP_REMAINING % (self.id, active_topup.id), amount)
+    def _get_ledger_topups(self):
+        """
+        Gets the non-expired topups which still have credits remaining, in the order their credits should be used,
+        as a list of (topup, remaining) tuples
+        """
+        topups = self.topups.filter(is_active=True, expires_on__gte=timezone.now(), credits__gt=0)\
+                            .annotate(used_credits=Sum('topupcredits__used'))\
+                            .order_by('expires_on', 'id')
 
-        if active_topup_id:
-            return (active_topup_id, amount)
+        ledger = [(topup, topup.credits - (topup.used_credits or 0)) for topup in topups]
+        return [(topup, remaining) for topup, remaining in ledger if remaining > 0]
 
-        return None, 0
+    def _load_credit_ledger(self, r):
+        """
+        Loads our credit ledger from the database if it doesn't already exist. The ledger lives until the first of
+        its topups expires, at which point it will be reloaded.
+        """
+        ledger = self._get_ledger_topups()
+        ttl = min([self.get_topup_ttl(topup) for topup, remaining in ledger] + [ORG_CREDITS_CACHE_TTL])
+
+        lua = "if redis.call('exists', KEYS[1]) == 1 then\n" \
+              "  return 0\n" \
+              "end\n" \
+              "redis.call('hset', KEYS[1], 'version', ARGV[1])\n" \
+              "redis.call('hset', KEYS[1], 'topups', ARGV[4])\n" \
+              "for i = 5, #ARGV, 2 do\n" \
+              "  redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])\n" \
+              "end\n" \
+              "redis.call('expire', KEYS[1], ARGV[2])\n" \
+              "redis.call('sadd', KEYS[2], ARGV[3])\n" \
+              "return 1"
+
+        args = [repr(time.time()), max(ttl, 1), self.id, ','.join([six.text_type(t.id) for t, remaining in ledger])]
+        for topup, remaining in ledger:
+            args += [topup.id, remaining]
+
+        loaded = r.eval(lua, 2, ORG_CREDIT_LEDGER_KEY % self.id, ORG_CREDIT_LEDGERS_KEY, *args)
+
+        # we know what our active topup is now too
+        if loaded and ledger:
+            active_topup = ledger[0][0]
+            r.set(ORG_ACTIVE_TOPUP_KEY % self.id, json.dumps(active_topup.id), self.get_topup_ttl(active_topup))
+
+    def reconcile_credit_ledger(self):
+        """
+        Reconciles our credit ledger with the credits actually used according to TopUpCredits. Credits used outside of
+        the ledger are removed from it straight away, but credits the ledger thinks are used which the database
+        doesn't, are only returned if they were missing at the previous reconciliation too, as otherwise they are
+        probably reserved for messages which are still being created.
+        """
+        r = get_redis_connection()
+        ledger = self._get_ledger_topups()
+        ttl = min([self.get_topup_ttl(topup) for topup, remaining in ledger] + [ORG_CREDITS_CACHE_TTL])
+
+        lua = "if redis.call('exists', KEYS[1]) == 0 then\n" \
+              "  return 0\n" \
+              "end\n" \
+              "local fields = {topups=true, version=true}\n" \
+              "for i = 3, #ARGV, 2 do\n" \
+              "  local topup_id = ARGV[i]\n" \
+              "  local actual = tonumber(ARGV[i + 1])\n" \
+              "  local gap_field = 'gap:' .. topup_id\n" \
+              "  local current = redis.call('hget', KEYS[1], topup_id)\n" \
+              "  fields[topup_id] = true\n" \
+              "  if current == false or tonumber(current) >= actual then\n" \
+              "    redis.call('hset', KEYS[1], topup_id, actual)\n" \
+              "  else\n" \
+              "    fields[gap_field] = true\n" \
+              "    local gap = actual - tonumber(current)\n" \
+              "    local restore = math.min(gap, tonumber(redis.call('hget', KEYS[1], gap_field) or 0))\n" \
+              "    redis.call('hincrby', KEYS[1], topup_id, restore)\n" \
+              "    redis.call('hset', KEYS[1], gap_field, gap - restore)\n" \
+              "  end\n" \
+              "end\n" \
+              "for _, field in ipairs(redis.call('hkeys', KEYS[1])) do\n" \
+              "  if not fields[field] then\n" \
+              "    redis.call('hdel', KEYS[1], field)\n" \
+              "  end\n" \
+              "end\n" \
+              "redis.call('hset', KEYS[1], 'topups', ARGV[2])\n" \
+              "if redis.call('ttl', KEYS[1]) > tonumber(ARGV[1]) then\n" \
+              "  redis.call('expire', KEYS[1], ARGV[1])\n" \
+              "end\n" \
+              "return 1"
+
+        args = [max(ttl, 1), ','.join([six.text_type(t.id) for t, remaining in ledger])]
+        for topup, remaining in ledger:
+            args += [topup.id, remaining]
+
+        return bool(r.eval(lua, 1, ORG_CREDIT_LEDGER_KEY % self.id, *args))
+
+    @classmethod
+    def reconcile_credit_ledgers(cls):
+        """
+        Reconciles the credit ledgers of all orgs which have one
+        """
+        r = get_redis_connection()
+
+        for org_id in r.smembers(ORG_CREDIT_LEDGERS_KEY):
+            org = cls.objects.filter(id=int(org_id)).first()
+
+            if not org or not org.reconcile_credit_ledger():
+                r.srem(ORG_CREDIT_LEDGERS_KEY, org_id)
 
     def get_active_topup(self, force_dirty=False):
         topup_id = self.get_active_topup_id(force_dirty=force_dirty)
@@ -1445,11 +1596,7 @@ class Org(SmartModel):
 
         topup = active_topups.first()
         if topup:
-            # initialize our active topup metrics
-            r = get_redis_connection()
-            ttl = self.get_topup_ttl(topup)
-            r.set(ORG_ACTIVE_TOPUP_REMAINING % (self.id, topup.id), topup.get_remaining(), ttl)
-            return topup.id, ttl
+            return topup.id, self.get_topup_ttl(topup)
 
         return 0, 0
 
@@ -2363,6 +2510,48 @@ class TopUpCredits(SquashableModel):
         return sql, (distinct_set.topup_id,) * 2
 
 
+class CreditReservation(object):
+    """
+    A batch of credits reserved from an org's credit ledger, which are handed out one message at a time. Credits which
+    aren't taken are returned to the ledger on release.
+    """
+    def __init__(self, org, amount):
+        self.org = org
+        self.amount = amount
+        self.taken = 0
+        self.version, reserved = org._reserve_credits(amount) if amount > 0 else (None, [])
+        self.reserved = [[topup_id, count] for topup_id, count in reserved]
+
+    def take(self):
+        """
+        Takes a single credit from this reservation, returning the id of its topup or None if there aren't any credits
+        """
+        if self.taken >= self.amount:
+            return self.org.decrement_credit()[0]
+
+        self.taken += 1
+
+        while self.reserved:
+            if self.reserved[0][1] > 0:
+                self.reserved[0][1] -= 1
+                return self.reserved[0][0]
+
+            self.reserved.pop(0)
+
+        return None
+
+    def release(self):
+        """
+        Returns any credits which weren't taken
+        """
+        unused = [(topup_id, count) for topup_id, count in self.reserved if count > 0]
+        if unused or self.taken < self.amount:
+            self.org._release_credits(self.version, unused, self.amount - self.taken)
+
+        self.reserved = []
+        self.amount = self.taken
+
+
 class CreditAlert(SmartModel):
     """
     Tracks when we have sent alerts to organization admins about low credits.
@@ -32,3 +32,8 @@ def apply_topups_task(org_id):
 @nonoverlapping_task(track_started=True, name="squash_topupcredits", lock_key='squash_topupcredits')
 def squash_topupcredits():
     TopUpCredits.squash()
+
+
+@nonoverlapping_task(track_started=True, name="reconcile_credit_ledgers", lock_key='reconcile_credit_ledgers')
+def reconcile_credit_ledgers():
+    Org.reconcile_credit_ledgers()
@@ -19,6 +19,7 @@ from django.core.urlresolvers import reverse
 from django.http import HttpRequest
 from django.test.utils import override_settings
 from django.utils import timezone
+from django_redis import get_redis_connection
 from mock import patch, Mock
 from smartmin.tests import SmartminTest
 from temba.airtime.models import AirtimeTransfer
@@ -38,7 +39,8 @@ from temba.utils import languages, dict_to_struct
 from uuid import uuid4
 from .models import Org, TopUp, Invitation, Language, TopUpCredits, DAYFIRST, MONTHFIRST, get_current_export_version
 from .models import CreditAlert, ORG_CREDIT_OVER, ORG_CREDIT_LOW, ORG_CREDIT_EXPIRING, WHITELISTED, SUSPENDED, RESTORED
-from .tasks import squash_topupcredits
+from .models import ORG_CREDIT_LEDGER_KEY, ORG_CREDIT_LEDGERS_KEY
+from .tasks import squash_topupcredits, reconcile_credit_ledgers
 
 
 class OrgContextProcessorTest(TembaTest):
@@ -1096,7 +1098,7 @@ class OrgTest(TembaTest):
         with self.assertNumQueries(2):
             self.assertTrue(self.org.is_nearing_expiration())
 
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             self.assertEqual(15, self.org.get_low_credits_threshold())
 
         with self.assertNumQueries(2):
@@ -1113,7 +1115,7 @@ class OrgTest(TembaTest):
         with self.assertNumQueries(1):
             self.assertFalse(self.org.is_nearing_expiration())
 
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             self.assertEqual(45, self.org.get_low_credits_threshold())
 
         with self.assertNumQueries(1):
@@ -1128,7 +1130,7 @@ class OrgTest(TembaTest):
         with self.assertNumQueries(1):
             self.assertFalse(self.org.is_nearing_expiration())
 
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             self.assertEqual(45, self.org.get_low_credits_threshold())
 
         with self.assertNumQueries(1):
@@ -1143,7 +1145,7 @@ class OrgTest(TembaTest):
         with self.assertNumQueries(1):
             self.assertFalse(self.org.is_nearing_expiration())
 
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(3):
             self.assertEqual(30, self.org.get_low_credits_threshold())
 
         with self.assertNumQueries(1):
@@ -1171,6 +1173,101 @@ class OrgTest(TembaTest):
         self.assertTrue(self.org.is_multi_user_tier())
         self.assertTrue(self.org.is_multi_org_tier())
 
+    def test_credit_ledger(self):
+        r = get_redis_connection()
+        contact = self.create_contact("Bob", "+250788123123")
+        welcome_topup = TopUp.objects.get()
+
+        # use up all but 3 of our welcome topup and add a second topup which expires later
+        TopUp.objects.filter(pk=welcome_topup.pk).update(credits=13)
+        self.org.clear_credit_cache()
+        self.create_inbound_msgs(contact, 10)
+        later_topup = TopUp.create(self.admin, price=0, credits=20, expires_on=timezone.now() + timedelta(days=400))
+
+        # a reservation rolls over from our welcome topup to our later topup, loading the ledger from the db once
+        with self.assertNumQueries(2):
+            credits = self.org.reserve_credits(5)
+
+        self.assertEqual([[welcome_topup.id, 3], [later_topup.id, 2]], credits.reserved)
+        self.assertEqual(later_topup.id, self.org.get_active_topup_id())
+
+        # subsequent reservations don't touch the db
+        with self.assertNumQueries(0):
+            self.assertEqual((later_topup.id, 1), self.org.decrement_credit())
+
+        self.assertEqual(welcome_topup.id, credits.take())
+        self.assertEqual(welcome_topup.id, credits.take())
+        self.assertEqual(welcome_topup.id, credits.take())
+        self.assertEqual(later_topup.id, credits.take())
+
+        # the credit we didn't take goes back to the ledger
+        credits.release()
+        self.assertEqual(b'18', r.hget(ORG_CREDIT_LEDGER_KEY % self.org.id, later_topup.id))
+
+        # reservations larger than our remaining credits only reserve what's left
+        credits = self.org.reserve_credits(20)
+        self.assertEqual([[later_topup.id, 18]], credits.reserved)
+
+        for i in range(18):
+            self.assertEqual(later_topup.id, credits.take())
+
+        self.assertIsNone(credits.take())
+        self.assertIsNone(credits.take())
+        credits.release()
+
+        # and once we're out, we don't have an active topup
+        self.assertEqual((None, 0), self.org.decrement_credit())
+        self.assertEqual(0, self.org.get_active_topup_id())
+
+        # releasing credits into a ledger which has since been reloaded is a noop
+        self.org.clear_credit_cache()
+        credits = self.org.reserve_credits(2)
+        self.assertEqual([[welcome_topup.id, 2]], credits.reserved)
+
+        self.org.clear_credit_cache()
+        self.org._load_credit_ledger(r)
+        credits.release()
+        self.assertEqual(b'3', r.hget(ORG_CREDIT_LEDGER_KEY % self.org.id, welcome_topup.id))
+
+    def test_reconcile_credit_ledgers(self):
+        r = get_redis_connection()
+        ledger_key = ORG_CREDIT_LEDGER_KEY % self.org.id
+        welcome_topup = TopUp.objects.get()
+
+        self.org.decrement_credit()
+        self.assertEqual(b'999', r.hget(ledger_key, welcome_topup.id))
+
+        # credits used outside of the ledger are removed straight away
+        r.hset(ledger_key, welcome_topup.id, 1005)
+        reconcile_credit_ledgers()
+        self.assertEqual(b'1000', r.hget(ledger_key, welcome_topup.id))
+
+        # but missing credits are only returned once they've been missing for more than one reconciliation
+        r.hset(ledger_key, welcome_topup.id, 990)
+        reconcile_credit_ledgers()
+        self.assertEqual(b'990', r.hget(ledger_key, welcome_topup.id))
+
+        r.hincrby(ledger_key, welcome_topup.id, -2)  # another 2 credits go missing
+        reconcile_credit_ledgers()
+        self.assertEqual(b'998', r.hget(ledger_key, welcome_topup.id))
+
+        reconcile_credit_ledgers()
+        self.assertEqual(b'1000', r.hget(ledger_key, welcome_topup.id))
+
+        # topups which are used up are dropped from the ledger and new ones are added
+        TopUpCredits.objects.create(topup=welcome_topup, used=1000)
+        new_topup = TopUp.objects.create(org=self.org, price=0, credits=50, expires_on=welcome_topup.expires_on,
+                                         created_by=self.admin, modified_by=self.admin)
+        reconcile_credit_ledgers()
+
+        self.assertEqual({b'version', b'topups', str(new_topup.id).encode()}, set(r.hkeys(ledger_key)))
+        self.assertEqual(b'50', r.hget(ledger_key, new_topup.id))
+
+        # orgs whose ledger has expired are no longer reconciled
+        r.delete(ledger_key)
+        reconcile_credit_ledgers()
+        self.assertFalse(r.sismember(ORG_CREDIT_LEDGERS_KEY, self.org.id))
+
     @patch('temba.orgs.views.TwilioRestClient', MockTwilioClient)
     @patch('twilio.util.RequestValidator', MockRequestValidator)
     def test_twilio_connect(self):
@@ -964,6 +964,10 @@ CELERYBEAT_SCHEDULE = {
         'task': 'squash_topupcredits',
         'schedule': timedelta(seconds=300),
     },
+    "reconcile-credit-ledgers": {
+        'task': 'reconcile_credit_ledgers',
+        'schedule': timedelta(seconds=300),
+    },
     "squash-contactgroupcounts": {
         'task': 'squash_contactgroupcounts',
         'schedule': timedelta(seconds=300),
@@ -166,13 +166,11 @@ $$ LANGUAGE plpgsql;
 -- Utility function to lookup whether a contact is a simulator contact
 ----------------------------------------------------------------------
 CREATE OR REPLACE FUNCTION temba_contact_is_test(_contact_id INT) RETURNS BOOLEAN AS $$
-DECLARE
-  _is_test BOOLEAN;
 BEGIN
-  SELECT is_test INTO STRICT _is_test FROM contacts_contact WHERE id = _contact_id;
-  RETURN _is_test;
+  -- simulator contacts are few, so probe the small partial index of them rather than the contact primary key
+  RETURN EXISTS(SELECT 1 FROM contacts_contact WHERE id = _contact_id AND is_test = TRUE);
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql STABLE;
 
 ----------------------------------------------------------------------
 -- Utility function to fetch the flow id from a run
@@ -186,6 +184,17 @@ BEGIN
 END;
 $$ LANGUAGE plpgsql;
 
+----------------------------------------------------------------------
+-- Utility function to check whether the current transaction has already
+-- counted the path changes it is making application side
+----------------------------------------------------------------------
+CREATE OR REPLACE FUNCTION temba_flowrun_paths_counted() RETURNS BOOLEAN AS $$
+BEGIN
+  -- the database has a default for this setting, so unlike an unregistered setting, reading it never errors
+  RETURN current_setting('temba.path_counts') = 'app';
+END;
+$$ LANGUAGE plpgsql STABLE;
+
 ----------------------------------------------------------------------
 -- Handles changes relating to a flow run's path
 ----------------------------------------------------------------------
@@ -213,6 +222,9 @@ BEGIN
     IF NOT OLD.is_active AND NEW.path != OLD.path THEN RAISE EXCEPTION 'Cannot modify path on an inactive flow run'; END IF;
   END IF;
 
+  -- ignore changes whose path and node counts have been written by the application
+  IF temba_flowrun_paths_counted() THEN RETURN NULL; END IF;
+
   IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
     _old_is_active := OLD.is_active;
     _old_path := OLD.path;
@@ -310,13 +322,11 @@ $$ LANGUAGE plpgsql;
 -- Utility function to lookup whether a contact is a simulator contact
 ----------------------------------------------------------------------
 CREATE OR REPLACE FUNCTION temba_flows_contact_is_test(_contact_id INT) RETURNS BOOLEAN AS $$
-DECLARE
-  _is_test BOOLEAN;
 BEGIN
-  SELECT is_test INTO STRICT _is_test FROM contacts_contact WHERE id = _contact_id;
-  RETURN _is_test;
+  -- simulator contacts are few, so probe the small partial index of them rather than the contact primary key
+  RETURN EXISTS(SELECT 1 FROM contacts_contact WHERE id = _contact_id AND is_test = TRUE);
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql STABLE;
 
 ----------------------------------------------------------------------
 -- Inserts a new channelcount row with the given values
@@ -626,8 +636,6 @@ $function$;
 -- Manages keeping track of the # of messages sent and received by a channel
 ----------------------------------------------------------------------
 CREATE OR REPLACE FUNCTION temba_update_channelcount() RETURNS TRIGGER AS $$
-DECLARE
-  is_test boolean;
 BEGIN
   -- Message being updated
   IF TG_OP = 'INSERT' THEN
@@ -636,11 +644,8 @@ BEGIN
       RETURN NULL;
     END IF;
 
-    -- Find out if this is a test contact
-    SELECT contacts_contact.is_test INTO STRICT is_test FROM contacts_contact WHERE id=NEW.contact_id;
-
-    -- Return if it is
-    IF is_test THEN
+    -- Return if this is a test contact
+    IF temba_contact_is_test(NEW.contact_id) THEN
       RETURN NULL;
     END IF;
 
@@ -968,25 +973,19 @@ $$ LANGUAGE plpgsql;
 -- Trigger procedure to update group count
 ----------------------------------------------------------------------
 CREATE OR REPLACE FUNCTION update_group_count() RETURNS TRIGGER AS $$
-DECLARE
-  is_test BOOLEAN;
 BEGIN
   -- contact being added to group
   IF TG_OP = 'INSERT' THEN
-    -- is this a test contact
-    SELECT contacts_contact.is_test INTO STRICT is_test FROM contacts_contact WHERE id = NEW.contact_id;
-
-    IF NOT is_test THEN
+    -- ignore test contacts
+    IF NOT temba_contact_is_test(NEW.contact_id) THEN
       INSERT INTO contacts_contactgroupcount("group_id", "count", "is_squashed")
       VALUES(NEW.contactgroup_id, 1, FALSE);
     END IF;
 
   -- contact being removed from a group
   ELSIF TG_OP = 'DELETE' THEN
-    -- is this a test contact
-    SELECT contacts_contact.is_test INTO STRICT is_test FROM contacts_contact WHERE id = OLD.contact_id;
-
-    IF NOT is_test THEN
+    -- ignore test contacts
+    IF NOT temba_contact_is_test(OLD.contact_id) THEN
       INSERT INTO contacts_contactgroupcount("group_id", "count", "is_squashed")
       VALUES(OLD.contactgroup_id, -1, FALSE);
     END IF;
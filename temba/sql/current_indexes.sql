@@ -114,6 +114,10 @@ ON msgs_systemlabel(org_id, label_type) WHERE NOT is_squashed;
 CREATE INDEX org_test_contacts
 ON contacts_contact (org_id) WHERE is_test = TRUE;
 
+-- index for fast lookups of whether a contact is a test contact from triggers
+CREATE INDEX contacts_contact_test_ids
+ON contacts_contact (id) WHERE is_test = TRUE;
+
 -- indexes for fast fetching of unsquashed rows
 CREATE INDEX orgs_debit_unsquashed_purged
 ON orgs_debit(topup_id) WHERE NOT is_squashed AND debit_type = 'P';
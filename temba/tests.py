@@ -27,13 +27,14 @@ from HTMLParser import HTMLParser
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from selenium.webdriver.firefox.webdriver import WebDriver
 from smartmin.tests import SmartminTest
-from temba.contacts.models import Contact, ContactGroup, ContactField, URN
+from temba.contacts.models import Contact, ContactGroup, ContactField, URN, contact_state_cache, group_predicate_cache
 from temba.orgs.models import Org
 from temba.channels.models import Channel
-from temba.locations.models import AdminBoundary
-from temba.flows.models import Flow, ActionSet, RuleSet, FlowStep, FlowRevision, clear_flow_users
+from temba.locations.models import AdminBoundary, gazetteer_cache
+from temba.flows.models import Flow, ActionSet, RuleSet, FlowStep, FlowRevision, clear_flow_users, compiled_rules_cache
 from temba.ivr.clients import TwilioClient
 from temba.msgs.models import Msg, INCOMING
+from temba.triggers.models import trigger_index_cache
 from temba.utils import dict_to_struct, get_anonymous_user
 from temba.values.models import Value
 from threading import Thread
@@ -290,6 +291,12 @@ class TembaTest(SmartminTest):
         r = redis.StrictRedis(host='localhost', db=10)
         r.flushdb()
 
+        contact_state_cache.clear()
+        group_predicate_cache.clear()
+        compiled_rules_cache.clear()
+        trigger_index_cache.clear()
+        gazetteer_cache.clear()
+
     def clear_storage(self):
         """
         If a test has written files to storage, it should remove them by calling this
@@ -3,11 +3,14 @@ from __future__ import unicode_literals
 import regex
 import six
 
+from collections import defaultdict, namedtuple
 from django.conf import settings
 from django.db import models
-from django.db.models import Q
+from django.db.models.signals import post_save, m2m_changed
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from django_redis import get_redis_connection
 from smartmin.models import SmartModel
 from temba.channels.models import Channel, ChannelEvent
 from temba.contacts.models import Contact, ContactGroup
@@ -15,7 +18,29 @@ from temba.flows.models import Flow, FlowRun, FlowStart
 from temba.ivr.models import IVRCall
 from temba.msgs.models import Msg
 from temba.orgs.models import Org
+from temba.utils import on_transaction_commit
+from temba.utils.cache import LRUCache
 from temba_expressions.utils import tokenize
+from uuid import uuid4
+
+TRIGGER_INDEX_VERSION_KEY = 'org:%d:cache:trigger_index_version'
+TRIGGER_INDEX_VERSION_TTL = 60 * 60 * 24  # 1 day
+
+# compiled trigger indexes for orgs used by this process, keyed by org id and versioned by a Redis stamp
+trigger_index_cache = LRUCache(max_size=1000, ttl=300)
+
+
+class TriggerQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # bulk updates bypass save signals so invalidate the trigger indexes of the affected orgs ourselves
+        org_ids = set(self.values_list('org_id', flat=True))
+
+        updated = super(TriggerQuerySet, self).update(**kwargs)
+
+        for org_id in org_ids:
+            Trigger.invalidate_index(org_id)
+
+        return updated
 
 
 @six.python_2_unicode_compatible
@@ -91,6 +116,8 @@ class Trigger(SmartModel):
     channel = models.ForeignKey(Channel, verbose_name=_("Channel"), null=True, related_name='triggers',
                                 help_text=_("The associated channel"))
 
+    objects = TriggerQuerySet.as_manager()
+
     @classmethod
     def create(cls, org, user, trigger_type, flow, channel=None, **kwargs):
         trigger = cls.objects.create(org=org, trigger_type=trigger_type, flow=flow, channel=channel,
@@ -269,36 +296,27 @@ class Trigger(SmartModel):
         else:  # pragma: needs cover
             raise ValueError("Entity must be of type msg, call or contact")
 
-        triggers = Trigger.get_triggers_of_type(entity.org, trigger_type)
+        triggers = Trigger.get_index(entity.org).by_type.get(trigger_type, [])
 
         if trigger_type in [Trigger.TYPE_FOLLOW, Trigger.TYPE_NEW_CONVERSATION, Trigger.TYPE_REFERRAL]:
-            triggers = triggers.filter(models.Q(channel=channel) | models.Q(channel=None))
+            triggers = [t for t in triggers if t.channel_id == (channel.id if channel else None) or t.channel_id is None]
 
         if referrer_id is not None:
-            triggers = triggers.filter(models.Q(referrer_id__iexact=referrer_id) | models.Q(referrer_id=''))
+            referrer_id = referrer_id.lower()
+            triggers = [t for t in triggers if t.referrer_id is not None and t.referrer_id.lower() in (referrer_id, '')]
 
             # if we catch more than one trigger with a referrer_id, ignore the catchall
             if len(triggers) > 1:
-                triggers = triggers.exclude(referrer_id='')
-
-        # is there a match for a group specific trigger?
-        group_ids = contact.user_groups.values_list('pk', flat=True)
-        group_triggers = triggers.filter(groups__in=group_ids).order_by('groups__name')
-
-        # if we match with a group restriction, that takes precedence
-        if group_triggers:
-            triggers = group_triggers
-
-        # otherwise, restrict to triggers that don't filter by group
-        else:
-            triggers = triggers.filter(groups=None)
+                triggers = [t for t in triggers if t.referrer_id != '']
 
         # only fire the first matching trigger
-        if triggers:
+        trigger = cls._select_for_contact(triggers, contact)
+        if trigger:
             contact.ensure_unstopped()
-            triggers[0].flow.start([], [contact], start_msg=start_msg, restart_participants=True, extra=extra)
+            Flow.objects.get(id=trigger.flow_id).start([], [contact], start_msg=start_msg, restart_participants=True,
+                                                       extra=extra)
 
-        return bool(triggers)
+        return bool(trigger)
 
     @classmethod
     def find_and_handle(cls, msg):
@@ -308,6 +326,15 @@ class Trigger(SmartModel):
         if not words:
             return False
 
+        # find keyword triggers with an active flow, if message text is only one word we can match 'only-word' too
+        index = Trigger.get_index(msg.org)
+        match_types = (cls.MATCH_FIRST_WORD, cls.MATCH_ONLY_WORD) if len(words) == 1 else (cls.MATCH_FIRST_WORD,)
+        keyword = words[0].lower()
+        triggers = [t for m in match_types for t in index.by_keyword.get((keyword, m), []) if t.flow_is_active]
+
+        if not triggers:
+            return False
+
         # skip if message contact is currently active in a flow
         active_run_qs = FlowRun.objects.filter(is_active=True, contact=msg.contact,
                                                flow__is_active=True, flow__is_archived=False)
@@ -316,20 +343,8 @@ class Trigger(SmartModel):
         if active_run and active_run.flow.ignore_triggers and not active_run.is_completed():
             return False
 
-        # find a matching keyword trigger with an active flow
-        trigger = Trigger.objects.filter(org=msg.org, is_archived=False, is_active=True, trigger_type=cls.TYPE_KEYWORD,
-                                         flow__is_archived=False, flow__is_active=True)
-
-        # if message text is only one word, then we can match 'only-word' triggers too
-        match_types = (cls.MATCH_FIRST_WORD, cls.MATCH_ONLY_WORD) if len(words) == 1 else (cls.MATCH_FIRST_WORD,)
-        trigger = trigger.filter(keyword__iexact=words[0], match_type__in=match_types)
-
         # trigger needs to match the contact's groups or be non-group specific
-        trigger = trigger.filter(Q(groups__in=msg.contact.user_groups.all()) | Q(groups=None))
-
-        trigger = trigger.prefetch_related('groups', 'groups__contacts').order_by('groups__name').first()
-
-        # if no trigger for contact groups find there is a no group trigger
+        trigger = cls._select_for_contact(triggers, msg.contact)
         if not trigger:
             return False
 
@@ -337,10 +352,59 @@ class Trigger(SmartModel):
         contact.ensure_unstopped()
 
         # if we have an associated flow, start this contact in it
-        trigger.flow.start([], [contact], start_msg=msg, restart_participants=True)
+        Flow.objects.get(id=trigger.flow_id).start([], [contact], start_msg=msg, restart_participants=True)
 
         return True
 
+    @classmethod
+    def _select_for_contact(cls, triggers, contact):
+        """
+        Selects the trigger to fire for the given contact from a list of indexed triggers. Triggers restricted to one
+        of the contact's groups take precedence (ordered by group name), otherwise we pick a non-group trigger.
+        """
+        group_triggers = [t for t in triggers if t.groups]
+
+        # only fetch the contact's groups if they can make a difference
+        if group_triggers:
+            contact_group_ids = {g.id for g in contact.cached_user_groups}
+            matches = []
+            for trigger in group_triggers:
+                matched_names = [name for group_id, name in six.iteritems(trigger.groups) if group_id in contact_group_ids]
+                if matched_names:
+                    matches.append((min(matched_names), trigger.id, trigger))
+
+            if matches:
+                return min(matches)[2]
+
+        return next((t for t in triggers if not t.groups), None)
+
+    @classmethod
+    def get_index(cls, org):
+        """
+        Gets the compiled trigger index for the given org, rebuilding it if it has been invalidated
+        """
+        r = get_redis_connection()
+        key = TRIGGER_INDEX_VERSION_KEY % org.id
+        version = r.get(key)
+        if version is None:
+            r.set(key, uuid4().hex, ex=TRIGGER_INDEX_VERSION_TTL, nx=True)
+            version = r.get(key)
+
+        index = trigger_index_cache.get(org.id, version)
+        if index is None:
+            index = TriggerIndex.build(org)
+            trigger_index_cache.set(org.id, version, index)
+
+        return index
+
+    @classmethod
+    def invalidate_index(cls, org_id):
+        """
+        Invalidates the trigger indexes held by all processes for the given org, once the current transaction commits
+        """
+        key = TRIGGER_INDEX_VERSION_KEY % org_id
+        on_transaction_commit(lambda: get_redis_connection().set(key, uuid4().hex, ex=TRIGGER_INDEX_VERSION_TTL))
+
     @classmethod
     def find_flow_for_inbound_call(cls, contact):
 
@@ -439,3 +503,63 @@ class Trigger(SmartModel):
             start.async_start()
 
         self.save()
+
+
+class TriggerIndex(object):
+    """
+    An in-memory index of an org's active triggers, with keyword triggers keyed by their lowercase keyword and match
+    type so that matching an incoming message is a dict lookup rather than a database query.
+    """
+    Entry = namedtuple('Entry', ('id', 'trigger_type', 'flow_id', 'flow_is_active', 'channel_id', 'referrer_id',
+                                 'groups'))
+
+    def __init__(self, entries):
+        self.by_type = defaultdict(list)
+        self.by_keyword = defaultdict(list)
+
+        for entry, keyword, match_type in entries:
+            self.by_type[entry.trigger_type].append(entry)
+
+            if entry.trigger_type == Trigger.TYPE_KEYWORD and keyword:
+                self.by_keyword[(keyword.lower(), match_type)].append(entry)
+
+    @classmethod
+    def build(cls, org):
+        triggers = Trigger.objects.filter(org=org, is_active=True, is_archived=False).select_related('flow')
+        triggers = triggers.prefetch_related('groups').order_by('id')
+
+        entries = []
+        for trigger in triggers:
+            entry = cls.Entry(id=trigger.id,
+                              trigger_type=trigger.trigger_type,
+                              flow_id=trigger.flow_id,
+                              flow_is_active=trigger.flow.is_active and not trigger.flow.is_archived,
+                              channel_id=trigger.channel_id,
+                              referrer_id=trigger.referrer_id,
+                              groups={g.id: g.name for g in trigger.groups.all()})
+            entries.append((entry, trigger.keyword, trigger.match_type))
+
+        return cls(entries)
+
+
+@receiver(post_save, sender=Trigger)
+def invalidate_trigger_index_on_trigger_save(sender, instance, **kwargs):
+    Trigger.invalidate_index(instance.org_id)
+
+
+@receiver(m2m_changed, sender=Trigger.groups.through)
+def invalidate_trigger_index_on_groups_change(sender, instance, **kwargs):
+    # instance is either the trigger or the group, but both belong to the org whose index has changed
+    Trigger.invalidate_index(instance.org_id)
+
+
+@receiver(post_save, sender=Flow)
+def invalidate_trigger_index_on_flow_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'is_active', 'is_archived'}.intersection(update_fields):
+        Trigger.invalidate_index(instance.org_id)
+
+
+@receiver(post_save, sender=ContactGroup)
+def invalidate_trigger_index_on_group_save(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or {'name', 'is_active'}.intersection(update_fields):
+        Trigger.invalidate_index(instance.org_id)
@@ -18,7 +18,7 @@ from temba.orgs.models import Language
 from temba.msgs.models import Msg, INCOMING
 from temba.schedules.models import Schedule
 from temba.tests import TembaTest, MockResponse
-from .models import Trigger
+from .models import Trigger, trigger_index_cache
 from .views import DefaultTriggerForm, RegisterTriggerForm
 
 
@@ -1112,6 +1112,84 @@ class TriggerTest(TembaTest):
         # incoming4 should not be handled
         self.assertFalse(Trigger.find_and_handle(incoming4))
 
+    def test_trigger_index(self):
+        contact = self.create_contact('Eric', '+250788382382')
+        group = self.create_group("Klab", [])
+
+        flow1 = self.create_flow()
+        flow2 = self.create_flow()
+
+        trigger1 = Trigger.objects.create(org=self.org, keyword='join', flow=flow1,
+                                          created_by=self.admin, modified_by=self.admin)
+        trigger2 = Trigger.objects.create(org=self.org, keyword='join', flow=flow2,
+                                          created_by=self.admin, modified_by=self.admin)
+        trigger2.groups.add(group)
+
+        index = Trigger.get_index(self.org)
+        self.assertEqual([t.id for t in index.by_keyword[('join', Trigger.MATCH_FIRST_WORD)]], [trigger1.id, trigger2.id])
+        self.assertEqual(index.by_keyword[('join', Trigger.MATCH_FIRST_WORD)][1].groups, {group.id: "Klab"})
+
+        # index is reused until something changes
+        with self.assertNumQueries(0):
+            self.assertIs(Trigger.get_index(self.org), index)
+
+        # messages which don't match any keyword don't hit the database at all
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="hello there")
+        with self.assertNumQueries(0):
+            self.assertFalse(Trigger.find_and_handle(incoming))
+
+        # contact isn't in the group so gets the non-group trigger
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertTrue(Trigger.find_and_handle(incoming))
+        self.assertEqual(FlowRun.objects.get(contact=contact).flow, flow1)
+
+        # adding the contact to the group doesn't change the index, but changes the trigger we pick
+        group.update_contacts(self.admin, [contact], add=True)
+        self.assertIs(Trigger.get_index(self.org), index)
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertTrue(Trigger.find_and_handle(incoming))
+        self.assertEqual(FlowRun.objects.filter(contact=contact, flow=flow2).count(), 1)
+
+        # changing a trigger's keyword invalidates the index
+        trigger1.keyword = 'signup'
+        trigger1.save()
+
+        index = Trigger.get_index(self.org)
+        self.assertEqual([t.id for t in index.by_keyword[('join', Trigger.MATCH_FIRST_WORD)]], [trigger2.id])
+        self.assertEqual([t.id for t in index.by_keyword[('signup', Trigger.MATCH_FIRST_WORD)]], [trigger1.id])
+
+        # as does changing a trigger's groups
+        trigger2.groups.remove(group)
+        self.assertIsNot(Trigger.get_index(self.org), index)
+
+        index = Trigger.get_index(self.org)
+        self.assertEqual(index.by_keyword[('join', Trigger.MATCH_FIRST_WORD)][0].groups, {})
+
+        # as does archiving a flow (which archives its triggers with a bulk update)
+        flow2.archive()
+        self.assertIsNot(Trigger.get_index(self.org), index)
+
+        index = Trigger.get_index(self.org)
+        self.assertEqual(index.by_keyword.get(('join', Trigger.MATCH_FIRST_WORD)), None)
+
+        # and releasing a group
+        Trigger.objects.create(org=self.org, trigger_type=Trigger.TYPE_MISSED_CALL, flow=flow1,
+                               created_by=self.admin, modified_by=self.admin).groups.add(group)
+
+        index = Trigger.get_index(self.org)
+        self.assertEqual(len(index.by_type[Trigger.TYPE_MISSED_CALL]), 1)
+
+        group.release()
+
+        index = Trigger.get_index(self.org)
+        self.assertEqual(len(index.by_type[Trigger.TYPE_MISSED_CALL]), 0)
+
+        # indexes are also invalidated in other processes which have their own copy
+        trigger_index_cache.clear()
+        index = Trigger.get_index(self.org)
+        self.assertEqual(index.by_type[Trigger.TYPE_KEYWORD][0].id, trigger1.id)
+
     def test_export_import(self):
         # tweak our current channel to be twitter so we can create a channel-based trigger
         Channel.objects.filter(id=self.channel.id).update(channel_type='TT')
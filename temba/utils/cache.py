@@ -1,7 +1,10 @@
 from __future__ import unicode_literals
 
 import json
+import threading
+import time
 
+from collections import OrderedDict
 from datetime import timedelta
 from django.utils import timezone
 from django_redis import get_redis_connection
@@ -82,32 +85,106 @@ class QueueRecord(object):
         self.yesterday_set_key = (timezone.now() - timedelta(days=1)).strftime(key_format)
 
     def is_queued(self, item):
-        item_value = self.item_val(item)
+        return not self.filter_unqueued([item])
 
-        # check whether we locked this item today or yesterday
-        r = get_redis_connection()
-        pipe = r.pipeline()
-        pipe.sismember(self.today_set_key, item_value)
-        pipe.sismember(self.yesterday_set_key, item_value)
-        (queued_today, queued_yesterday) = pipe.execute()
+    def filter_unqueued(self, items):
+        """
+        Filters the given items to those which haven't been queued today or yesterday, in a single round trip
+        """
+        if not items:
+            return []
 
-        return queued_today or queued_yesterday
+        values = [self.item_val(i) for i in items]
 
-    def filter_unqueued(self, items):
-        return [i for i in items if not self.is_queued(i)]
+        r = get_redis_connection()
+        with r.pipeline(transaction=False) as pipe:
+            for value in values:
+                pipe.sismember(self.today_set_key, value)
+                pipe.sismember(self.yesterday_set_key, value)
+            results = pipe.execute()
+
+        return [item for i, item in enumerate(items) if not (results[i * 2] or results[i * 2 + 1])]
 
     def set_queued(self, items):
         """
         Marks the given items as queued
         """
+        if not items:
+            return
+
+        r = get_redis_connection()
+
+        values = [self.item_val(i) for i in items]
+
+        with r.pipeline() as pipe:
+            for value_batch in chunk_list(values, 1000):
+                pipe.sadd(self.today_set_key, *value_batch)
+
+            pipe.expire(self.today_set_key, 86400)  # 24 hours
+            pipe.execute()
+
+    def set_unqueued(self, items):
+        """
+        Unmarks the given items as queued, e.g. so that items which weren't processed can be queued again
+        """
+        if not items:
+            return
+
         r = get_redis_connection()
 
         values = [self.item_val(i) for i in items]
 
-        for value_batch in chunk_list(values, 50):
-            pipe = r.pipeline()
-            for v in value_batch:
-                pipe.sadd(self.today_set_key, v)
+        with r.pipeline() as pipe:
+            for value_batch in chunk_list(values, 1000):
+                pipe.srem(self.today_set_key, *value_batch)
+                pipe.srem(self.yesterday_set_key, *value_batch)
             pipe.execute()
 
-        r.expire(self.today_set_key, 86400)  # 24 hours
+
+class LRUCache(object):
+    """
+    A bounded in-process cache which evicts the least recently used items once it is full and expires items after a
+    TTL. Items are stored with a version, e.g. a modified_on value, and lookups only hit if they are for that version.
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+
+            item_version, expires_on, value = item
+            if item_version != version or expires_on < time.time():
+                return None
+
+            # put back as the most recently used item
+            self._items[key] = item
+            return value
+
+    def set(self, key, version, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (version, time.time() + self.ttl, value)
+
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
@@ -27,6 +27,16 @@ def evaluate_template_compat(template, context, url_encode=False):
     return evaluator.evaluate_template(template, context, url_encode)
 
 
+def get_template_variables(template):
+    """
+    Gets the set of context variables (lowercase paths like contact.name) referenced by the given template
+    """
+    if not template or '@' not in template:
+        return set()
+
+    return VariableCollector().get_variables(template)
+
+
 def get_function_listing():
     global listing
 
@@ -295,3 +305,20 @@ class ContactFieldCollector(EvaluationContext):
         if contact_field:
             self.contact_fields.add(contact_field)
         return ""
+
+
+class VariableCollector(EvaluationContext):
+    """
+    A simple evaluator that extracts all context variables from the parse tree
+    """
+    def __init__(self):
+        super(VariableCollector, self).__init__(dict(), pytz.UTC, None)
+
+    def get_variables(self, template):
+        self.paths = set()
+        evaluate_template(six.text_type(template), self, False, True)
+        return self.paths
+
+    def resolve_variable(self, path):
+        self.paths.add(path.lower())
+        return ""
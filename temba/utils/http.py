@@ -1,8 +1,21 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+import requests
 import six
+import threading
 
+from collections import OrderedDict
 from django.conf import settings
+from django_redis import get_redis_connection
+from six.moves.http_cookiejar import DefaultCookiePolicy
+from six.moves.urllib.parse import urlparse
+
+# maximum number of hosts we keep connection pools for, and the number of keep-alive connections kept for each
+SESSION_POOL_MAX_HOSTS = 200
+SESSION_POOL_MAX_CONNECTIONS = 10
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
 
 
 def http_headers(extra=None):
@@ -15,6 +28,129 @@ def http_headers(extra=None):
     return headers
 
 
+def get_host(url):
+    """
+    Gets the host (and port if specified) of the given URL
+    """
+    return urlparse(url).netloc.lower()
+
+
+def get_endpoint(url):
+    """
+    Gets the host and path of the given URL, i.e. without its scheme or query string
+    """
+    parsed = urlparse(url)
+    return parsed.netloc.lower() + parsed.path
+
+
+def get_session(url):
+    """
+    Gets a requests session for the host of the given URL. Sessions are shared by the threads of this process and keep
+    a bounded pool of keep-alive connections to their host, so that repeated calls to the same endpoint don't pay for
+    new TCP and TLS handshakes. Cookies are never stored as a host may be called on behalf of many different orgs.
+    """
+    host = get_host(url)
+
+    with _sessions_lock:
+        session = _sessions.pop(host, None)
+
+        if session is None:
+            session = requests.Session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=SESSION_POOL_MAX_CONNECTIONS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        # put back as the most recently used session, dropping the least recently used one if we have too many. That
+        # isn't closed as another thread may be using it, but its connections will be closed when it is collected.
+        _sessions[host] = session
+
+        if len(_sessions) > SESSION_POOL_MAX_HOSTS:
+            _sessions.popitem(last=False)
+
+    return session
+
+
+def send_request(prepped, timeout):
+    """
+    Sends a prepared request using the pooled session for its host. Connection errors, timeouts and server errors are
+    recorded against the circuit breaker of its endpoint, and if that is open we fail fast without making the request.
+    """
+    breaker = CircuitBreaker.for_url(prepped.url)
+    if breaker.is_open():
+        raise CircuitOpenError("Calls to %s are failing, not retrying until it has recovered" % breaker.endpoint)
+
+    try:
+        response = get_session(prepped.url).send(prepped, timeout=timeout)
+    except requests.RequestException:
+        breaker.record_failure()
+        raise
+
+    if response.status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+    return response
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive failures of calls to an endpoint (a host and path) in Redis so that the count is shared by all
+    workers. Endpoints rather than hosts are tracked as a shared host like hooks.zapier.com serves many orgs, and one
+    failing endpoint there shouldn't stop calls to all the others. Once failures reach the threshold the circuit opens
+    and callers should fail fast rather than wait on the endpoint. When the cooldown has passed, calls are allowed
+    through again but a single further failure will reopen the circuit.
+    """
+    FAILURES_KEY = 'circuit:%s:failures'
+    OPEN_KEY = 'circuit:%s:open'
+
+    def __init__(self, endpoint, threshold=5, cooldown=60):
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    @classmethod
+    def for_url(cls, url, **kwargs):
+        return cls(get_endpoint(url), **kwargs)
+
+    def is_open(self):
+        r = get_redis_connection()
+        return bool(r.exists(self.OPEN_KEY % self.endpoint))
+
+    def record_success(self):
+        r = get_redis_connection()
+        r.delete(self.FAILURES_KEY % self.endpoint)
+
+    def record_failure(self):
+        """
+        Records a failed call, returning whether that caused the circuit to open
+        """
+        r = get_redis_connection()
+        failures_key = self.FAILURES_KEY % self.endpoint
+
+        with r.pipeline() as pipe:
+            pipe.incr(failures_key)
+            pipe.expire(failures_key, self.cooldown * 10)
+            failures = pipe.execute()[0]
+
+        if failures < self.threshold:
+            return False
+
+        # open the circuit, and leave the count one short of the threshold so that it is half-open after the cooldown
+        with r.pipeline() as pipe:
+            pipe.set(self.OPEN_KEY % self.endpoint, failures, ex=self.cooldown)
+            pipe.set(failures_key, self.threshold - 1, ex=self.cooldown * 10)
+            pipe.execute()
+
+        return True
+
+
 @six.python_2_unicode_compatible
 class HttpEvent(object):
 
@@ -0,0 +1,52 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+from temba.flows.models import Flow, FlowPathCounter
+from temba.orgs.models import Org
+
+
+class Command(BaseCommand):  # pragma: no cover
+    help = "Checks the path and node counts of flows against counts calculated from the paths of their runs. Used to " \
+           "verify that counts written by the application match those the trigger would have written."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', type=int, action='store', dest='org_id', default=None,
+                            help="The database id of the org whose active flows should be checked.")
+        parser.add_argument('--flow', type=int, action='store', dest='flow_id', default=None,
+                            help="The database id of a single flow to check.")
+
+    def handle(self, org_id, flow_id, *args, **options):
+        if flow_id:
+            flows = Flow.objects.filter(id=flow_id)
+        elif org_id:
+            org = Org.objects.filter(id=org_id).first()
+            if not org:
+                raise CommandError("No org with id %d" % org_id)
+
+            self.stdout.write(self.style.MIGRATE_HEADING("Org #%d '%s' (%s counts)" % (
+                org.id, org.name, "application" if org.has_app_path_counts() else "trigger"
+            )))
+            flows = Flow.objects.filter(org=org, is_active=True)
+        else:
+            raise CommandError("Must specify an org or a flow to check")
+
+        num_inconsistent = 0
+
+        for flow in flows.order_by('id'):
+            node_diffs, path_diffs, num_trimmed = FlowPathCounter.check_flow(flow)
+
+            if not node_diffs and not path_diffs:
+                self.stdout.write(" > %s" % self.style.SUCCESS("Flow #%d '%s' is consistent" % (flow.id, flow.name)))
+                continue
+
+            num_inconsistent += 1
+            self.stdout.write(" > %s" % self.style.ERROR("Flow #%d '%s' has %d mismatched node counts and %d mismatched "
+                                                          "path counts (%d runs with trimmed paths)"
+                                                          % (flow.id, flow.name, len(node_diffs), len(path_diffs),
+                                                             num_trimmed)))
+
+            for key, (stored, expected) in sorted(node_diffs.items()) + sorted(path_diffs.items()):
+                self.stdout.write("    %s: %d stored, %d expected" % (key, stored, expected))
+
+        if num_inconsistent:
+            raise CommandError("%d flows have inconsistent counts" % num_inconsistent)
@@ -0,0 +1,65 @@
+from __future__ import unicode_literals
+
+import copy
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+from temba.channels.courier import push_courier_msgs, push_courier_batches, COURIER_DEFAULT_TPS
+from temba.msgs.models import Msg, OUTGOING
+
+PERF_QUEUE_UUID = 'perf-courier-push'
+
+
+class Command(BaseCommand):  # pragma: no cover
+    help = "Benchmarks pushing batches of outgoing messages to courier queues, one script call per batch vs pipelined. " \
+           "Messages are pushed to a separate queue which is deleted afterwards."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--msgs', type=int, action='store', dest='num_msgs', default=10000,
+                            help="Number of outgoing messages to push. Default is 10000.")
+        parser.add_argument('--batch-size', type=int, action='store', dest='batch_size', default=1,
+                            help="Number of messages in each batch. Default is 1, i.e. one contact per batch.")
+
+    def handle(self, num_msgs, batch_size, *args, **options):
+        msgs = list(Msg.objects.filter(direction=OUTGOING).exclude(channel=None).exclude(contact_urn=None)
+                    .order_by('id')[:num_msgs])
+        if not msgs:
+            raise CommandError("No outgoing messages to push")
+
+        # push everything to a throwaway queue
+        channel = copy.copy(msgs[0].channel)
+        channel.uuid = PERF_QUEUE_UUID
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Pushing %d messages in batches of %d" % (len(msgs), batch_size)))
+
+        # measure queuing from unloaded messages, as the whole send set is loaded by Msg.send_messages
+        for mode in ('per-batch', 'pipelined'):
+            batch_msgs = list(Msg.objects.filter(id__in=[m.id for m in msgs]).order_by('id'))
+
+            start = time.time()
+
+            if mode == 'pipelined':
+                Msg._prefetch_send_relations(batch_msgs)
+
+            batches = [dict(channel=channel, msgs=batch_msgs[i:i + batch_size], high_priority=False)
+                       for i in range(0, len(batch_msgs), batch_size)]
+
+            if mode == 'pipelined':
+                push_courier_batches(batches)
+            else:
+                for batch in batches:
+                    push_courier_msgs(batch['channel'], batch['msgs'], batch['high_priority'])
+
+            rate = len(batch_msgs) / (time.time() - start)
+
+            self.stdout.write(" > %s %s" % (mode, self.style.SUCCESS("%d msgs/sec" % rate)))
+
+            self.clear_queue(channel)
+
+    def clear_queue(self, channel):
+        r = get_redis_connection()
+        queue_key = 'msgs:%s|%d' % (channel.uuid, channel.tps if channel.tps else COURIER_DEFAULT_TPS)
+
+        r.delete(queue_key + '/0', queue_key + '/1')
+        r.zrem('msgs:active', queue_key)
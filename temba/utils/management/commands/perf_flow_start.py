@@ -0,0 +1,57 @@
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from temba.contacts.models import Contact
+from temba.flows.models import Flow, START_FLOW_BATCH_SIZE
+
+
+class Command(BaseCommand):  # pragma: no cover
+    help = "Benchmarks starting a batch of contacts in a flow, with and without batched execution. Only to be run " \
+           "on a database generated with make_test_db as messages are queued for sending."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flow', type=int, action='store', dest='flow_id', required=True,
+                            help="The database id of the flow to start.")
+        parser.add_argument('--contacts', type=int, action='store', dest='num_contacts', default=START_FLOW_BATCH_SIZE,
+                            help="Number of contacts in each batch. Default is %d." % START_FLOW_BATCH_SIZE)
+        parser.add_argument('--batches', type=int, action='store', dest='num_batches', default=3,
+                            help="Number of batches to start in each mode. Default is 3.")
+
+    def handle(self, flow_id, num_contacts, num_batches, *args, **options):
+        flow = Flow.objects.filter(id=flow_id, is_active=True).select_related('org').first()
+        if not flow:
+            raise CommandError("No active flow with id %d" % flow_id)
+
+        contact_ids = list(Contact.objects.filter(org=flow.org, is_active=True, is_blocked=False, is_stopped=False,
+                                                  is_test=False).values_list('id', flat=True)[:num_contacts])
+        if len(contact_ids) < 2:
+            raise CommandError("Org #%d doesn't have enough contacts to start a batch" % flow.org_id)
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Flow #%d '%s' (%d contacts per batch)"
+                                                     % (flow.id, flow.name, len(contact_ids))))
+
+        for batch_mode in (False, True):
+            self.stdout.write(" > %s " % ("batched" if batch_mode else "per-contact"), ending='')
+
+            rates = [self.start_batch(flow, contact_ids, batch_mode) for b in range(num_batches)]
+
+            self.stdout.write(self.style.SUCCESS("%d...%d runs/sec" % (min(rates), max(rates))))
+
+    def start_batch(self, flow, contact_ids, batch_mode):
+        """
+        Starts a single batch in a transaction which is rolled back, returning the number of runs started per second
+        """
+        with transaction.atomic():
+            start_time = time.time()
+
+            broadcasts = flow.create_entry_broadcasts(contact_ids)
+            flow.start_msg_flow_batch(contact_ids, broadcasts, [], batch_mode=batch_mode)
+
+            rate = len(contact_ids) / (time.time() - start_time)
+
+            transaction.set_rollback(True)
+
+        return int(rate)
@@ -0,0 +1,203 @@
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from temba.channels.models import Channel
+from temba.contacts.models import ContactURN
+from temba.msgs.models import Msg, OUTGOING, INBOX, WIRED
+from temba.orgs.models import Org
+
+# the functions which looked up test contacts by primary key before the partial index of test contacts was added,
+# including the triggers which did so inline, restored as they were to measure the baseline
+LEGACY_SQL = """
+CREATE OR REPLACE FUNCTION temba_contact_is_test(_contact_id INT) RETURNS BOOLEAN AS $$
+DECLARE
+  _is_test BOOLEAN;
+BEGIN
+  SELECT is_test INTO STRICT _is_test FROM contacts_contact WHERE id = _contact_id;
+  RETURN _is_test;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION temba_flows_contact_is_test(_contact_id INT) RETURNS BOOLEAN AS $$
+DECLARE
+  _is_test BOOLEAN;
+BEGIN
+  SELECT is_test INTO STRICT _is_test FROM contacts_contact WHERE id = _contact_id;
+  RETURN _is_test;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION temba_update_channelcount() RETURNS TRIGGER AS $$
+DECLARE
+  is_test boolean;
+BEGIN
+  -- Message being updated
+  IF TG_OP = 'INSERT' THEN
+    -- Return if there is no channel on this message
+    IF NEW.channel_id IS NULL THEN
+      RETURN NULL;
+    END IF;
+
+    -- Find out if this is a test contact
+    SELECT contacts_contact.is_test INTO STRICT is_test FROM contacts_contact WHERE id=NEW.contact_id;
+
+    -- Return if it is
+    IF is_test THEN
+      RETURN NULL;
+    END IF;
+
+    -- If this is an incoming message, without message type, then increment that count
+    IF NEW.direction = 'I' THEN
+      -- This is a voice message, increment that count
+      IF NEW.msg_type = 'V' THEN
+        PERFORM temba_insert_channelcount(NEW.channel_id, 'IV', NEW.created_on::date, 1);
+      -- Otherwise, this is a normal message
+      ELSE
+        PERFORM temba_insert_channelcount(NEW.channel_id, 'IM', NEW.created_on::date, 1);
+      END IF;
+
+    -- This is an outgoing message
+    ELSIF NEW.direction = 'O' THEN
+      -- This is a voice message, increment that count
+      IF NEW.msg_type = 'V' THEN
+        PERFORM temba_insert_channelcount(NEW.channel_id, 'OV', NEW.created_on::date, 1);
+      -- Otherwise, this is a normal message
+      ELSE
+        PERFORM temba_insert_channelcount(NEW.channel_id, 'OM', NEW.created_on::date, 1);
+      END IF;
+
+    END IF;
+
+  -- Assert that updates aren't happening that we don't approve of
+  ELSIF TG_OP = 'UPDATE' THEN
+    -- If the direction is changing, blow up
+    IF NEW.direction <> OLD.direction THEN
+      RAISE EXCEPTION 'Cannot change direction on messages';
+    END IF;
+
+    -- Cannot move from IVR to Text, or IVR to Text
+    IF (OLD.msg_type <> 'V' AND NEW.msg_type = 'V') OR (OLD.msg_type = 'V' AND NEW.msg_type <> 'V') THEN
+      RAISE EXCEPTION 'Cannot change a message from voice to something else or vice versa';
+    END IF;
+
+    -- Cannot change created_on
+    IF NEW.created_on <> OLD.created_on THEN
+      RAISE EXCEPTION 'Cannot change created_on on messages';
+    END IF;
+
+  -- Table being cleared, reset all counts
+  ELSIF TG_OP = 'TRUNCATE' THEN
+    DELETE FROM channels_channelcount WHERE count_type IN ('IV', 'IM', 'OV', 'OM');
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION update_group_count() RETURNS TRIGGER AS $$
+DECLARE
+  is_test BOOLEAN;
+BEGIN
+  -- contact being added to group
+  IF TG_OP = 'INSERT' THEN
+    -- is this a test contact
+    SELECT contacts_contact.is_test INTO STRICT is_test FROM contacts_contact WHERE id = NEW.contact_id;
+
+    IF NOT is_test THEN
+      INSERT INTO contacts_contactgroupcount("group_id", "count", "is_squashed")
+      VALUES(NEW.contactgroup_id, 1, FALSE);
+    END IF;
+
+  -- contact being removed from a group
+  ELSIF TG_OP = 'DELETE' THEN
+    -- is this a test contact
+    SELECT contacts_contact.is_test INTO STRICT is_test FROM contacts_contact WHERE id = OLD.contact_id;
+
+    IF NOT is_test THEN
+      INSERT INTO contacts_contactgroupcount("group_id", "count", "is_squashed")
+      VALUES(OLD.contactgroup_id, -1, FALSE);
+    END IF;
+
+  -- table being cleared, clear our counts
+  ELSIF TG_OP = 'TRUNCATE' THEN
+    TRUNCATE contacts_contactgroupcount;
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+# the modes we benchmark, with whether each uses the legacy functions
+MODES = (('primary key', True), ('partial index', False))
+
+
+class Command(BaseCommand):  # pragma: no cover
+    help = "Benchmarks inserting outgoing messages, with test contacts looked up by primary key vs the partial index " \
+           "of test contacts. Messages are inserted in transactions which are rolled back, with the modes interleaved."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--org', type=int, action='store', dest='org_id', required=True,
+                            help="The database id of the org to insert messages for.")
+        parser.add_argument('--msgs', type=int, action='store', dest='num_msgs', default=10000,
+                            help="Number of messages to insert in each run. Default is 10000.")
+        parser.add_argument('--runs', type=int, action='store', dest='num_runs', default=3,
+                            help="Number of runs in each mode. Default is 3.")
+
+    def handle(self, org_id, num_msgs, num_runs, *args, **options):
+        org = Org.objects.filter(id=org_id).first()
+        if not org:
+            raise CommandError("No org with id %d" % org_id)
+
+        channel = Channel.objects.filter(org=org, is_active=True).first()
+        if not channel:
+            raise CommandError("Org #%d doesn't have an active channel" % org.id)
+
+        urns = list(ContactURN.objects.filter(org=org, contact__is_active=True, contact__is_test=False)
+                    .exclude(contact=None).only('id', 'contact_id')[:num_msgs])
+        if not urns:
+            raise CommandError("Org #%d doesn't have any contacts with URNs" % org.id)
+
+        self.stdout.write(self.style.MIGRATE_HEADING("Org #%d '%s' (%d msgs per run, %d contacts)"
+                                                     % (org.id, org.name, num_msgs, len(urns))))
+
+        # modes are interleaved, alternating which goes first, so that neither benefits more from a warmer cache
+        rates = {mode: [] for mode, legacy in MODES}
+        for r in range(num_runs):
+            for mode, legacy in (MODES if r % 2 == 0 else reversed(MODES)):
+                rates[mode].append(self.insert_msgs(org, channel, urns, num_msgs, legacy))
+
+        for mode, legacy in MODES:
+            self.stdout.write(" > %s " % mode, ending='')
+            self.stdout.write(self.style.SUCCESS("%d...%d msgs/sec" % (min(rates[mode]), max(rates[mode]))))
+
+    def insert_msgs(self, org, channel, urns, num_msgs, legacy):
+        """
+        Inserts messages in a transaction which is rolled back, returning the number of messages inserted per second
+        """
+        with transaction.atomic():
+            if legacy:
+                with connection.cursor() as cursor:
+                    cursor.execute(LEGACY_SQL)
+
+            now = timezone.now()
+            msgs = []
+            for m in range(num_msgs):
+                urn = urns[m % len(urns)]
+                msgs.append(Msg(org=org, channel=channel, contact_id=urn.contact_id, contact_urn_id=urn.id,
+                                text="Benchmark message %d" % m, direction=OUTGOING, status=WIRED, msg_type=INBOX,
+                                created_on=now, modified_on=now, sent_on=now))
+
+            start_time = time.time()
+
+            Msg.objects.bulk_create(msgs, batch_size=1000)
+
+            rate = num_msgs / (time.time() - start_time)
+
+            transaction.set_rollback(True)
+
+        return int(rate)
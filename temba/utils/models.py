@@ -9,6 +9,7 @@ from django.db import models, connection
 from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 from smartmin.models import SmartModel
+from temba.utils import analytics, chunk_list
 from uuid import uuid4
 
 
@@ -65,6 +66,13 @@ class SquashableModel(models.Model):
     """
     SQUASH_OVER = None
 
+    SQUASH_MIN_BATCH_SIZE = 100
+    SQUASH_MAX_BATCH_SIZE = 10000
+    SQUASH_BATCH_TARGET_SECS = 5
+    SQUASH_STATEMENTS_PER_QUERY = 100
+    SQUASH_TIME_LIMIT = 240
+    SQUASH_LAG_LIMIT = 1000000
+
     id = models.BigAutoField(auto_created=True, primary_key=True, verbose_name='ID')
 
     is_squashed = models.BooleanField(default=False, help_text=_("Whether this row was created by squashing"))
@@ -74,20 +82,54 @@ class SquashableModel(models.Model):
         return cls.objects.filter(is_squashed=False)
 
     @classmethod
-    def squash(cls):
+    def squash(cls, time_limit=None):
+        """
+        Squashes batches of distinct sets until we catch up or run out of time. Batches grow while they complete
+        within SQUASH_BATCH_TARGET_SECS and shrink when they don't, so that we keep up when lots of deltas are being
+        inserted without holding long transactions when the database is busy. Returns the number of unsquashed rows
+        remaining, capped at SQUASH_LAG_LIMIT.
+        """
+        if time_limit is None:
+            time_limit = cls.SQUASH_TIME_LIMIT
+
         start = time.time()
         num_sets = 0
-        for distinct_set in cls.get_unsquashed().order_by(*cls.SQUASH_OVER).distinct(*cls.SQUASH_OVER)[:5000]:
-            with connection.cursor() as cursor:
-                sql, params = cls.get_squash_query(distinct_set)
+        batch_size = cls.SQUASH_MIN_BATCH_SIZE
+        caught_up = False
+
+        while time.time() - start < time_limit:
+            distinct_sets = list(cls.get_unsquashed().order_by(*cls.SQUASH_OVER).distinct(*cls.SQUASH_OVER)[:batch_size])
+            batch_start = time.time()
+
+            for set_batch in chunk_list(distinct_sets, cls.SQUASH_STATEMENTS_PER_QUERY):
+                queries = [cls.get_squash_query(distinct_set) for distinct_set in set_batch]
+                sql = "\n".join([q[0] for q in queries])
+                params = [p for q in queries for p in q[1]]
+
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
 
-                cursor.execute(sql, params)
+            num_sets += len(distinct_sets)
 
-            num_sets += 1
+            if len(distinct_sets) < batch_size:
+                caught_up = True
+                break
+
+            if time.time() - batch_start < cls.SQUASH_BATCH_TARGET_SECS:
+                batch_size = min(batch_size * 2, cls.SQUASH_MAX_BATCH_SIZE)
+            else:
+                batch_size = max(batch_size // 2, cls.SQUASH_MIN_BATCH_SIZE)
+
+        lag = 0 if caught_up else cls.get_unsquashed().values('id')[:cls.SQUASH_LAG_LIMIT].count()
 
         time_taken = time.time() - start
 
-        print("Squashed %d distinct sets of %s in %0.3fs" % (num_sets, cls.__name__, time_taken))
+        analytics.gauge('temba.squash_lag.%s' % cls._meta.model_name, lag)
+
+        print("Squashed %d distinct sets of %s in %0.3fs (%d unsquashed rows remaining)"
+              % (num_sets, cls.__name__, time_taken, lag))
+
+        return lag
 
     class Meta:
         abstract = True
@@ -7,7 +7,10 @@ import textwrap
 import time
 import traceback
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from django.db.backends.utils import CursorWrapper
+from temba.utils import analytics
 
 
 logger = logging.getLogger(__name__)
@@ -137,3 +140,35 @@ def time_monitor(threshold):
             return result
         return wrapper
     return _time_monitor
+
+
+@six.python_2_unicode_compatible
+class StageTimer(object):
+    """
+    Accumulates the time spent in the named stages of some process, e.g.
+
+        timer = StageTimer()
+        with timer.stage('load'):
+            ...
+        timer.report('temba.msg_handling')
+    """
+    def __init__(self):
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.time() - start
+
+    def report(self, prefix):
+        """
+        Records the total time spent in each stage as a gauge
+        """
+        for name, seconds in six.iteritems(self.timings):
+            analytics.gauge('%s.%s' % (prefix, name), seconds)
+
+    def __str__(self):
+        return ", ".join("%s=%.3fs" % (name, seconds) for name, seconds in six.iteritems(self.timings))
@@ -7,7 +7,7 @@ import importlib
 from celery import current_app, shared_task
 from django.conf import settings
 from django_redis import get_redis_connection
-from temba.utils import dict_to_json
+from temba.utils import analytics, dict_to_json
 
 
 LOW_PRIORITY = +10000000   # +10M ~ 110 days
@@ -60,32 +60,63 @@ def start_task(task_name):
     Ex: start_task('start_flow')
     <<< {flow=5, contacts=[1,2,3,4,5,6,7,8,9,10]}
     """
+    org_id, tasks = start_tasks(task_name, 1)
+
+    return org_id, tasks[0] if tasks else None
+
+
+def start_tasks(task_name, max_count):
+    """
+    Pops up to max_count tasks off the queue of the org with the fewest active workers, returning the org id and the
+    list of arguments that were saved. The worker counts as a single active worker for that org regardless of how many
+    tasks it took, so complete_task should be called once when they have all been handled.
+
+    Ex: start_tasks('start_flow', 10)
+    <<< 5, [{flow=5, contacts=[1,2,3]}, {flow=5, contacts=[4,5,6]}]
+    """
     r = get_redis_connection('default')
 
-    task = None
     active_set = "%s:active" % task_name
 
-    # get what queue we will work against, always the one with the lowest number of workers
-    org_queue = r.zrange(active_set, 0, 0)
+    # this lua script picks the org queue with the fewest active workers, removing any empty queues it finds from our
+    # active set, then pops up to max_count items off it and increments its worker count, all as an atomic action
+    lua = "local org = redis.call('zrange', ARGV[1], 0, 0) \n" \
+          "while next(org) do \n" \
+          "  local queue = ARGV[2] .. ':' .. org[1] \n" \
+          "  local vals = redis.call('zrange', queue, 0, ARGV[3] - 1, 'WITHSCORES') \n" \
+          "  if next(vals) then \n" \
+          "    redis.call('zincrby', ARGV[1], 1, org[1]); redis.call('zremrangebyrank', queue, 0, #vals / 2 - 1) \n" \
+          "    return {org[1], redis.call('zcard', queue), vals} \n" \
+          "  end \n" \
+          "  redis.call('zrem', ARGV[1], org[1]); org = redis.call('zrange', ARGV[1], 0, 0) \n" \
+          "end \n" \
+          "return nil \n"
+
+    result = r.eval(lua, 3, 'active_set', 'task_name', 'max_count', active_set, task_name, max_count)
+    if not result:
+        return None, []
+
+    org_id, depth, vals = int(result[0]), result[1], result[2]
+    tasks = [json.loads(val) for val in vals[0::2]]
 
-    while org_queue:
-        # this lua script does both a "zpop" (popping the next highest thing off our sorted set) and
-        # a clearing of our active set if there is no value in it as an atomic action
-        lua = "local val = redis.call('zrange', ARGV[2], 0, 0) \n" \
-              "if not next(val) then redis.call('zrem', ARGV[1], ARGV[3]) return nil \n"\
-              "else redis.call('zincrby', ARGV[1], 1, ARGV[3]); redis.call('zremrangebyrank', ARGV[2], 0, 0) return val[1] end\n"
+    # record how deep this org's queue still is and how long the oldest task we popped was waiting
+    now = time.time()
+    wait = now - _get_queued_time(float(vals[1]), now)
 
-        task = r.eval(lua, 3, 'active_set', 'queue', 'org', active_set, '%s:%d' % (task_name, int(org_queue[0])), org_queue[0])
+    analytics.gauge('temba.%s_depth.%d' % (task_name, org_id), depth)
+    analytics.gauge('temba.%s_wait.%d' % (task_name, org_id), wait)
 
-        # found a task? then break out
-        if task is not None:
-            task = json.loads(task)
-            break
+    return org_id, tasks
 
-        # if we didn't get a task, then run again against a new queue until there is nothing left in our task queue
-        org_queue = r.zrange(active_set, 0, 0)
 
-    return int(org_queue[0]) if org_queue else None, task
+def _get_queued_time(score, now):
+    """
+    Recovers the time a task was queued from its score. Priorities are multiples of 10M seconds (~110 days) so the
+    nearest such multiple to the difference between the score and now is the priority it was pushed with.
+    """
+    priority_unit = abs(LOW_PRIORITY)
+    priority = round((score - now) / priority_unit) * priority_unit
+    return score - priority
 
 
 def complete_task(task_name, org):
@@ -7,6 +7,7 @@ import datetime
 import json
 import pycountry
 import pytz
+import requests
 import six
 import time
 
@@ -26,24 +27,25 @@ from temba.locations.models import AdminBoundary
 from temba.msgs.models import Msg, SystemLabelCount
 from temba.flows.models import FlowRun
 from temba.orgs.models import Org, UserSettings
-from temba.tests import TembaTest
+from temba.tests import TembaTest, MockResponse
 from temba_expressions.evaluator import EvaluationContext, DateStyle
 
 from . import format_decimal, json_to_dict, dict_to_struct, dict_to_json, str_to_bool, percentage, datetime_to_json_date
 from . import chunk_list, get_country_code_by_name, voicexml, json_date_to_datetime
-from .cache import get_cacheable_result, get_cacheable_attr, incrby_existing, QueueRecord
+from .cache import get_cacheable_result, get_cacheable_attr, incrby_existing, LRUCache, QueueRecord
 from .currencies import currency_for_country
 from .dates import str_to_datetime, str_to_time, date_to_utc_range, datetime_to_ms, ms_to_datetime, datetime_to_epoch
 from .dates import datetime_to_str
 from .email import send_simple_email, is_valid_address
 from .export import TableExporter
 from .expressions import migrate_template, evaluate_template, evaluate_template_compat, get_function_listing
+from .expressions import get_template_variables
 from .expressions import _build_function_signature
 from .gsm7 import is_gsm7, replace_non_gsm7_accents, calculate_num_segments
-from .http import http_headers
+from .http import http_headers, get_session, send_request, CircuitBreaker, CircuitOpenError
 from .nexmo import NCCOException, NCCOResponse
-from .profiler import time_monitor
-from .queues import start_task, complete_task, push_task, HIGH_PRIORITY, LOW_PRIORITY, nonoverlapping_task
+from .profiler import time_monitor, StageTimer
+from .queues import start_task, start_tasks, complete_task, push_task, HIGH_PRIORITY, LOW_PRIORITY, nonoverlapping_task
 from .timezones import TimeZoneFormField, timezone_to_country_code
 from .text import clean_string, decode_base64, truncate, slugify_with, random_string
 from .voicexml import VoiceXMLException
@@ -149,6 +151,67 @@ class InitTest(TembaTest):
         self.assertEqual(headers, {'User-agent': 'RapidPro', 'Foo': "Bar", 'Token': "123456"})
         self.assertEqual(http_headers(), {'User-agent': 'RapidPro'})  # check changes don't leak
 
+    def test_get_session(self):
+        session = get_session("http://example.com/hook")
+
+        self.assertIs(get_session("https://Example.com/other"), session)
+        self.assertIsNot(get_session("http://example.com:8080/hook"), session)
+
+        # once we have sessions for too many hosts, the least recently used is dropped but not closed as it may be in use
+        with patch('temba.utils.http.SESSION_POOL_MAX_HOSTS', 1):
+            with patch('requests.Session.close') as mock_close:
+                get_session("http://other.com/hook")
+
+                self.assertIsNot(get_session("http://example.com/hook"), session)
+                self.assertFalse(mock_close.called)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker('example.com/hook', threshold=3, cooldown=60)
+        self.assertFalse(breaker.is_open())
+
+        # a success resets the count of consecutive failures
+        self.assertFalse(breaker.record_failure())
+        self.assertFalse(breaker.record_failure())
+        breaker.record_success()
+
+        self.assertFalse(breaker.record_failure())
+        self.assertFalse(breaker.record_failure())
+        self.assertTrue(breaker.record_failure())
+        self.assertTrue(breaker.is_open())
+
+        # requests to the endpoint now fail fast, whatever their query string
+        with patch('requests.Session.send') as mock_send:
+            with self.assertRaises(CircuitOpenError):
+                send_request(requests.Request('GET', "http://example.com/hook?id=123").prepare(), timeout=5)
+
+            self.assertFalse(mock_send.called)
+
+        # but other endpoints on the same host can still be called
+        with patch('requests.Session.send') as mock_send:
+            mock_send.return_value = MockResponse(200, "OK")
+            send_request(requests.Request('GET', "http://example.com/other_hook").prepare(), timeout=5)
+
+            self.assertTrue(mock_send.called)
+
+        # once the cooldown has passed, calls can be made but a single failure will reopen the circuit
+        get_redis_connection().delete(CircuitBreaker.OPEN_KEY % 'example.com/hook')
+        self.assertFalse(breaker.is_open())
+
+        self.assertTrue(breaker.record_failure())
+        self.assertTrue(breaker.is_open())
+
+        # server errors from other hosts are counted as failures but client errors aren't
+        with patch('requests.Session.send') as mock_send:
+            mock_send.return_value = MockResponse(500, "Error")
+            send_request(requests.Request('GET', "http://other.com/hook").prepare(), timeout=5)
+
+            mock_send.return_value = MockResponse(400, "Bad Request")
+            send_request(requests.Request('GET', "http://another.com/hook").prepare(), timeout=5)
+
+        r = get_redis_connection()
+        self.assertEqual(r.get(CircuitBreaker.FAILURES_KEY % 'other.com/hook'), b'1')
+        self.assertIsNone(r.get(CircuitBreaker.FAILURES_KEY % 'another.com/hook'))
+
 
 class DatesTest(TembaTest):
     def test_datetime_to_ms(self):
@@ -406,6 +469,38 @@ class CacheTest(TembaTest):
         self._test_value = "CACHED"
         self.assertEqual(get_cacheable_attr(self, '_test_value', calculate), "CACHED")
 
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set('a', 1, "A1")
+        cache.set('b', 1, "B1")
+
+        self.assertEqual(cache.get('a', 1), "A1")
+        self.assertIsNone(cache.get('c', 1))
+
+        # adding a third item evicts the least recently used which is now b
+        cache.set('c', 1, "C1")
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual(cache.get('c', 1), "C1")
+
+        # lookups for other versions miss
+        self.assertIsNone(cache.get('a', 2))
+        self.assertIsNone(cache.get('a', 1))
+
+        cache.set('a', 2, "A2")
+        self.assertEqual(cache.get('a', 2), "A2")
+
+        cache.delete('a')
+        self.assertIsNone(cache.get('a', 2))
+
+        # items expire after our TTL
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get('c', 1))
+
+        cache.set('a', 1, "A1")
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
     def test_incrby_existing(self):
         r = get_redis_connection()
         r.setex('foo', 100, 10)
@@ -452,6 +547,10 @@ class CacheTest(TembaTest):
             lock = QueueRecord('test_items', lambda i: i['id'])
             self.assertEqual(lock.filter_unqueued([dict(id=3)]), [])
 
+            # items can be unmarked so that they can be queued again
+            lock.set_unqueued([dict(id=3)])
+            self.assertEqual(lock.filter_unqueued([dict(id=3)]), [dict(id=3)])
+
 
 class EmailTest(TembaTest):
 
@@ -712,6 +811,47 @@ class QueueTest(TembaTest):
         self.assertIsNone(r.zscore('test:active', self.org.id))
         self.assertIsNone(r.zscore('test:active', self.org2.id))
 
+    @patch('temba.utils.analytics.gauge')
+    def test_start_tasks(self, mock_gauge):
+        r = get_redis_connection()
+
+        self.create_secondary_org()
+
+        args = [dict(task=i) for i in range(6)]
+
+        push_task(self.org, None, 'test', args[2])
+        push_task(self.org, None, 'test', args[3], LOW_PRIORITY)
+        push_task(self.org, None, 'test', args[0], HIGH_PRIORITY)
+        push_task(self.org, None, 'test', args[1])
+        push_task(self.org2, None, 'test', args[4])
+        push_task(self.org2, None, 'test', args[5])
+
+        # pop multiple tasks off the first org's queue, in priority order
+        self.assertEqual(start_tasks('test', 3), (self.org.id, [args[0], args[1], args[2]]))
+
+        # one worker is active on that org regardless of how many tasks it took
+        self.assertEqual(r.zscore('test:active', self.org.id), 1)
+
+        mock_gauge.assert_any_call('temba.test_depth.%d' % self.org.id, 1)
+        wait = mock_gauge.call_args_list[1][0]
+        self.assertEqual(wait[0], 'temba.test_wait.%d' % self.org.id)
+        self.assertTrue(0 <= wait[1] < 5)
+
+        # next pop goes to the other org as it has fewer active workers, and can take less than max_count
+        self.assertEqual(start_tasks('test', 3), (self.org2.id, [args[4], args[5]]))
+        self.assertEqual(r.zscore('test:active', self.org2.id), 1)
+
+        complete_task('test', self.org2.id)
+
+        # org2's queue is empty so that is cleared from our active set and we move on to the low priority task
+        self.assertEqual(start_tasks('test', 3), (self.org.id, [args[3]]))
+        self.assertIsNone(r.zscore('test:active', self.org2.id))
+        self.assertEqual(r.zscore('test:active', self.org.id), 2)
+
+        # nothing left to do
+        self.assertEqual(start_tasks('test', 3), (None, []))
+        self.assertIsNone(r.zscore('test:active', self.org.id))
+
     @patch('redis.client.StrictRedis.lock')
     @patch('redis.client.StrictRedis.get')
     def test_nonoverlapping_task(self, mock_redis_get, mock_redis_lock):
@@ -789,6 +929,13 @@ class ExpressionsTest(TembaTest):
 
         self.context = EvaluationContext(variables, timezone.utc, DateStyle.DAY_FIRST)
 
+    def test_get_template_variables(self):
+        self.assertEqual(get_template_variables(None), set())
+        self.assertEqual(get_template_variables("Hello World"), set())
+        self.assertEqual(get_template_variables("Hello @contact.First_Name, @(UPPER(flow.color) & contact.tel) "
+                                                "@unknown.foo @(INVALID"),
+                         {'contact.first_name', 'flow.color', 'contact.tel'})
+
     def test_evaluate_template(self):
         self.assertEqual(("Hello World", []), evaluate_template('Hello World', self.context))  # no expressions
         self.assertEqual(("Hello = Well 5", []),
@@ -1623,6 +1770,25 @@ class MiddlewareTest(TembaTest):
 
 
 class ProfilerTest(TembaTest):
+    @patch('temba.utils.analytics.gauge')
+    def test_stage_timer(self, mock_gauge):
+        timer = StageTimer()
+
+        with patch('time.time', side_effect=[1000.0, 1000.5, 1001.0, 1003.0, 1004.0, 1004.25]):
+            with timer.stage('load'):
+                pass
+            with timer.stage('handle'):
+                pass
+            with timer.stage('load'):
+                pass
+
+        self.assertEqual(list(timer.timings.items()), [('load', 0.75), ('handle', 2.0)])
+        self.assertEqual(six.text_type(timer), "load=0.750s, handle=2.000s")
+
+        timer.report('temba.test')
+        mock_gauge.assert_any_call('temba.test.load', 0.75)
+        mock_gauge.assert_any_call('temba.test.handle', 2.0)
+
     @time_monitor(threshold=50)
     def foo(self, bar):
         time.sleep(bar / 1000.0)